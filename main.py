@@ -1,4 +1,5 @@
 import random
+import copy
 import yaml
 import os
 import re
@@ -7,13 +8,14 @@ import json
 import asyncio
 import datetime
 import sys
+from types import MappingProxyType
 from astrbot.api.all import *
 
 # 添加当前目录到系统路径
 current_dir = os.path.dirname(os.path.abspath(__file__))
 if (current_dir not in sys.path):
     sys.path.append(current_dir)
-from sign_image import SignImageGenerator
+from sign_image import SignImageGenerator, SignRenderService
 
 # 添加商城模块导入
 from niuniu_shop import NiuniuShop
@@ -25,15 +27,49 @@ from niuniu_redpacket import NiuniuRedPacket
 from niuniu_market import NiuniuMarket
 # 添加税收系统导入
 from tax_system import TaxSystem
+# 添加存储后端导入
+from niuniu_storage import create_storage, normalize_group, ShardedGroups
+# 添加写回式持久化导入
+from niuniu_persistence import PersistenceManager
+from niuniu_journal import EventJournal
+from niuniu_scheduler import Scheduler, JobStore
+from niuniu_router import CommandRouter
+from niuniu_nickname import NicknameIndex, AmbiguousNickname
+from niuniu_leaderboard import Leaderboard
+from niuniu_global_rank import GlobalRanking
+from niuniu_txn import LockManager, Transaction
+from niuniu_backend import create_state_backend, StaleRecord
+from niuniu_cooldown import CooldownStore
+from niuniu_ratelimit import RateLimiter
+# 添加数据编解码器导入
+from niuniu_codec import DataCodec, available_formats
 
 # 常量定义
 PLUGIN_DIR = os.path.join('data', 'plugins', 'astrbot_plugin_niuniuplus')
 os.makedirs(PLUGIN_DIR, exist_ok=True)
-NIUNIU_LENGTHS_FILE = os.path.join('data', 'niuniu_lengths.yml')
+NIUNIU_LENGTHS_FILE = os.path.join('data', 'niuniu_lengths')  # 不含扩展名，由数据格式决定
+NIUNIU_LENGTHS_DB = os.path.join('data', 'niuniu_lengths.db')
+NIUNIU_JOURNAL_FILE = os.path.join('data', 'niuniu_journal.jsonl')  # 金币/长度变动日志
+NIUNIU_SHARD_DIR = os.path.join('data', 'niuniu')  # 分片布局：每个群一个数据文件/数据库
 NIUNIU_TEXTS_FILE = os.path.join(PLUGIN_DIR, 'niuniu_game_texts.yml')
-LAST_ACTION_FILE = os.path.join(PLUGIN_DIR, 'last_actions.yml')
+LAST_ACTION_FILE = os.path.join(PLUGIN_DIR, 'last_actions')  # 不含扩展名，由数据格式决定
+BULL_KINGS_FILE = os.path.join('data', 'niuniu_bull_kings')  # 牛王与当日连胜榜首，不含扩展名
+GLOBAL_RANK_FILE = os.path.join('data', 'niuniu_global_rank')  # 分片布局下的全服排行统计，不含扩展名
+JOBS_DB = os.path.join('data', 'niuniu_jobs.db')  # 定时任务
+NIUNIU_STATE_DB = os.path.join('data', 'niuniu_state.db')  # 多进程共享状态
+LEGACY_JOBS_FILE = os.path.join('data', 'niuniu_jobs')  # 旧版本的定时任务文件，不含扩展名
 UPDATES_FILE = os.path.join(current_dir, 'updates.txt')  # 添加更新记录文件路径
 LOCK_COOLDOWN = 300  # 锁牛牛冷却时间 5分钟
+EMPTY_GROUP = MappingProxyType({})  # 不存在的群的只读数据
+# 默认限流策略，可在配置 rate_limits 中按名称覆盖（设为空表示不限制）
+DEFAULT_RATE_LIMITS = {
+    '比划': {'policy': 'sliding_log', 'limit': 3, 'window': 180},       # 每人3分钟内最多比划3次
+    '锁牛牛': {'policy': 'sliding_log', 'limit': 3, 'window': 300},     # 每人5分钟内最多锁3个不同用户
+    '锁牛牛冷却': {'policy': 'sliding_log', 'limit': 1, 'window': LOCK_COOLDOWN},
+    'group': {'policy': 'token_bucket', 'capacity': 30, 'rate': 1},     # 每个群的命令总数
+    # 全部群的命令总数，默认不限制，以免个别群刷屏影响其他群；需要时可配置如 {'policy': 'token_bucket', 'capacity': 300, 'rate': 20}
+    'global': None,
+}
 
 @register("niuniu_plugin", "长安某", "牛牛插件，包含注册牛牛、打胶、我的牛牛、比划比划、牛牛排行等功能", "3.5.0")
 class NiuniuPlugin(Star):
@@ -50,46 +86,183 @@ class NiuniuPlugin(Star):
     def __init__(self, context: Context, config: dict = None):
         super().__init__(context)
         self.config = config or {}
+        # 存储后端，默认使用SQLite并自动从原YAML文件导入
+        storage_cfg = self.config.get('storage_config', {})
+        # 数据文件编解码器，旧的YAML文件可透明读取
+        self.codec = DataCodec(storage_cfg.get('data_format', 'json'))
+        self.storage = create_storage(
+            storage_cfg.get('backend', 'sqlite'), self.codec, NIUNIU_LENGTHS_FILE, NIUNIU_LENGTHS_DB,
+            layout=storage_cfg.get('layout', 'single'), shard_dir=NIUNIU_SHARD_DIR
+        )
+        # 写回式持久化，合并一个时间窗口内的所有保存请求
+        self.persistence = PersistenceManager(storage_cfg.get('save_delay', 2.0))
         self.niuniu_lengths = self._load_niuniu_lengths()
+        # 各群插件开关的内存缓存 {str(group_id): bool}，分片布局下按需填充
+        self._group_enabled = {
+            group_id: bool(group_data.get('plugin_enabled', False))
+            for group_id, group_data in self.niuniu_lengths.items() if isinstance(group_data, dict)
+        }
+        # 按群的昵称索引，用于不@时按昵称查找目标
+        self.nickname_index = NicknameIndex(self.peek_group_data)
+        # 按群的长度排行索引，随保存请求增量更新
+        self.leaderboard = Leaderboard(self.peek_group_data)
+        # 按用户划分的锁，供 transaction 使用
+        self.locks = LockManager()
+        # 多进程共享状态（默认仅本进程）
+        self.state = create_state_backend(
+            storage_cfg.get('state_backend', 'memory'), NIUNIU_STATE_DB, storage_cfg.get('worker_id')
+        )
+        if self.state.shared:
+            # 日志、群账户等文件由各进程分别写入，需要固定的进程标识才能在重启后找回；
+            # 整文件保存的牛牛数据会互相覆盖，只能使用按行写入的SQLite存储
+            if not storage_cfg.get('worker_id'):
+                raise ValueError("state_backend 为 sqlite 时需要为每个进程配置固定且不同的 storage_config.worker_id")
+            if self.storage.file_based:
+                raise ValueError("state_backend 为 sqlite 时牛牛数据需使用SQLite存储（storage_config.backend: sqlite）")
+        # 金币/长度变动日志，重放上次快照之后的变动
+        self.journal = EventJournal(self.worker_file(NIUNIU_JOURNAL_FILE),
+                                    storage_cfg.get('journal_fsync_interval', 1.0))
+        self.persistence.register('niuniu_lengths', self._snapshot_niuniu_lengths, self._write_niuniu_lengths)
+        replayed = self.journal.replay(self.niuniu_lengths)
+        if replayed:
+            self.persistence.mark_dirty('niuniu_lengths', replayed)
+        # 全服排行与百分位统计（分片布局下在日志压缩和关闭时保存）
+        self._global_ranking_changed = False
+        self.global_ranking = self._load_global_ranking()
+        for group_id, user_id in replayed:
+            self._touch_global_ranking(group_id, [user_id])
+        if self.state.shared:
+            self._commit_replayed(replayed)
+        asyncio.create_task(self._compact_journal(storage_cfg.get('journal_compact_interval', 600)))
+        # 分片布局下定期把长时间不活跃的群移出内存
+        if isinstance(self.niuniu_lengths, ShardedGroups):
+            asyncio.create_task(self._evict_idle_groups(storage_cfg.get('group_ttl', 3600)))
         self.niuniu_texts = self._load_niuniu_texts()
-        self.last_dajiao_time = {}      # {str(group_id): {str(user_id): last_time}}
-        self.last_compare_time = {}     # {str(group_id): {str(user_id): {str(target_id): last_time}}}
-        self.last_actions = self._load_last_actions()
+        # 冷却与频率记录（含比划冷却），过期记录定期清理
+        self.cooldowns = CooldownStore(self._load_last_actions())
+        self.last_actions = self.cooldowns.data
+        self._register_cooldown_rules()
+        self.persistence.register(
+            'last_actions',
+            lambda keys: self.cooldowns.snapshot(),
+            self._write_last_actions
+        )
+        # 命令限流，按用户的计数保存在冷却数据中（重启后仍然有效），刷屏保护只在内存中计数
+        self.limiter = RateLimiter(DEFAULT_RATE_LIMITS, self.cooldowns, self._save_last_actions)
+        for name, spec in (self.config.get('rate_limits') or {}).items():
+            try:
+                self.limiter.configure(name, spec)
+            except Exception as e:
+                logger.error(f"限流配置 {name} 无效: {str(e)}")
+        self.limiter.persist('比划', '锁牛牛', '锁牛牛冷却')
+        self.cooldowns.vacuum()
+        asyncio.create_task(self._vacuum_cooldowns(storage_cfg.get('cooldown_vacuum_interval', 600)))
         self.admins = self._load_admins()  # 加载管理员列表
         self.working_users = {}  # {str(group_id): {str(user_id): {start_time: float, duration: int}}}
+        # 集中式定时任务调度器，各模块在初始化时注册任务类型
+        self.job_store = JobStore(JOBS_DB)
+        self.scheduler = Scheduler(lambda job_id: self.persistence.mark_dirty('jobs', {job_id}),
+                                   claim=self._claim_job if self.state.shared else None)
+        self.scheduler.load(self.job_store.load())
+        self.persistence.register('jobs', self.scheduler.snapshot, self.job_store.write)
+        self.scheduler.register('work', self._on_work_finished)
+        # 命令路由，各模块在初始化时注册自己的命令
+        self.router = CommandRouter()
+        self._register_commands()
         # 初始化商城实例
         self.shop = NiuniuShop(self)
         # 初始化定时测试模块
-        self.timer_test = TimerTest(context)
+        self.timer_test = TimerTest(context, self.scheduler, self.router)
         # 初始化红包模块
         self.redpacket = NiuniuRedPacket(self)
         # 初始化牛牛集市
         self.market = NiuniuMarket(self)
         # 初始化税收系统
         self.tax_system = TaxSystem(self)
-        # 初始化打工任务字典
-        self._work_tasks = {}  # 添加这一行
-        
-        # 从 last_actions 中恢复正在进行的打工任务
-        self._restore_work_tasks()
-        
-        # 保留变性手术监控任务
-        asyncio.create_task(self.shop.monitor_gender_surgeries())
-        self.bull_kings = {}  # 记录每个群的牛王 {str(group_id): str(user_id)}
-    
-        # 启动0点重置连胜的任务
-        asyncio.create_task(self.reset_win_streak_at_midnight())
+        # 签到图片渲染服务（线程池）
+        render_cfg = self.config.get('render_config', {})
+        self.sign_renderer = SignRenderService(render_cfg.get('max_workers', 2), render_cfg.get('max_pending', 8))
+        # 首次启动时从旧版本数据中补建定时任务，之后只需读取任务表
+        if not self.job_store.get_flag('legacy_migrated'):
+            self._migrate_legacy_jobs()
+        self.scheduler.start()
+        
+        # 牛王 {str(group_id): str(user_id)}；当日连胜榜首 {str(group_id): {day, user, streak}}
+        # 跨天后首次访问该群时，前一天的榜首成为牛王，无需在0点遍历所有数据
+        self.bull_kings, self.streak_leaders = self._load_bull_kings()
+        self.persistence.register(
+            'bull_kings',
+            lambda keys: copy.deepcopy({'kings': self.bull_kings, 'leaders': self.streak_leaders}),
+            self._write_bull_kings
+        )
         
         # 确保更新记录文件存在
         if not os.path.exists(UPDATES_FILE):
             self._create_default_updates_file()
             
+    def worker_file(self, path):
+        """本进程单独写入的数据文件路径
+
+        多进程部署时在扩展名前加上进程标识（如 niuniu_journal.bot1.jsonl），
+        避免多个进程追加、压缩或整体替换同一个文件；单进程时返回原路径。
+        """
+        if not self.state.shared:
+            return path
+        # 不含扩展名的基础路径直接追加，扩展名由数据格式决定
+        root, ext = os.path.splitext(path) if path.endswith('.jsonl') else (path, '')
+        return f"{root}.{re.sub(r'[^0-9A-Za-z_-]', '_', self.state.worker_id)}{ext}"
+
+    def load_data_file(self, base_path, validate=None):
+        """读取本进程的数据文件，多进程部署首次启动时从原来的共用文件导入"""
+        path = self.worker_file(base_path)
+        data = self.codec.load(path, validate)
+        if data is None and path != base_path:
+            data = self.codec.load(base_path, validate)
+        return data
+
+    def _claim_job(self, job):
+        """多进程部署：领取定时任务（只执行本进程负责的群的任务），成功后先同步任务涉及的用户再执行"""
+        if job.group_id is not None and not self.state.own_group(job.group_id):
+            return False
+        if not self.state.claim(job):
+            return False
+        if job.group_id is not None and job.user_id is not None:
+            self.sync_user(job.group_id, job.user_id)
+        return True
+
+    def _commit_replayed(self, replayed):
+        """多进程部署：把从日志恢复的长度和金币按版本写入共享状态
+
+        日志只包含本进程负责的群，其中的数值不会比共享状态中的旧；
+        先取得共享状态中的当前版本再提交，之后同步时不会被旧版本覆盖。
+        """
+        for group_id, user_id in sorted(replayed):
+            user_data = self.peek_group_data(group_id).get(user_id)
+            values = {'length': user_data['length'], 'coins': user_data['coins']}
+            self.state.sync(group_id, user_id, user_data)
+            user_data.update(values)
+            self.state.commit(group_id, {user_id: user_data})
+
+    def _migrate_legacy_jobs(self):
+        """从旧版本的数据中补建定时任务（只执行一次）"""
+        try:
+            legacy_jobs = self.codec.load(LEGACY_JOBS_FILE, lambda d: d is None or isinstance(d, list)) or []
+            self.scheduler.load(legacy_jobs)
+            self._restore_work_tasks()
+            self.shop.restore_gender_surgery_jobs()
+            self.job_store.write(self.scheduler.snapshot())
+            self.job_store.set_flag('legacy_migrated')
+        except Exception as e:
+            logger.error(f"迁移旧定时任务失败: {str(e)}")
+
     def _restore_work_tasks(self):
-        """从 last_actions 中恢复打工任务"""
+        """从 last_actions 中恢复没有对应定时任务的打工（旧版本遗留）"""
         current_time = time.time()
         for group_id, users in self.last_actions.items():
             for user_id, user_actions in users.items():
                 if 'work_data' in user_actions:
+                    if self.scheduler.get(self._work_job_id(group_id, user_id)):
+                        continue
                     work_data = user_actions['work_data']
                     if not self._is_user_working(group_id, user_id):
                         # 如果用户不再工作中，清理数据
@@ -113,52 +286,26 @@ class NiuniuPlugin(Star):
                     multiplier = self.shop.get_work_multiplier(group_id, user_id) if hasattr(self, 'shop') else 1
                     total_coins = int(coins_per_hour * work_data['duration'] * multiplier)
                     
-                    task_id = f"work_{group_id}_{user_id}_{int(work_data['start_time'])}"
-                    self._work_tasks[task_id] = {
-                        'task': asyncio.create_task(self._work_timer_improved(
-                            group_id=group_id,
-                            user_id=user_id,
-                            nickname=nickname,
-                            unified_msg_origin=None,  # 无法恢复原始消息来源
-                            delay_seconds=int(remaining_seconds)
-                        )),
-                        'coins': total_coins,
-                        'hours': work_data['duration'],
-                        'start_time': work_data['start_time']
-                    }
+                    self._schedule_work(group_id, user_id, nickname, None,  # 无法恢复原始消息来源
+                                        work_data['start_time'], work_data['duration'], total_coins)
         
         # 保存可能的更改
         self._save_last_actions()
 
     # region 数据管理
-    def _create_niuniu_lengths_file(self):
-        """创建数据文件"""
-        try:
-            with open(NIUNIU_LENGTHS_FILE, 'w', encoding='utf-8') as f:
-                yaml.dump({}, f)
-        except Exception as e:
-            logger.error(f"创建文件失败: {str(e)}")
-
     def _load_niuniu_lengths(self):
         """加载牛牛数据"""
-        if not os.path.exists(NIUNIU_LENGTHS_FILE):
-            self._create_niuniu_lengths_file()
-        
         try:
-            with open(NIUNIU_LENGTHS_FILE, 'r', encoding='utf-8') as f:
-                data = yaml.safe_load(f) or {}
+            data = self.storage.load()
             
-            # 数据结构验证
+            # 数据结构验证（分片布局在各群加载时验证）
             for group_id in list(data.keys()):
-                group_data = data[group_id]
-                if not isinstance(group_data, dict):
-                    data[group_id] = {'plugin_enabled': False}
-                elif 'plugin_enabled' not in group_data:
-                    group_data['plugin_enabled'] = False
+                data[group_id] = normalize_group(data[group_id])
             return data
         except Exception as e:
+            # 不能返回空数据，否则下一次保存会覆盖掉所有玩家的数据
             logger.error(f"加载数据失败: {str(e)}")
-            return {}
+            raise
 
     def _load_niuniu_texts(self):
         """加载游戏文本"""
@@ -232,6 +379,8 @@ class NiuniuPlugin(Star):
 🔹 锁牛牛 @目标 - 锁他牛牛
 🔹 比划比划 @目标 - 发起对决
 🔹 牛牛排行 - 查看群排行榜
+🔹 我的排名 - 查看自己的排名
+🔹 全服排行/全服排名 - 查看跨群排行
 🔹 每日签到 - 领取金币奖励
 🔹 牛牛商城 - 购买强力道具
 🔹 牛牛背包 - 查看拥有道具
@@ -282,29 +431,234 @@ class NiuniuPlugin(Star):
                 base[key] = value
         return base
 
-    def _save_niuniu_lengths(self):
-        """保存数据"""
-        try:
-            with open(NIUNIU_LENGTHS_FILE, 'w', encoding='utf-8') as f:
-                yaml.dump(self.niuniu_lengths, f, allow_unicode=True)
-        except Exception as e:
-            logger.error(f"保存失败: {str(e)}")
+    def _save_niuniu_lengths(self, group_id=None, *user_ids):
+        """标记牛牛数据待保存，由持久化管理器合并后在后台落盘
+
+        Args:
+            group_id: 发生变化的群，为None表示全部数据
+            *user_ids: 发生变化的用户，为空表示整个群
+        """
+        txn = Transaction.current(group_id) if group_id is not None else None
+        if txn is not None and user_ids:
+            # 事务内的保存请求在事务结束时合并提交
+            txn.mark_dirty(user_ids)
+            return
+        if group_id is not None and user_ids:
+            # 没有通过 record_change 记录的变化也要写入日志，保证崩溃后可以重放
+            for uid in user_ids:
+                if uid is not None and (data := self.get_user_data(group_id, uid)) is not None:
+                    self.journal.append_changed(group_id, uid, 'save', data)
+        if self.state.shared and group_id is not None and user_ids:
+            try:
+                self.state.commit(group_id, {
+                    uid: data for uid in user_ids
+                    if uid is not None and (data := self.get_user_data(group_id, uid)) is not None
+                })
+            except StaleRecord as e:
+                # 本地数据是在旧版本上修改的，放弃本地修改，以其他进程写入的版本为准
+                for uid in e.user_ids:
+                    self.sync_user(group_id, uid)
+                raise
+        self._mark_niuniu_dirty(group_id, *user_ids)
+
+    def _mark_niuniu_dirty(self, group_id=None, *user_ids):
+        """通知排行索引并标记牛牛数据待保存"""
+        if group_id is None:
+            keys = None
+        elif user_ids:
+            keys = {(str(group_id), str(uid)) for uid in user_ids if uid is not None}
+        else:
+            keys = {(str(group_id), None)}
+        self.leaderboard.touch(group_id, user_ids or None)
+        self._touch_global_ranking(group_id, user_ids)
+        self.persistence.mark_dirty('niuniu_lengths', keys)
+
+    def _snapshot_niuniu_lengths(self, keys):
+        """生成牛牛数据快照，同时记录快照包含的日志序号"""
+        return self.journal.seq, self.storage.snapshot(self.niuniu_lengths, keys)
+
+    def _write_niuniu_lengths(self, payload):
+        """写入牛牛数据快照后推进日志检查点"""
+        seq, snapshot = payload
+        self.storage.write(snapshot)
+        self.journal.checkpoint(seq)
+
+    def record_change(self, group_id, user_id, reason: str, dlen: int = 0, dcoins: int = 0):
+        """把一次金币/长度变动追加到日志（需在修改用户数据之后、保存之前调用）
+
+        保存时会为未记录的变化补写原因为 save 的记录，这里用于留下具体原因。
+        """
+        txn = Transaction.current(group_id)
+        if txn is not None:
+            txn.record(user_id, reason, dlen, dcoins)
+            return
+        self.journal.append(group_id, user_id, dlen, dcoins, reason, self.get_user_data(group_id, user_id))
+
+    async def _compact_journal(self, interval: float):
+        """定期落盘并清理已包含在快照中的日志记录"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                # 群账户余额平时只记入明细，在这里批量保存
+                self.tax_system.flush_ledger()
+                self._save_global_ranking()
+                await self.persistence.flush()
+                loop = asyncio.get_running_loop()
+                dropped = await loop.run_in_executor(None, self.journal.compact)
+                dropped += await loop.run_in_executor(None, self.tax_system.ledger.compact)
+                if dropped:
+                    logger.debug(f"变动日志已压缩，清理 {dropped} 条记录")
+            except Exception as e:
+                logger.error(f"压缩变动日志失败: {str(e)}")
+
+    async def _evict_idle_groups(self, ttl: float):
+        """分片布局：落盘后把超过ttl秒未访问的群移出内存"""
+        while True:
+            await asyncio.sleep(min(ttl, 300))
+            try:
+                if not self.niuniu_lengths.idle_groups(ttl):
+                    continue
+                # 先统计待处理的变化，避免之后为此重新加载已淘汰的群
+                self.global_ranking.apply(self.peek_group_data)
+                await self.persistence.flush()
+                # 落盘期间可能有新的访问或修改，重新检查
+                for group_id in self.niuniu_lengths.idle_groups(ttl):
+                    if self.persistence.is_dirty('niuniu_lengths', lambda key: key[0] == group_id):
+                        continue
+                    self.niuniu_lengths.evict(group_id)
+                    self.nickname_index.forget(group_id)
+                    self.leaderboard.forget(group_id)
+                    self.journal.forget(group_id)
+                    self.storage.release(group_id)
+            except Exception as e:
+                logger.error(f"淘汰不活跃群数据失败: {str(e)}")
 
     def _load_last_actions(self):
-        """加载冷却数据"""
+        """加载冷却数据，文件损坏时回退到最新的有效历史版本"""
         try:
-            with open(LAST_ACTION_FILE, 'r', encoding='utf-8') as f:
-                return yaml.safe_load(f) or {}
-        except:
+            return self.load_data_file(LAST_ACTION_FILE, lambda d: d is None or isinstance(d, dict)) or {}
+        except Exception as e:
+            logger.error(f"加载冷却数据失败: {str(e)}")
             return {}
 
     def _save_last_actions(self):
-        """保存冷却数据"""
+        """标记冷却数据待保存"""
+        self.persistence.mark_dirty('last_actions')
+
+    def _write_last_actions(self, data):
+        """把冷却数据快照写入文件"""
+        self.codec.write(self.worker_file(LAST_ACTION_FILE), data)
+
+    def _register_cooldown_rules(self):
+        """登记冷却数据各字段的清理规则"""
+        def holds(item):
+            """等待使用道具的标记在道具用掉后删除"""
+            def keep(group_id, user_id):
+                if isinstance(self.niuniu_lengths, ShardedGroups):
+                    group_data = self.niuniu_lengths.peek(group_id)
+                    if group_data is None:
+                        return True  # 群未加载，暂不判断
+                else:
+                    group_data = self.peek_group_data(group_id)
+                user_data = group_data.get(user_id)
+                return isinstance(user_data, dict) and bool(user_data.get('items', {}).get(item))
+            return keep
+
+        self.cooldowns.expire('dajiao', self.COOLDOWN_30_MIN)  # 超过30分钟与从未打胶的效果相同
+        self.cooldowns.expire('last_viagra_use', 86400)
+        self.cooldowns.expire('lock', self.LOCK_COOLDOWN)  # 旧版本的锁牛牛冷却，现由限流计数 rate:锁牛牛冷却 代替
+        self.cooldowns.expire('lock_records', self.LOCK_COOLDOWN, nested=True)
+        self.cooldowns.expire('compare_records', self.COMPARE_COOLDOWN, nested=True)
+        self.cooldowns.expire('waiting_for_exchange', keep=holds('exchanger'))
+        self.cooldowns.expire('waiting_for_sterilization', keep=holds('sterilization_ring'))
+        self.cooldowns.expire('waiting_for_parasite', keep=holds('parasite'))
+
+    async def _vacuum_cooldowns(self, interval: float):
+        """定期清理过期的冷却记录与限流计数"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.limiter.vacuum()
+                removed = self.cooldowns.vacuum()
+                if removed:
+                    self._save_last_actions()
+                    logger.debug(f"冷却数据已清理 {removed} 条过期记录")
+            except Exception as e:
+                logger.error(f"清理冷却数据失败: {str(e)}")
+
+    def _load_global_ranking(self):
+        """建立全服排行统计
+
+        单文件布局下所有数据都在内存中，启动时直接统计；
+        分片布局下读取保存的统计结果，首次启动时逐个读取分片建立。
+        """
+        ranking = GlobalRanking(20)
+        if not isinstance(self.niuniu_lengths, ShardedGroups):
+            for group_id, group_data in self.iter_all_groups():
+                ranking.add_group(group_id, group_data)
+            return ranking
+
         try:
-            with open(LAST_ACTION_FILE, 'w', encoding='utf-8') as f:
-                yaml.dump(self.last_actions, f, allow_unicode=True)
+            records = self.load_data_file(GLOBAL_RANK_FILE, lambda d: d is None or isinstance(d, dict))
         except Exception as e:
-            logger.error(f"保存冷却数据失败: {str(e)}")
+            logger.error(f"加载全服排行统计失败: {str(e)}")
+            records = None
+        if records is not None:
+            ranking.load(records)
+        else:
+            # 已加载的群（如重放变动日志时）以内存中的数据为准
+            for group_id, group_data in self.iter_all_groups():
+                ranking.add_group(group_id, group_data)
+            logger.info(f"已建立全服排行统计，共 {len(ranking)} 个用户")
+        self.persistence.register('global_ranking', self._snapshot_global_ranking, self._write_global_ranking)
+        if records is None:
+            self.persistence.mark_dirty('global_ranking')
+        return ranking
+
+    def _touch_global_ranking(self, group_id, user_ids):
+        """记录全服排行中发生变化的用户"""
+        if group_id is None:
+            groups = [(gid, gdata) for gid, gdata in dict.items(self.niuniu_lengths) if isinstance(gdata, dict)]
+        elif user_ids:
+            self.global_ranking.touch(group_id, user_ids)
+            groups = []
+        else:
+            groups = [(str(group_id), self.peek_group_data(group_id))]
+        for gid, group_data in groups:
+            self.global_ranking.touch(gid, [uid for uid, data in group_data.items() if isinstance(data, dict)])
+        self._global_ranking_changed = True
+
+    def _save_global_ranking(self):
+        """分片布局：标记全服排行统计待保存
+
+        统计包含所有群的用户，每次保存都要写出全部记录，不随每次修改保存，
+        只在日志压缩和插件关闭时保存；意外退出时最多丢失一个压缩周期内的排名变化。
+        """
+        if self._global_ranking_changed and isinstance(self.niuniu_lengths, ShardedGroups):
+            self._global_ranking_changed = False
+            self.persistence.mark_dirty('global_ranking')
+
+    def _snapshot_global_ranking(self, keys):
+        """生成全服排行统计快照"""
+        self.global_ranking.apply(self.peek_group_data)
+        return self.global_ranking.dump()
+
+    def _write_global_ranking(self, data):
+        """把全服排行统计快照写入文件"""
+        self.codec.write(self.worker_file(GLOBAL_RANK_FILE), data)
+
+    def _load_bull_kings(self):
+        """加载牛王数据"""
+        try:
+            data = self.load_data_file(BULL_KINGS_FILE, lambda d: d is None or isinstance(d, dict)) or {}
+            return data.get('kings', {}), data.get('leaders', {})
+        except Exception as e:
+            logger.error(f"加载牛王数据失败: {str(e)}")
+            return {}, {}
+
+    def _write_bull_kings(self, data):
+        """把牛王数据快照写入文件"""
+        self.codec.write(self.worker_file(BULL_KINGS_FILE), data)
 
     def _load_admins(self):
         """加载管理员列表"""
@@ -329,17 +683,79 @@ class NiuniuPlugin(Star):
         return f"{length}cm"
 
     def get_group_data(self, group_id):
-        """获取群组数据"""
+        """获取群组数据，不存在时创建（只读场景请使用 peek_group_data）"""
         group_id = str(group_id)
         if group_id not in self.niuniu_lengths:
             self.niuniu_lengths[group_id] = {'plugin_enabled': False}  # 默认关闭插件
         return self.niuniu_lengths[group_id]
 
+    def peek_group_data(self, group_id):
+        """只读获取群组数据，群不存在时返回空的只读字典，不会创建群数据"""
+        group_data = self.niuniu_lengths.get(str(group_id))
+        return group_data if group_data is not None else EMPTY_GROUP
+
+    def iter_all_groups(self):
+        """依次获取所有群的数据，用于启动时的一次性统计或补建
+
+        分片布局下未加载的群直接从分片读取，不放入内存；已加载的群以内存中的数据为准。
+        """
+        if not isinstance(self.niuniu_lengths, ShardedGroups):
+            for group_id, group_data in self.niuniu_lengths.items():
+                if isinstance(group_data, dict):
+                    yield group_id, group_data
+            return
+        seen = set()
+        for group_id, group_data in self.storage.iter_groups():
+            loaded = self.niuniu_lengths.peek(group_id)
+            seen.add(group_id)
+            yield group_id, loaded if loaded is not None else group_data
+        # 尚未落盘的新群只在内存中
+        for group_id, group_data in list(dict.items(self.niuniu_lengths)):
+            if group_id not in seen and isinstance(group_data, dict):
+                yield group_id, group_data
+
+    def is_plugin_enabled(self, group_id):
+        """群是否启用了插件（优先读取内存缓存）"""
+        group_id = str(group_id)
+        enabled = self._group_enabled.get(group_id)
+        if enabled is None:
+            enabled = bool(self.peek_group_data(group_id).get('plugin_enabled', False))
+            self._group_enabled[group_id] = enabled
+        return enabled
+
     def get_user_data(self, group_id, user_id):
         """获取用户数据"""
-        group_data = self.get_group_data(group_id)
+        group_data = self.peek_group_data(group_id)
         user_id = str(user_id)
-        return group_data.get(user_id)
+        user_data = group_data.get(user_id)
+        if isinstance(user_data, dict):
+            self.journal.observe(group_id, user_id, user_data)
+            # 跨天后首次读取时重置当日连胜，显示、排行与奖励都基于当天的数据
+            if self._roll_win_streak(user_data):
+                self._mark_niuniu_dirty(group_id, user_id)
+        txn = Transaction.current(group_id)
+        if txn is not None:
+            txn.include(user_id, user_data)
+        return user_data
+
+    def sync_user(self, group_id, user_id):
+        """把用户数据更新为共享状态中的最新版本（其他进程注册的用户会加入本地群数据）"""
+        user_data = self.get_user_data(group_id, user_id)
+        synced, changed = self.state.sync(group_id, user_id, user_data)
+        if changed and isinstance(synced, dict):
+            # 其他进程写入的变化已经记录在它自己的日志中，以同步后的数据为新的基准
+            self.journal.forget(group_id, user_id)
+            self.journal.observe(group_id, user_id, synced)
+        if synced is not user_data:
+            self.get_group_data(group_id)[str(user_id)] = synced
+            self.nickname_index.add(group_id, user_id, synced.get('nickname', ''))
+        if changed:
+            self._mark_niuniu_dirty(group_id, user_id)
+        return synced
+
+    def transaction(self, group_id, *user_ids) -> Transaction:
+        """锁定若干用户并开始一组修改，见 niuniu_txn.Transaction"""
+        return Transaction(self, group_id, *user_ids)
 
     def check_cooldown(self, last_time, cooldown):
         """检查冷却时间"""
@@ -361,12 +777,7 @@ class NiuniuPlugin(Star):
         target_name = msg.split(maxsplit=1)[1] if len(msg.split()) > 1 else ""
         if target_name:
             group_id = str(event.message_obj.group_id)
-            group_data = self.get_group_data(group_id)
-            for user_id, user_data in group_data.items():
-                if isinstance(user_data, dict):  # 检查 user_data 是否为字典
-                    nickname = user_data.get('nickname', '')
-                    if re.search(re.escape(target_name), nickname, re.IGNORECASE):
-                        return user_id
+            return self.nickname_index.find(group_id, target_name)
         return None
 
     def parse_target(self, event):
@@ -379,12 +790,7 @@ class NiuniuPlugin(Star):
             target_name = msg[len("比划比划"):].strip()
             if target_name:
                 group_id = str(event.message_obj.group_id)
-                group_data = self.get_group_data(group_id)
-                for user_id, user_data in group_data.items():
-                    if isinstance(user_data, dict):  # 检查 user_data 是否为字典
-                        nickname = user_data.get('nickname', '')
-                        if re.search(re.escape(target_name), nickname, re.IGNORECASE):
-                            return user_id
+                return self.nickname_index.find(group_id, target_name)
         return None
 
     def parse_lock_target(self, event):
@@ -400,13 +806,7 @@ class NiuniuPlugin(Star):
             target_name = msg[len("锁牛牛"):].strip()
             if target_name:
                 group_id = str(event.message_obj.group_id)
-                group_data = self.get_group_data(group_id)
-                for user_id, user_data in group_data.items():
-                    if not isinstance(user_data, dict) or 'nickname' not in user_data:
-                        continue
-                    nickname = user_data.get('nickname', '')
-                    if nickname and target_name in nickname:
-                        return user_id
+                return self.nickname_index.find(group_id, target_name)
         return None
 
     # 在 NiuniuPlugin 类中添加等待消息的辅助方法
@@ -441,249 +841,33 @@ class NiuniuPlugin(Star):
     @event_message_type(EventMessageType.GROUP_MESSAGE)
     async def on_group_message(self, event: AstrMessageEvent):
         """群聊消息处理器"""
-        group_id = str(event.message_obj.group_id)
         msg = event.message_str.strip()
 
-        # Add stop work command before other commands
-        if msg == "停止打工":
-            async for result in self._stop_work(event):
-                yield result
+        route = self.router.match(msg)
+        if route is None:
             return
-
-        # 添加查看更新命令处理
-        if msg == "查看更新"or msg == "牛牛更新":
-            async for result in self._show_updates(event):
-                yield result
-            return
-
-        # 添加独立测试命令，不需要牛牛插件启用
-        if msg == "定时测试":
-            async for result in self.timer_test.test_timer(event):
-                yield result
-            return
-            
-        # 添加可以指定时间的定时测试
-        match = re.match(r'^定时测试\s+(\d+)(?:分钟)?$', msg)
-        if match:
-            minutes = int(match.group(1))
-            if 1 <= minutes <= 60:  # 限制在1-60分钟之间
-                async for result in self.timer_test.test_timer(event, minutes):
-                    yield result
-                return
-            else:
-                yield event.plain_result("⚠️ 定时测试时间需要在1-60分钟之间")
+        group_id = str(event.message_obj.group_id)
+        if not self.state.own_group(group_id):
+            # 多进程部署：该群由其他进程负责（集市、群账户、冷却等数据只在那个进程中），不处理
+            logger.debug(f"群 {group_id} 由其他进程负责，已忽略: {msg[:20]}")
+            return
+        # 刷屏保护：单个群或全部群的命令过多时直接忽略，不回复以免加剧刷屏
+        # 未启用插件的群不计数（其中的命令只会得到提示），两项都允许时才同时计数，被拒绝的命令不占用任何额度
+        if self.is_plugin_enabled(group_id):
+            if self.limiter.check('group', group_id) or self.limiter.check('global'):
+                logger.debug(f"群 {group_id} 命令过于频繁，已忽略: {msg[:20]}")
                 return
-
-        # 添加1分钟测试命令
-        if msg == "1分钟":
-            async for result in self._work_test(event):
-                yield result
-            return
-
-        # 添加牛牛集市相关命令处理 - 确保先于"购买"命令处理
-        if (msg == "牛牛集市" or msg == "查看集市" or msg == "集市列表" or 
-            msg.startswith("上架牛牛") or msg.startswith("购买牛牛") or 
-            msg.startswith("下架牛牛") or msg == "回收牛牛" or 
-            msg == "确认回收牛牛"):
-            async for result in self.market.process_market_command(event):
-                yield result
-            return
-
-        # 添加购买命令的处理 - 放在处理集市命令之后
-        if msg.startswith("购买"):
-            # 将购买命令直接传递给shop模块处理
-            async for result in self.shop.process_purchase_command(event):
-                yield result
-            return
-        
-        # 添加绝育命令处理
-        if msg.startswith("绝育"):
-            async for result in self._handle_sterilization(event):
-                yield result
-            return
-            
-        # 添加解锁命令处理
-        if msg == "解锁绝育" or msg == "解除绝育":
-            async for result in self.shop.unlock_sterilization(event):
-                yield result
-            return
-            
-        # 添加调换命令处理
-        if msg.startswith("调换"):
-            async for result in self._handle_exchange(event):
-                yield result
-            return
-            
-        # 添加寄生命令处理
-        if msg.startswith("寄生"):
-            async for result in self._handle_parasite(event):
-                yield result
-            return
-        
-        # 添加背包命令
-        if msg.startswith("牛牛背包"):
-            async for result in self.shop.show_backpack(event):
-                yield result
-            return
-
-        # 添加红包相关命令处理
-        if msg.startswith("发红包"):
-            async for result in self.redpacket.handle_send_red_packet(event):
-                yield result
-            return
-            
-        if msg == "抢红包":
-            async for result in self.redpacket.handle_grab_red_packet(event):
-                yield result
-            return
-
-        # 添加扣豆命令处理
-        if msg.startswith("扣"):
-            async for result in self._handle_kou_doudou(event):
+            self.limiter.hit('group', group_id)
+            self.limiter.hit('global')
+        handler, args = route
+        try:
+            if self.state.shared:
+                # 多进程部署：先取得其他进程写入的最新数据，本进程的修改才能按版本提交
+                self.sync_user(group_id, event.get_sender_id())
+            async for result in handler(event, *args):
                 yield result
-            return
-
-        # 处理群账户相关命令
-        if msg.startswith("群账户"):
-            user_id = str(event.get_sender_id())
-            if not self.is_admin(user_id):
-                yield event.plain_result("❌ 只有管理员才能使用群账户功能")
-                return
-                
-            if msg == "群账户":
-                # 显示群账户余额
-                balance = self.tax_system.get_treasury_balance(group_id)
-                tax_status = "✅ 已开启" if self.tax_system.is_tax_enabled(group_id) else "❌ 已关闭"
-                yield event.plain_result(f"💰 群账户余额：{balance}金币\n💹 赋税状态：{tax_status}\n\n{self.tax_system.show_treasury_menu()}")
-                
-            elif msg.startswith("群账户 发工资"):
-                try:
-                    amount = int(msg.replace("群账户 发工资", "").strip())
-                    if amount <= 0:
-                        yield event.plain_result("❌ 金额必须大于0")
-                        return
-                        
-                    success, result = self.tax_system.distribute_salary(group_id, amount)
-                    yield event.plain_result(result)
-                except ValueError:
-                    yield event.plain_result("❌ 请输入正确的金额，例如：群账户 发工资 1000")
-                    
-            elif msg.startswith("群账户 转账"):
-                # 解析目标用户和金额
-                target_id = self.parse_at_target(event)
-                if not target_id:
-                    yield event.plain_result("❌ 请指定转账目标")
-                    return
-                    
-                try:
-                    amount = int(msg.split()[-1])
-                    if amount <= 0:
-                        yield event.plain_result("❌ 金额必须大于0")
-                        return
-                        
-                    success, result = self.tax_system.transfer_to_user(group_id, target_id, amount)
-                    yield event.plain_result(result)
-                except (ValueError, IndexError):
-                    yield event.plain_result("❌ 请输入正确的金额，例如：群账户 转账 @用户 1000")
-                return
-
-        # 处理赋税开关命令
-        if msg == "开启赋税" or msg == "启用赋税":
-            user_id = str(event.get_sender_id())
-            if not self.is_admin(user_id):
-                yield event.plain_result("❌ 只有管理员才能控制赋税")
-                return
-                
-            self.tax_system.set_tax_status(group_id, True)
-            yield event.plain_result("✅ 赋税已开启！群内所有收入将按比例缴纳税款")
-            return
-                
-        if msg == "关闭赋税" or msg == "停用赋税":
-            user_id = str(event.get_sender_id())
-            if not self.is_admin(user_id):
-                yield event.plain_result("❌ 只有管理员才能控制赋税")
-                return
-                
-            self.tax_system.set_tax_status(group_id, False)
-            yield event.plain_result("✅ 赋税已关闭！群内所有收入将不再缴纳税款")
-            return
-
-        # 处理管理员直接转账命令
-        if msg.startswith("管理员转账"):
-            user_id = str(event.get_sender_id())
-            if not self.is_admin(user_id):
-                yield event.plain_result("❌ 只有管理员才能使用直接转账功能")
-                return
-                
-            # 解析消息
-            msg = event.message_str.strip()
-            if msg.startswith("管理员转账"):
-                msg = msg[len("管理员转账"):].strip()
-                
-            # 先尝试获取@的用户
-            target_id = None
-            for comp in event.message_obj.message:
-                if isinstance(comp, At):
-                    target_id = str(comp.qq)
-                    break
-                    
-            # 如果没有@，尝试从消息中解析用户名
-            if not target_id:
-                # 尝试从消息中提取用户名和金额
-                parts = msg.split()
-                if len(parts) < 2:  # 至少需要用户名和金额
-                    yield event.plain_result("❌ 请输入正确的格式，例如：管理员转账 用户名 1000")
-                    return
-                    
-            if not target_id:
-                yield event.plain_result("❌ 未找到目标用户")
-                return
-
-            # 获取@的目标用户
-            target_id = self.parse_at_target(event)
-            if not target_id:
-                yield event.plain_result("❌ 请@要转账的用户")
-                return
-                
-            # 解析金额
-            try:
-                amount = int(msg.split()[-1])
-                if amount <= 0:
-                    yield event.plain_result("❌ 金额必须大于0")
-                    return
-                    
-                async for result in self._admin_direct_transfer(event, target_id, amount):
-                    yield result
-            except (ValueError, IndexError):
-                yield event.plain_result("❌ 请输入正确的金额，例如：@用户 管理员转账 1000")
-            return
-
-        handler_map = {
-            "牛牛菜单": self._show_menu,
-            "牛牛开": lambda event: self._toggle_plugin(event, True),
-            "牛牛关": lambda event: self._toggle_plugin(event, False),
-            "注册牛牛": self._register,
-            "打胶": self._dajiao,
-            "批量打胶": self._batch_dajiao,    # 新增：批量打胶命令
-            "我的牛牛": self._show_status,
-            "比划比划": self._compare,
-            "牛牛排行": self._show_ranking,
-            "锁牛牛": self._lock_niuniu,
-            "每日签到": self._daily_sign,      
-            "牛牛商城": self._show_shop,
-            "牛牛背包": lambda event: self.shop.show_backpack(event),
-            "送金币": self._transfer_coins,  # 添加金币转赠命令
-            "打工时间": self._check_work_time,
-            "打工": self._work,
-            "牛牛日历": self._view_sign_calendar
-        }
-
-        for cmd, handler in handler_map.items():
-            if msg.startswith(cmd):
-                async for result in handler(event):
-                    yield result
-                return
-
+        except (AmbiguousNickname, StaleRecord) as e:
+            yield event.plain_result(str(e))
 
     @event_message_type(EventMessageType.PRIVATE_MESSAGE)
     async def on_private_message(self, event: AstrMessageEvent):
@@ -732,8 +916,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -802,11 +985,12 @@ class NiuniuPlugin(Star):
         total_coins = int(coins_per_hour * hours * multiplier)
         
         # 计算税收
-        after_tax, tax = self.tax_system.process_coins(group_id, total_coins)
+        after_tax, tax = self.tax_system.process_coins(group_id, total_coins, user_id, 'work')
         
         # 更新用户金币
         user_data['coins'] = user_data.get('coins', 0) + after_tax
-        self._save_niuniu_lengths()
+        self.record_change(group_id, user_id, 'work', dcoins=after_tax)
+        self._save_niuniu_lengths(group_id, user_id)
         
         # 记录打工信息到last_actions
         user_actions = self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})
@@ -829,28 +1013,9 @@ class NiuniuPlugin(Star):
         ]
         yield event.chain_result(chain)
 
-        # 创建并存储异步任务，使用与timer_test相似的方式
-        task_id = f"work_{group_id}_{user_id}_{int(time.time())}"
-        task = asyncio.create_task(self._work_timer_improved(
-            group_id=group_id,
-            user_id=user_id,
-            nickname=nickname,
-            unified_msg_origin=unified_msg_origin,
-            delay_seconds=int(hours * 3600)
-        ))
-        
-        # 存储任务引用，防止被垃圾回收
-        if not hasattr(self, '_work_tasks'):
-            self._work_tasks = {}
-        self._work_tasks[task_id] = {
-            'task': task,
-            'coins': total_coins,
-            'hours': hours,
-            'start_time': time.time()
-        }
-        
-        # 设置清理回调
-        task.add_done_callback(lambda t: self._work_tasks.pop(task_id, None))
+        # 安排打工结束提醒
+        self._schedule_work(group_id, user_id, nickname, unified_msg_origin,
+                            user_actions['work_data']['start_time'], hours, total_coins)
 
     async def _work_test(self, event):
         """打工测试功能 - 1分钟后自动完成"""
@@ -858,8 +1023,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -886,7 +1050,7 @@ class NiuniuPlugin(Star):
         
         # 更新用户金币
         user_data['coins'] = user_data.get('coins', 0) + total_coins
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, user_id)
         
         # 记录打工信息到last_actions
         user_actions = self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})
@@ -903,53 +1067,42 @@ class NiuniuPlugin(Star):
         # 发送开始打工的消息
         yield event.plain_result(f"🧪 测试模式：{nickname}开始打工测试，将在{minutes}分钟后结束。\n💰 获得{total_coins}金币\n现在金币余额：{user_data['coins']}💰")
 
-        # 创建并存储异步任务，使用与定时测试相似的方式
-        task_id = f"work_test_{group_id}_{user_id}_{int(time.time())}"
-        task = asyncio.create_task(self._work_timer_improved(
-            group_id=group_id,
-            user_id=user_id,
-            nickname=nickname,
-            unified_msg_origin=unified_msg_origin,
-            delay_seconds=int(minutes * 60)
-        ))
-        
-        # 存储任务引用，防止被垃圾回收
-        if not hasattr(self, '_work_tasks'):
-            self._work_tasks = {}
-        self._work_tasks[task_id] = task
-        
-        # 设置清理回调
-        task.add_done_callback(lambda t: self._work_tasks.pop(task_id, None))
+        # 安排打工结束提醒
+        self._schedule_work(group_id, user_id, nickname, unified_msg_origin,
+                            user_actions['work_data']['start_time'], hours, total_coins)
 
-    async def _work_timer_improved(self, group_id, user_id, nickname, unified_msg_origin, delay_seconds):
-        """改进版的打工定时器，采用与定时测试相同的实现方式"""
-        try:
-            # 等待指定时间
-            await asyncio.sleep(delay_seconds)
-            
-            # 构建消息链
-            message_chain = MessageChain([
-                At(qq=user_id),
-                Plain(f" 小南娘：{nickname}，你的工作时间结束了哦~")
-            ])
-            
-            # 直接发送消息
-            await self.context.send_message(unified_msg_origin, message_chain)
-            
-            # 记录日志
-            logger.info(f"已向用户 {user_id} 发送打工结束提醒")
-            
-            # 清理用户的打工状态
+    @staticmethod
+    def _work_job_id(group_id, user_id):
+        return f"work:{group_id}:{user_id}"
+
+    def _schedule_work(self, group_id, user_id, nickname, unified_msg_origin, start_time, hours, coins):
+        """安排打工结束的定时任务"""
+        self.scheduler.schedule(
+            self._work_job_id(group_id, user_id), start_time + hours * 3600, 'work',
+            group_id, user_id, unified_msg_origin,
+            {'nickname': nickname, 'coins': coins, 'hours': hours, 'start_time': start_time}
+        )
+
+    async def _on_work_finished(self, job):
+        """打工结束：发送提醒并清理打工状态"""
+        group_id, user_id = job.group_id, job.user_id
+        if job.origin:
             try:
-                user_actions = self.last_actions.get(group_id, {}).get(user_id, {})
-                if 'work_data' in user_actions:
-                    del user_actions['work_data']
-                    self._save_last_actions()
+                # 构建消息链
+                message_chain = MessageChain([
+                    At(qq=user_id),
+                    Plain(f" 小南娘：{job.payload.get('nickname', '用户')}，你的工作时间结束了哦~")
+                ])
+                await self.context.send_message(job.origin, message_chain)
+                logger.info(f"已向用户 {user_id} 发送打工结束提醒")
             except Exception as e:
-                logger.error(f"清理打工状态失败: {e}")
-                
-        except Exception as e:
-            logger.error(f"打工定时器执行异常: {e}")
+                logger.error(f"发送打工结束提醒失败: {e}")
+
+        # 清理用户的打工状态
+        user_actions = self.last_actions.get(group_id, {}).get(user_id, {})
+        if 'work_data' in user_actions:
+            del user_actions['work_data']
+            self._save_last_actions()
 
     async def _check_work_time(self, event):
         """查看打工时间"""
@@ -957,8 +1110,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             chain = [
                 At(qq=event.get_sender_id()),
                 Plain("\n❌ 插件未启用")
@@ -1002,17 +1154,11 @@ class NiuniuPlugin(Star):
             return
 
         # Find user's work task
-        task_id = None
-        task_info = None
-        for tid, info in self._work_tasks.items():
-            if tid.startswith(f"work_{group_id}_{user_id}_"):
-                task_id = tid
-                task_info = info
-                break
-
-        if not task_info:
+        job = self.scheduler.get(self._work_job_id(group_id, user_id))
+        if not job:
             yield event.plain_result("❌ 无法找到打工任务")
             return
+        task_info = job.payload
 
         # Calculate remaining time and coins to deduct
         elapsed_time = time.time() - task_info['start_time']
@@ -1028,18 +1174,19 @@ class NiuniuPlugin(Star):
 
         # Deduct coins and penalty
         total_deduction = coins_to_deduct + 50  # Add 50 coins penalty
+        old_coins = user_data['coins']
         user_data['coins'] = max(0, user_data['coins'] - total_deduction)
+        self.record_change(group_id, user_id, 'stop_work', dcoins=user_data['coins'] - old_coins)
         
         # Cancel the task
-        task_info['task'].cancel()
-        self._work_tasks.pop(task_id, None)
+        self.scheduler.cancel(job.job_id)
         
         # Clear work status
         user_actions = self.last_actions.get(group_id, {}).get(user_id, {})
         if 'work_data' in user_actions:
             del user_actions['work_data']
         self._save_last_actions()
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, user_id)
 
         # Send notification
         yield event.plain_result(
@@ -1050,56 +1197,57 @@ class NiuniuPlugin(Star):
     # endregion
 
     # region 核心功能
-    async def reset_win_streak_at_midnight(self):
-        """每天0点重置连胜数据并更新牛王"""
-        while True:
-            # 计算到下一个0点的时间
-            now = datetime.datetime.now()
-            next_day = now.replace(hour=0, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
-            wait_seconds = (next_day - now).total_seconds()
-            
-            # 等待到0点
-            await asyncio.sleep(wait_seconds)
-            
-            try:
-                # 重置所有群的连胜数据
-                for group_id, group_data in self.niuniu_lengths.items():
-                    if not isinstance(group_data, dict):
-                        continue
-                        
-                    # 查找当前群的牛王
-                    top_streak = 0
-                    king_id = None
-                    
-                    for user_id, user_data in group_data.items():
-                        if not isinstance(user_data, dict):
-                            continue
-                            
-                        # 更新历史最高连胜
-                        today_max = user_data.get('today_max_win_streak', 0)
-                        max_streak = user_data.get('max_win_streak', 0)
-                        user_data['max_win_streak'] = max(max_streak, today_max)
-                        
-                        # 记录当前群的最高连胜用户
-                        if today_max > top_streak:
-                            top_streak = today_max
-                            king_id = user_id
-                        
-                        # 重置当前连胜和今日最高连胜
-                        user_data['win_streak'] = 0
-                        user_data['today_max_win_streak'] = 0
-                        user_data['streak_rewards'] = []
-                    
-                    # 更新牛王
-                    if king_id:
-                        self.bull_kings[group_id] = king_id
-                        
-                # 保存数据
-                self._save_niuniu_lengths()
-                logger.info("已重置所有用户的连胜数据并更新牛王")
-                
-            except Exception as e:
-                logger.error(f"重置连胜数据失败: {e}")
+    @staticmethod
+    def _today():
+        """当天的日期序号"""
+        return datetime.date.today().toordinal()
+
+    def _roll_win_streak(self, user_data, today=None):
+        """跨天后首次访问时重置用户的当日连胜数据（由 get_user_data 在读取时调用）
+
+        Returns:
+            bool: 是否发生了重置
+        """
+        today = today or self._today()
+        day = user_data.get('streak_day')
+        if day == today:
+            return False
+        user_data['streak_day'] = today
+        if day is None:
+            # 旧数据没有日期标记，视为当天的数据
+            return False
+        user_data['max_win_streak'] = max(user_data.get('max_win_streak', 0), user_data.get('today_max_win_streak', 0))
+        user_data['win_streak'] = 0
+        user_data['today_max_win_streak'] = 0
+        user_data['streak_rewards'] = []
+        return True
+
+    def _roll_bull_king(self, group_id, today=None):
+        """跨天后前一天的连胜榜首成为牛王，返回当天的榜首记录"""
+        today = today or self._today()
+        leader = self.streak_leaders.get(group_id)
+        if leader is not None and leader.get('day') == today:
+            return leader
+        if leader is not None and leader.get('user'):
+            self.bull_kings[group_id] = leader['user']
+        leader = {'day': today, 'user': None, 'streak': 0}
+        self.streak_leaders[group_id] = leader
+        self.persistence.mark_dirty('bull_kings')
+        return leader
+
+    def get_bull_king(self, group_id):
+        """获取群的牛王"""
+        group_id = str(group_id)
+        self._roll_bull_king(group_id)
+        return self.bull_kings.get(group_id)
+
+    def _update_streak_leader(self, group_id, user_id, streak):
+        """比划获胜后更新当日连胜榜首"""
+        leader = self._roll_bull_king(group_id)
+        if streak > leader['streak']:
+            leader['user'] = user_id
+            leader['streak'] = streak
+            self.persistence.mark_dirty('bull_kings')
 
     async def _toggle_plugin(self, event, enable):
         """开关插件"""
@@ -1112,7 +1260,8 @@ class NiuniuPlugin(Star):
             return
 
         self.get_group_data(group_id)['plugin_enabled'] = enable
-        self._save_niuniu_lengths()
+        self._group_enabled[group_id] = enable
+        self._save_niuniu_lengths(group_id)
         text_key = 'enable' if enable else 'disable'
         yield event.plain_result(self.niuniu_texts['system'][text_key])
 
@@ -1122,10 +1271,10 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
+        group_data = self.get_group_data(group_id)
 
         if user_id in group_data:
             text = self.niuniu_texts['register']['already_registered'].format(nickname=nickname)
@@ -1145,7 +1294,8 @@ class NiuniuPlugin(Star):
                 'pills': False    # 是否有六味地黄丸效果
             }
         }
-        self._save_niuniu_lengths()
+        self.nickname_index.add(group_id, user_id, nickname)
+        self._save_niuniu_lengths(group_id, user_id)
 
         text = self.niuniu_texts['register']['success'].format(
             nickname=nickname,
@@ -1160,8 +1310,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -1205,7 +1354,7 @@ class NiuniuPlugin(Star):
                 # 更新最后打胶时间，但不影响冷却（伟哥特性）
                 self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})['last_viagra_use'] = current_time
                 self._save_last_actions()
-                self._save_niuniu_lengths()
+                self._save_niuniu_lengths(group_id, user_id)
                 
                 # 构建消息
                 msg_parts = [
@@ -1280,7 +1429,7 @@ class NiuniuPlugin(Star):
 
         self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})['dajiao'] = current_time
         self._save_last_actions()
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, user_id)
 
         msg_parts.append(f"当前长度：{self.format_length(user_data['length'])}")
         yield event.plain_result("\n".join(msg_parts))
@@ -1291,10 +1440,10 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
+        group_data = self.get_group_data(group_id)
 
         # 检查用户是否在打工中
         if self._is_user_working(group_id, user_id):
@@ -1329,12 +1478,7 @@ class NiuniuPlugin(Star):
             
             target_name = parts[0]
             # 在群内查找匹配的用户
-            for uid, data in group_data.items():
-                if isinstance(data, dict):  # 检查 user_data 是否为字典
-                    nickname = data.get('nickname', '')
-                    if re.search(re.escape(target_name), nickname, re.IGNORECASE):
-                        target_id = uid
-                        break
+            target_id = self.nickname_index.find(group_id, target_name)
         
         if not target_id:
             yield event.plain_result(self.niuniu_texts['transfer']['no_target'])
@@ -1376,7 +1520,9 @@ class NiuniuPlugin(Star):
         # 执行转赠
         user_data['coins'] -= amount
         target_data['coins'] = target_data.get('coins', 0) + amount
-        self._save_niuniu_lengths()
+        self.record_change(group_id, user_id, 'transfer_out', dcoins=-amount)
+        self.record_change(group_id, target_id, 'transfer_in', dcoins=amount)
+        self._save_niuniu_lengths(group_id, user_id, target_id)
 
         # 发送成功消息
         text = self.niuniu_texts['transfer']['success'].format(
@@ -1393,8 +1539,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -1431,29 +1576,24 @@ class NiuniuPlugin(Star):
         # 更新用户数据
         user_data['coins'] = user_data.get('coins', 0) + coins
         user_data['last_sign'] = current_time
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, user_id)
 
-        # 生成签到图片
+        # 生成签到图片（在渲染线程池中进行，繁忙时直接回复文字）
         try:
-            # 使用已导入的SignImageGenerator
-            sign_generator = SignImageGenerator()
-            sign_generator.save_sign_record(user_id, group_id)
-            sign_image_path = sign_generator.create_sign_image(nickname, coins, group_id)
-            
-            # 发送签到图片
-            if (os.path.exists(sign_image_path)):
-                yield event.image_result(sign_image_path)
-            else:
-                # 如果图片生成失败，发送文本消息
-                yield event.plain_result(
-                    f"✨ 签到成功！\n"
-                    f"📏 当前牛牛长度：{self.format_length(length)}\n"
-                    f"🪙 获得金币：{coins}\n"
-                    f"💰 当前金币：{user_data['coins']}"
-                )
+            SignImageGenerator().save_sign_record(user_id, group_id)
+            sign_image_path = await self.sign_renderer.render_sign(nickname, coins, group_id, user_id)
         except Exception as e:
             print(f"生成签到图片失败: {str(e)}")
-            # 发送文本消息作为备用
+            sign_image_path = None
+
+        if sign_image_path and os.path.exists(sign_image_path):
+            try:
+                yield event.image_result(sign_image_path)
+            finally:
+                # 签到图片只发送一次，发送后删除
+                SignImageGenerator.remove_image(sign_image_path)
+        else:
+            # 如果图片生成失败，发送文本消息
             yield event.plain_result(
                 f"✨ 签到成功！\n"
                 f"📏 当前牛牛长度：{self.format_length(length)}\n"
@@ -1467,8 +1607,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -1498,8 +1637,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -1531,7 +1669,8 @@ class NiuniuPlugin(Star):
             return
 
         # 冷却检查
-        compare_records = self.last_compare_time.setdefault(group_id, {}).setdefault(user_id, {})
+        user_actions = self.cooldowns.user(group_id, user_id)
+        compare_records = user_actions.setdefault('compare_records', {})
         last_compare = compare_records.get(target_id, 0)
         on_cooldown, remaining = self.check_cooldown(last_compare, self.COMPARE_COOLDOWN)
         if on_cooldown:
@@ -1543,25 +1682,16 @@ class NiuniuPlugin(Star):
             yield event.plain_result(text)
             return
 
-        # 检查3分钟内比划次数
-        compare_records = self.last_compare_time.setdefault(group_id, {}).setdefault(user_id, {})
-        last_compare_time = compare_records.get('last_time', 0)
+        # 检查比划次数（默认3分钟内三次）
         current_time = time.time()
-
-        # 如果超过3分钟，重置计数
-        if current_time - last_compare_time > 180:
-            compare_records['count'] = 0
-            compare_records['last_time'] = current_time  # 更新最后比划时间
-
-        compare_count = compare_records.get('count', 0)
-
-        if compare_count >= 3:
-            yield event.plain_result("❌ 3分钟内只能比划三次")
+        wait = self.limiter.hit('比划', group_id, user_id, now=current_time)
+        if wait:
+            yield event.plain_result(f"❌ 比划太频繁了，请{int(wait) + 1}秒后再来")
             return
 
-        # 更新冷却时间和比划次数
+        # 更新冷却时间
         compare_records[target_id] = current_time
-        compare_records['count'] = compare_count + 1
+        self._save_last_actions()
 
         # 添加变性状态检查
         if self.shop.is_gender_surgery_active(group_id, user_id):
@@ -1574,6 +1704,17 @@ class NiuniuPlugin(Star):
             yield event.plain_result(f"❌ {target_data['nickname']}正在变性状态下，变成妹子了不能比划哦~\n剩余时间: {surgery_time}")
             return
 
+        # 锁定双方后结算，结算中途出错时双方数据都保持原样
+        async with self.transaction(group_id, user_id, target_id):
+            result_msg = self._settle_compare(group_id, user_id, target_id, nickname)
+
+        yield event.plain_result("\n".join(result_msg))
+
+    def _settle_compare(self, group_id, user_id, target_id, nickname):
+        """结算一次比划，返回结果消息各行（需在事务内调用）"""
+        user_data = self.get_user_data(group_id, user_id)
+        target_data = self.get_user_data(group_id, target_id)
+
         # 计算胜负
         u_len = user_data['length']
         t_len = target_data['length']
@@ -1624,8 +1765,6 @@ class NiuniuPlugin(Star):
             if random.random() < 0.3:
                 target_data['hardness'] = max(1, target_data['hardness'] - 1)
                 
-            self._save_niuniu_lengths()
-            
             # 生成结果消息
             result_msg = [
                 "⚔️ 【牛牛对决结果】 ⚔️",
@@ -1633,9 +1772,8 @@ class NiuniuPlugin(Star):
                 f"🛡️ {target_data['nickname']}: {self.format_length(old_t_len)} > {self.format_length(target_data['length'])}",
                 f"📢 {text}"
             ]
-            
-            yield event.plain_result("\n".join(result_msg))
-            return
+            self.record_change(group_id, target_id, 'compare_loss', dlen=target_data['length'] - old_t_len)
+            return result_msg
 
         # 原有的比划逻辑
         # 记录比划前的长度
@@ -1643,7 +1781,8 @@ class NiuniuPlugin(Star):
         old_t_len = target_data['length']
 
         # 执行判定
-        if random.random() < win_prob:
+        won = random.random() < win_prob
+        if won:
             gain = random.randint(0, 3)
             loss = random.randint(1, 2)
             actual_gain, stolen_gain, parasite_info = self._handle_length_increase(group_id, user_id, gain)
@@ -1668,12 +1807,14 @@ class NiuniuPlugin(Star):
             user_data['win_streak'] = user_data.get('win_streak', 0) + 1
             user_data['today_max_win_streak'] = max(user_data.get('today_max_win_streak', 0), user_data['win_streak'])
             user_data['max_win_streak'] = max(user_data.get('max_win_streak', 0), user_data['win_streak'])
+            self._update_streak_leader(group_id, user_id, user_data['today_max_win_streak'])
             
             # 随机奖励金币
             coins_reward = random.randint(10, 20)
             # 计算税收
-            after_tax, tax = self.tax_system.process_coins(group_id, coins_reward)
+            after_tax, tax = self.tax_system.process_coins(group_id, coins_reward, user_id, 'compare_win')
             user_data['coins'] = user_data.get('coins', 0) + after_tax
+            self.record_change(group_id, user_id, 'compare_win', dcoins=after_tax)
             
             # 检查连胜奖励
             _, reward_message = self.check_win_streak_rewards(group_id, user_id, user_data)
@@ -1708,17 +1849,16 @@ class NiuniuPlugin(Star):
         if random.random() < 0.3:
             target_data['hardness'] = max(1, target_data['hardness'] - 1)
 
-        self._save_niuniu_lengths()
-
         # 生成结果消息
         current_streak = user_data.get('win_streak', 0)
         max_streak = user_data.get('max_win_streak', 0)
-        is_king = self.bull_kings.get(group_id) == user_id
+        bull_king = self.get_bull_king(group_id)
+        is_king = bull_king == user_id
     
         result_msg = [
             "⚔️ 【牛牛对决结果】 ⚔️",
             f"🗡️ {nickname}{' 👑牛王' if is_king else ''}: {self.format_length(old_u_len)} > {self.format_length(user_data['length'])}",
-            f"🛡️ {target_data['nickname']}{' 👑牛王' if self.bull_kings.get(group_id) == target_id else ''}: {self.format_length(old_t_len)} > {self.format_length(target_data['length'])}",
+            f"🛡️ {target_data['nickname']}{' 👑牛王' if bull_king == target_id else ''}: {self.format_length(old_t_len)} > {self.format_length(target_data['length'])}",
             f"📢 {text}",
             f"🔄 连胜: {current_streak}次 | 最高: {max_streak}次"
         ]
@@ -1742,9 +1882,11 @@ class NiuniuPlugin(Star):
             target_data['length'] = max(1, target_data['length'] // 2)
             special_event_triggered = True
 
-        self._save_niuniu_lengths()
-
-        yield event.plain_result("\n".join(result_msg))
+        if won:
+            self.record_change(group_id, target_id, 'compare_loss', dlen=target_data['length'] - old_t_len)
+        else:
+            self.record_change(group_id, user_id, 'compare_loss', dlen=user_data['length'] - old_u_len)
+        return result_msg
 
     async def _show_status(self, event):
         """查看牛牛状态"""
@@ -1752,8 +1894,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -1813,28 +1954,19 @@ class NiuniuPlugin(Star):
     async def _show_ranking(self, event):
         """显示排行榜"""
         group_id = str(event.message_obj.group_id)
-        group_data = self.get_group_data(group_id)
-
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
-        # 过滤有效用户数据
-        valid_users = [
-            (uid, data) for uid, data in group_data.items()
-            if isinstance(data, dict) and 'length' in data
-        ]
-
-        if not valid_users:
+        # 从排行索引中取前10
+        top_users = self.leaderboard.top(group_id, 10)
+        if not top_users:
             yield event.plain_result(self.niuniu_texts['ranking']['no_data'])
             return
 
-        # 排序并取前10
-        sorted_users = sorted(valid_users, key=lambda x: x[1]['length'], reverse=True)[:10]
-
         # 构建排行榜
         ranking = [self.niuniu_texts['ranking']['header']]
-        for idx, (uid, data) in enumerate(sorted_users, 1):
+        for idx, uid, data in top_users:
             ranking.append(
                 self.niuniu_texts['ranking']['item'].format(
                     rank=idx,
@@ -1843,8 +1975,79 @@ class NiuniuPlugin(Star):
                 )
             )
 
+        # 附上自己的排名
+        user_id = str(event.get_sender_id())
+        rank, total = self.leaderboard.rank(group_id, user_id)
+        if rank is not None and rank > len(top_users):
+            ranking.append(f"\n📍 你的排名：第{rank}名（共{total}人）")
+
         yield event.plain_result("\n".join(ranking))
 
+    async def _show_my_rank(self, event):
+        """显示自己的排名及前后的用户"""
+        group_id = str(event.message_obj.group_id)
+        user_id = str(event.get_sender_id())
+        nickname = event.get_sender_name()
+        if not self.is_plugin_enabled(group_id):
+            yield event.plain_result("❌ 插件未启用")
+            return
+
+        nearby = self.leaderboard.around(group_id, user_id, 2)
+        if not nearby:
+            yield event.plain_result(self.niuniu_texts['my_niuniu']['not_registered'].format(nickname=nickname))
+            return
+
+        _, total = self.leaderboard.rank(group_id, user_id)
+        lines = [f"📍 {nickname} 的排名（共{total}人）："]
+        for idx, uid, data in nearby:
+            marker = "👉 " if uid == user_id else ""
+            lines.append(f"{marker}{idx}. {data['nickname']} ➜ {self.format_length(data['length'])}")
+        yield event.plain_result("\n".join(lines))
+
+    async def _show_global_ranking(self, event):
+        """显示全服长度前20名"""
+        group_id = str(event.message_obj.group_id)
+        if not self.is_plugin_enabled(group_id):
+            yield event.plain_result("❌ 插件未启用")
+            return
+
+        self.global_ranking.apply(self.peek_group_data)
+        top_users = self.global_ranking.top(20)
+        if not top_users:
+            yield event.plain_result(self.niuniu_texts['ranking']['no_data'])
+            return
+
+        lines = [f"🌏 全服牛牛排行榜 TOP{len(top_users)}（共{len(self.global_ranking)}人）：\n"]
+        for idx, _, _, record in top_users:
+            lines.append(f"{idx}. {record[3]} ➜ {self.format_length(record[0])}")
+        yield event.plain_result("\n".join(lines))
+
+    async def _show_global_percentile(self, event):
+        """显示自己在全服的百分位"""
+        group_id = str(event.message_obj.group_id)
+        user_id = str(event.get_sender_id())
+        nickname = event.get_sender_name()
+        if not self.is_plugin_enabled(group_id):
+            yield event.plain_result("❌ 插件未启用")
+            return
+
+        self.global_ranking.apply(self.peek_group_data)
+        percentiles = self.global_ranking.percentile(group_id, user_id)
+        if percentiles is None:
+            yield event.plain_result(self.niuniu_texts['my_niuniu']['not_registered'].format(nickname=nickname))
+            return
+
+        user_data = self.get_user_data(group_id, user_id)
+        labels = (
+            ('length', '📏 长度', self.format_length(user_data['length'])),
+            ('coins', '💰 金币', user_data.get('coins', 0)),
+            ('max_win_streak', '🔥 最高连胜', user_data.get('max_win_streak', 0)),
+        )
+        lines = [f"🌏 {nickname} 的全服排名（共{len(self.global_ranking)}人）："]
+        for metric, label, value in labels:
+            lines.append(f"{label}：{value}，位于全服前{max(percentiles[metric], 0.1):.1f}%")
+        yield event.plain_result("\n".join(lines))
+
     async def _show_menu(self, event):
         """显示菜单"""
         menu_text = self.niuniu_texts['menu']['default']
@@ -1856,8 +2059,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -1910,19 +2112,14 @@ class NiuniuPlugin(Star):
                 yield event.plain_result(text)
                 return
 
-        # 清理5分钟前的记录
-        lock_records = {k: v for k, v in lock_records.items() 
-                       if current_time - v < 300}  # 300秒 = 5分钟
-        
-        # 检查5分钟内锁定的不同用户数量
-        recent_locks = len(lock_records)
-        if recent_locks >= 3:  # 修改这里：移除了 "or target_id not in lock_records"
-            yield event.plain_result("❌ 5分钟内只能锁3个不同用户的牛牛")
+        # 检查锁定的不同用户数量（默认5分钟内3个，同一目标在冷却内不会重复计入）
+        wait = self.limiter.hit('锁牛牛', group_id, user_id, now=current_time)
+        if wait:
+            yield event.plain_result(f"❌ 锁的人太多了，请{int(wait) + 1}秒后再来")
             return
 
-        # 更新锁定记录
+        # 更新锁定记录（过期记录由冷却数据的定期清理删除）
         lock_records[target_id] = current_time
-        user_actions['lock_records'] = lock_records
         self._save_last_actions()
 
         # 随机效果判定
@@ -1958,7 +2155,7 @@ class NiuniuPlugin(Star):
                 target_nickname=target_data['nickname']
             )
 
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, target_id)
 
         # 生成结果消息
         result_msg = [
@@ -1976,8 +2173,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -2028,7 +2224,7 @@ class NiuniuPlugin(Star):
             self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})['last_viagra_use'] = current_time
 
         self._save_last_actions()
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, user_id)
 
         # 汇总消息
         msg_lines = [
@@ -2050,8 +2246,7 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -2061,18 +2256,15 @@ class NiuniuPlugin(Star):
             return
 
         try:
-            # 创建签到图片生成器
-            sign_generator = SignImageGenerator()
-            # 获取用户的签到记录
-            sign_records = sign_generator.load_sign_records(user_id, group_id)
-            # 生成签到图片
-            sign_image_path = sign_generator.create_calendar_image(nickname, user_id, group_id)
-            
-            # 发送签到图片
-            if os.path.exists(sign_image_path):
+            # 在渲染线程池中生成签到日历
+            sign_image_path = await self.sign_renderer.render_calendar(nickname, user_id, group_id)
+            if sign_image_path and os.path.exists(sign_image_path):
                 yield event.image_result(sign_image_path)
-            else:
-                yield event.plain_result(f"❌ {nickname}，生成签到日历失败了")
+                return
+            # 渲染繁忙或失败时回复文字版日历
+            sign_records = sorted(SignImageGenerator().load_sign_records(user_id, group_id))
+            days = '、'.join(str(day) for day in sign_records) or '无'
+            yield event.plain_result(f"📅 {nickname} 本月签到{len(sign_records)}次\n签到日期：{days}")
         except Exception as e:
             print(f"生成签到日历失败: {str(e)}")
             yield event.plain_result(f"❌ {nickname}，生成签到日历失败了")
@@ -2125,13 +2317,7 @@ class NiuniuPlugin(Star):
                 target_name = msg[3:].strip()
                 if target_name:
                     # 在群数据中查找匹配用户名的用户
-                    group_data = self.get_group_data(group_id)
-                    for uid, udata in group_data.items():
-                        if not isinstance(udata, dict):
-                            continue
-                        if udata.get('nickname', '') and target_name in udata.get('nickname', ''):
-                            target_id = uid
-                            break
+                    target_id = self.nickname_index.find(group_id, target_name)
         
         if not target_id:
             yield event.plain_result("❌ 请指定要锁牛牛的用户")
@@ -2148,12 +2334,11 @@ class NiuniuPlugin(Star):
             yield event.plain_result("❌ 不能锁自己的牛牛")
             return
             
-        # 检查冷却时间
+        # 检查冷却时间（锁定成功后才开始计算）
         current_time = time.time()
-        last_lock = self.last_actions.get(group_id, {}).get(user_id, {}).get('lock', 0)
-        if current_time - last_lock < self.LOCK_COOLDOWN:
-            remaining = int(self.LOCK_COOLDOWN - (current_time - last_lock))
-            yield event.plain_result(f"❌ 锁牛牛冷却中，还需等待{remaining}秒")
+        wait = self.limiter.check('锁牛牛冷却', group_id, user_id, now=current_time)
+        if wait:
+            yield event.plain_result(f"❌ 锁牛牛冷却中，还需等待{int(wait)}秒")
             return
             
         # 检查目标是否被锁
@@ -2167,12 +2352,11 @@ class NiuniuPlugin(Star):
         target_data['locked_until'] = current_time + lock_time
         target_data['locked_by'] = user_id
         
-        # 记录使用时间
-        self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})['lock'] = current_time
-        
         # 保存数据
-        self._save_niuniu_lengths()
-        self._save_last_actions()
+        self._save_niuniu_lengths(group_id, target_id)
+        
+        # 记录使用时间
+        self.limiter.hit('锁牛牛冷却', group_id, user_id, now=current_time)
         
         result = (
             f"🔒 {nickname} 成功锁住了 {target_data['nickname']} 的牛牛！\n"
@@ -2211,10 +2395,10 @@ class NiuniuPlugin(Star):
         user_id = str(event.get_sender_id())
         nickname = event.get_sender_name()
 
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
+        group_data = self.get_group_data(group_id)
 
         # 检查用户是否在打工中
         if self._is_user_working(group_id, user_id):
@@ -2249,12 +2433,7 @@ class NiuniuPlugin(Star):
             
             target_name = parts[0]
             # 在群内查找匹配的用户
-            for uid, data in group_data.items():
-                if isinstance(data, dict):  # 检查 user_data 是否为字典
-                    nickname = data.get('nickname', '')
-                    if re.search(re.escape(target_name), nickname, re.IGNORECASE):
-                        target_id = uid
-                        break
+            target_id = self.nickname_index.find(group_id, target_name)
         
         if not target_id:
             yield event.plain_result(self.niuniu_texts['transfer']['no_target'])
@@ -2296,7 +2475,9 @@ class NiuniuPlugin(Star):
         # 执行转赠
         user_data['coins'] -= amount
         target_data['coins'] = target_data.get('coins', 0) + amount
-        self._save_niuniu_lengths()
+        self.record_change(group_id, user_id, 'transfer_out', dcoins=-amount)
+        self.record_change(group_id, target_id, 'transfer_in', dcoins=amount)
+        self._save_niuniu_lengths(group_id, user_id, target_id)
 
         # 发送成功消息
         text = self.niuniu_texts['transfer']['success'].format(
@@ -2314,10 +2495,10 @@ class NiuniuPlugin(Star):
         nickname = event.get_sender_name()
 
         # 检查插件是否启用
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
+        group_data = self.get_group_data(group_id)
 
         # 检查用户是否注册
         user_data = self.get_user_data(group_id, user_id)
@@ -2348,12 +2529,8 @@ class NiuniuPlugin(Star):
             if msg.startswith("绝育"):
                 target_name = msg[2:].strip()
                 if target_name:
-                    # 在群数据中查找匹配用户名的用户
-                    for uid, data in group_data.items():
-                        if isinstance(data, dict) or 'nickname' in data:
-                            if target_name in data['nickname']:
-                                target_id = uid
-                                break
+                    # 在群数据中查找匹配的用户
+                    target_id = self.nickname_index.find(group_id, target_name)
 
         if not target_id:
             yield event.plain_result("❌ 请指定要绝育的目标用户")
@@ -2374,10 +2551,10 @@ class NiuniuPlugin(Star):
         nickname = event.get_sender_name()
 
         # 检查插件是否启用
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
+        group_data = self.get_group_data(group_id)
 
         # 检查用户是否注册
         user_data = self.get_user_data(group_id, user_id)
@@ -2404,11 +2581,7 @@ class NiuniuPlugin(Star):
                 target_name = msg[len("扣"):].strip()
                 if target_name:
                     # 在群数据中查找匹配的用户
-                    for uid, data in group_data.items():
-                        if isinstance(data, dict) or 'nickname' in data:
-                            if target_name in data['nickname']:
-                                target_id = uid
-                                break
+                    target_id = self.nickname_index.find(group_id, target_name)
 
         if not target_id:
             yield event.plain_result("❌ 请指定要扣豆的目标用户")
@@ -2438,9 +2611,10 @@ class NiuniuPlugin(Star):
         for streak, coins in rewards.items():
             if win_streak >= streak and streak not in streak_rewards:
                 # 计算税收
-                after_tax, tax = self.tax_system.process_coins(group_id, coins)
+                after_tax, tax = self.tax_system.process_coins(group_id, coins, user_id, 'win_streak')
                 # 发放奖励
                 user_data['coins'] = user_data.get('coins', 0) + after_tax
+                self.record_change(group_id, user_id, 'win_streak_reward', dcoins=after_tax)
                 streak_rewards.append(streak)
                 reward_coins += after_tax
                 reward_message = f"\n🎖️ 连胜{streak}次！奖励{after_tax}金币（缴纳税款：{tax}金币）！"
@@ -2505,6 +2679,142 @@ class NiuniuPlugin(Star):
             
         yield event.plain_result(result)
 
+    def _register_commands(self):
+        """注册主模块的命令（商城、集市、红包、税收等模块在各自初始化时注册）"""
+        router = self.router
+        router.add('停止打工', self._stop_work, exact=True)
+        router.add(('查看更新', '牛牛更新'), self._show_updates, exact=True)
+        router.add('牛牛渲染状态', self._show_render_stats, exact=True)
+        router.add('牛牛命令统计', self._show_command_stats, exact=True)
+        router.add('牛牛数据转换', self._convert_data_format)
+        router.add('1分钟', self._work_test, exact=True)
+        router.add('绝育', self._handle_sterilization)
+        router.add('调换', self._handle_exchange)
+        router.add('寄生', self._handle_parasite)
+        router.add('扣', self._handle_kou_doudou)
+        router.add('管理员转账', self._handle_admin_transfer)
+        router.add('牛牛菜单', self._show_menu)
+        router.add('牛牛开', lambda event: self._toggle_plugin(event, True))
+        router.add('牛牛关', lambda event: self._toggle_plugin(event, False))
+        router.add('注册牛牛', self._register)
+        router.add('打胶', self._dajiao)
+        router.add('批量打胶', self._batch_dajiao)
+        router.add('我的牛牛', self._show_status)
+        router.add('比划比划', self._compare)
+        router.add('牛牛排行', self._show_ranking)
+        router.add('我的排名', self._show_my_rank, exact=True)
+        router.add('全服排行', self._show_global_ranking, exact=True)
+        router.add('全服排名', self._show_global_percentile, exact=True)
+        router.add('锁牛牛', self._lock_niuniu)
+        router.add('每日签到', self._daily_sign)
+        router.add('牛牛商城', self._show_shop)
+        router.add('送金币', self._transfer_coins)
+        router.add('打工时间', self._check_work_time)
+        router.add('打工', self._work)
+        router.add('牛牛日历', self._view_sign_calendar)
+
+    async def _handle_admin_transfer(self, event):
+        """管理员直接转账"""
+        user_id = str(event.get_sender_id())
+        if not self.is_admin(user_id):
+            yield event.plain_result("❌ 只有管理员才能使用直接转账功能")
+            return
+            
+        # 解析消息
+        msg = event.message_str.strip()
+        if msg.startswith("管理员转账"):
+            msg = msg[len("管理员转账"):].strip()
+            
+        # 先尝试获取@的用户
+        target_id = None
+        for comp in event.message_obj.message:
+            if isinstance(comp, At):
+                target_id = str(comp.qq)
+                break
+                
+        # 如果没有@，尝试从消息中解析用户名
+        if not target_id:
+            # 尝试从消息中提取用户名和金额
+            parts = msg.split()
+            if len(parts) < 2:  # 至少需要用户名和金额
+                yield event.plain_result("❌ 请输入正确的格式，例如：管理员转账 用户名 1000")
+                return
+                
+        if not target_id:
+            yield event.plain_result("❌ 未找到目标用户")
+            return
+
+        # 获取@的目标用户
+        target_id = self.parse_at_target(event)
+        if not target_id:
+            yield event.plain_result("❌ 请@要转账的用户")
+            return
+            
+        # 解析金额
+        try:
+            amount = int(msg.split()[-1])
+            if amount <= 0:
+                yield event.plain_result("❌ 金额必须大于0")
+                return
+                
+            async for result in self._admin_direct_transfer(event, target_id, amount):
+                yield result
+        except (ValueError, IndexError):
+            yield event.plain_result("❌ 请输入正确的金额，例如：@用户 管理员转账 1000")
+
+    async def _show_command_stats(self, event):
+        """查看各命令的命中次数"""
+        if not self.is_admin(str(event.get_sender_id())):
+            yield event.plain_result("❌ 只有管理员才能查看命令统计")
+            return
+        stats = [(name, count) for name, count in self.router.stats().items() if count]
+        if not stats:
+            yield event.plain_result("📊 暂无命令调用记录")
+            return
+        lines = [f"{name}：{count}次" for name, count in stats]
+        yield event.plain_result("📊 命令调用统计\n" + "\n".join(lines))
+
+    async def _show_render_stats(self, event):
+        """查看签到图片渲染队列与耗时"""
+        if not self.is_admin(str(event.get_sender_id())):
+            yield event.plain_result("❌ 只有管理员才能查看渲染状态")
+            return
+        stats = self.sign_renderer.stats()
+        yield event.plain_result(
+            f"🖼️ 签到图片渲染状态\n"
+            f"排队中：{stats['pending']}/{stats['max_pending']}\n"
+            f"已完成：{stats['rendered']}  已拒绝：{stats['rejected']}  失败：{stats['failed']}\n"
+            f"日历缓存命中：{stats['cache_hits']}\n"
+            f"耗时：平均{stats['avg_latency'] * 1000:.0f}ms / 最近{stats['last_latency'] * 1000:.0f}ms / "
+            f"最大{stats['max_latency'] * 1000:.0f}ms"
+        )
+
+    async def _convert_data_format(self, event):
+        """把所有数据文件转换为指定格式"""
+        user_id = str(event.get_sender_id())
+        if not self.is_admin(user_id):
+            yield event.plain_result("❌ 只有管理员才能转换数据格式")
+            return
+
+        fmt = event.message_str.strip()[len("牛牛数据转换"):].strip().lower()
+        formats = available_formats()
+        if fmt not in formats:
+            yield event.plain_result(f"❌ 请指定目标格式：牛牛数据转换 [{'/'.join(formats)}]\n当前格式：{self.codec.format}")
+            return
+
+        self.codec.set_format(fmt)
+        for name in ('niuniu_lengths', 'last_actions', 'tax', 'market'):
+            self.persistence.mark_dirty(name)
+        await self.persistence.flush()
+
+        text = f"✅ 数据文件已转换为 {fmt} 格式"
+        if not self.storage.file_based:
+            text += "\n💾 牛牛数据使用SQLite存储，不受影响"
+        elif isinstance(self.niuniu_lengths, ShardedGroups):
+            text += "\n📂 牛牛数据为分片存储，未加载的群将在下次保存时转换"
+        text += "\n⚠️ 请同步修改配置中的 storage_config.data_format，否则重启后将以原格式写入"
+        yield event.plain_result(text)
+
     def _handle_length_increase(self, group_id, user_id, increase_amount):
         """处理牛牛长度增加，考虑寄生虫效果"""
         user_data = self.get_user_data(group_id, user_id)
@@ -2515,6 +2825,7 @@ class NiuniuPlugin(Star):
         is_parasited, parasite_owner = self.shop.is_parasited(group_id, user_id)
         if not is_parasited:
             user_data['length'] += increase_amount
+            self.record_change(group_id, user_id, 'length_increase', dlen=increase_amount)
             return increase_amount, None, None
             
         # 计算被窃取的长度（向上取整）
@@ -2523,12 +2834,15 @@ class NiuniuPlugin(Star):
         
         # 更新被寄生者的长度
         user_data['length'] += actual_increase
+        self.record_change(group_id, user_id, 'length_increase', dlen=actual_increase)
         
         # 更新寄生虫主人的长度
         parasite_owner_data = self.get_user_data(group_id, parasite_owner)
         if parasite_owner_data:
             parasite_owner_data['length'] += stolen_amount
+            self.record_change(group_id, parasite_owner, 'parasite', dlen=stolen_amount)
             parasite_owner_name = parasite_owner_data['nickname']
+            self._save_niuniu_lengths(group_id, parasite_owner)
         else:
             parasite_owner_name = "未知用户"
             
@@ -2547,10 +2861,10 @@ class NiuniuPlugin(Star):
         nickname = event.get_sender_name()
 
         # 检查插件是否启用
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
+        group_data = self.get_group_data(group_id)
 
         # 检查用户是否注册
         user_data = self.get_user_data(group_id, user_id)
@@ -2576,11 +2890,8 @@ class NiuniuPlugin(Star):
             if msg.startswith("寄生"):
                 target_name = msg[2:].strip()
                 if target_name:
-                    for uid, data in group_data.items():
-                        if isinstance(data, dict) and 'nickname' in data:
-                            if target_name in data['nickname']:
-                                target_id = uid
-                                break
+                    # 在群数据中查找匹配的用户
+                    target_id = self.nickname_index.find(group_id, target_name)
 
         if not target_id:
             yield event.plain_result("❌ 请指定要寄生的目标用户")
@@ -2607,8 +2918,7 @@ class NiuniuPlugin(Star):
         nickname = event.get_sender_name()
         
         # 检查插件是否启用
-        group_data = self.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
             
@@ -2623,9 +2933,10 @@ class NiuniuPlugin(Star):
         
         # 直接增加目标用户金币
         target_data['coins'] = target_data.get('coins', 0) + amount
+        self.record_change(group_id, target_id, 'admin_transfer', dcoins=amount)
         
         # 保存数据
-        self._save_niuniu_lengths()
+        self._save_niuniu_lengths(group_id, target_id)
         
         # 发送成功消息
         result = (
@@ -2636,3 +2947,15 @@ class NiuniuPlugin(Star):
         )
         yield event.plain_result(result)
 
+    async def terminate(self):
+        """插件卸载时强制落盘所有数据并释放存储资源"""
+        self.scheduler.shutdown()
+        self.tax_system.flush_ledger()
+        self._save_global_ranking()
+        await self.persistence.shutdown()
+        self.job_store.close()
+        self.state.close()
+        self.journal.close()
+        self.tax_system.ledger.close()
+        self.storage.close()
+        self.sign_renderer.shutdown()
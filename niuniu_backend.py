@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+
+
+class StaleRecord(Exception):
+    """提交时用户数据已被其他进程修改"""
+
+    def __init__(self, group_id, user_ids):
+        self.group_id = str(group_id)
+        self.user_ids = sorted(user_ids)
+        super().__init__("⚠️ 数据已被其他操作修改，请重试")
+
+
+class StateBackend:
+    """多个bot进程共享的状态
+
+    - 用户记录：按 (群ID, 用户ID) 保存，每次写入版本号加一。
+      事务开始时读取最新版本（sync），提交时比较版本（commit），
+      期间被其他进程修改过则抛出 StaleRecord，本次修改整体撤销（乐观并发）。
+      不在事务中的修改同样按版本提交，不会覆盖其他进程已写入的新版本。
+    - 定时任务：同一任务的同一次到期只能被一个进程领取（claim），
+      各进程加载相同的任务时也只会执行一次。
+    - 群归属：每个群由第一个处理它的进程负责（own_group），之后一直由该进程处理。
+      集市、群账户、冷却、牛王等按进程保存的数据因此只存在于一个进程中，不会出现多个互相分叉的副本。
+
+    子类实现 _load/_store/_claim/_claim_group 四个基本操作。
+    """
+
+    shared = False
+
+    def __init__(self, worker_id: Optional[str] = None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        # 本进程已同步的版本 {(group_id, user_id): 版本号}
+        self._seen: Dict[Tuple[str, str], int] = {}
+        # 已查询过的群归属 {group_id: 进程标识}，归属确定后不再变化
+        self._owners: Dict[str, str] = {}
+
+    def _load(self, group_id: str, user_id: str) -> Tuple[int, Optional[dict]]:
+        """读取用户记录，返回 (版本号, 数据)，不存在时版本号为0"""
+        raise NotImplementedError
+
+    def _store(self, group_id: str, records: Dict[str, Tuple[Optional[int], dict]]) -> Dict[str, int]:
+        """原子地写入一组用户记录
+
+        Args:
+            records: {user_id: (期望的当前版本号，None表示不检查, 数据)}
+
+        Returns:
+            {user_id: 新版本号}
+
+        Raises:
+            StaleRecord: 有记录的当前版本号与期望不符（此时不写入任何记录）
+        """
+        raise NotImplementedError
+
+    def _claim(self, job_id: str, due: float) -> bool:
+        """领取一次任务执行"""
+        raise NotImplementedError
+
+    def _claim_group(self, group_id: str) -> str:
+        """群还没有归属时登记为本进程，返回负责该群的进程标识"""
+        raise NotImplementedError
+
+    def sync(self, group_id, user_id, user_data: Optional[dict]) -> Tuple[Optional[dict], bool]:
+        """把本地用户数据更新为共享存储中的最新版本
+
+        Returns:
+            (更新后的用户数据, 是否有更新)；本地不存在而共享存储中存在时返回新的字典，需由调用方放入群数据
+        """
+        key = (str(group_id), str(user_id))
+        version, data = self._load(*key)
+        if version <= self._seen.get(key, 0) or data is None:
+            return user_data, False
+        self._seen[key] = version
+        if user_data is None:
+            return data, True
+        user_data.clear()
+        user_data.update(data)
+        return user_data, True
+
+    def commit(self, group_id, users: Dict[str, dict]):
+        """按已同步的版本提交一组用户数据，期间有其他进程写入时抛出 StaleRecord"""
+        group_id = str(group_id)
+        records = {str(uid): (self._seen.get((group_id, str(uid)), 0), data) for uid, data in users.items()}
+        self._remember(group_id, self._store(group_id, records))
+
+    def _remember(self, group_id: str, versions: Dict[str, int]):
+        for user_id, version in versions.items():
+            self._seen[(group_id, user_id)] = version
+
+    def claim(self, job) -> bool:
+        """领取定时任务的本次执行，返回False表示已由其他进程执行"""
+        return self._claim(job.job_id, job.due)
+
+    def own_group(self, group_id) -> bool:
+        """本进程是否负责该群（群没有归属时由本进程领取）"""
+        if not self.shared:
+            return True
+        group_id = str(group_id)
+        owner = self._owners.get(group_id)
+        if owner is None:
+            owner = self._owners[group_id] = self._claim_group(group_id)
+        return owner == self.worker_id
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """单进程默认实现
+
+    本进程内存中的数据就是全部数据，只维护版本号，不保存数据副本；
+    任务总能领取成功。
+    """
+
+    def __init__(self, worker_id: Optional[str] = None):
+        super().__init__(worker_id)
+        self._versions: Dict[Tuple[str, str], int] = {}
+
+    def _load(self, group_id, user_id):
+        return self._versions.get((group_id, user_id), 0), None
+
+    def _store(self, group_id, records):
+        stale = [uid for uid, (expected, _) in records.items()
+                 if expected is not None and self._versions.get((group_id, uid), 0) != expected]
+        if stale:
+            raise StaleRecord(group_id, stale)
+        versions = {}
+        for user_id in records:
+            key = (group_id, user_id)
+            versions[user_id] = self._versions[key] = self._versions.get(key, 0) + 1
+        return versions
+
+    def _claim(self, job_id, due):
+        return True
+
+    def _claim_group(self, group_id):
+        return self.worker_id
+
+
+class SQLiteBackend(StateBackend):
+    """基于SQLite的共享实现，供同一台机器上的多个进程使用
+
+    写入在 BEGIN IMMEDIATE 事务中完成，由SQLite的文件锁保证多个进程的写入依次进行；
+    任务领取记录以 (任务ID, 到期时间) 为主键，只有第一个插入成功的进程执行该任务；
+    群归属同样以群ID为主键，第一个插入成功的进程负责该群。
+    需要把群交给其他进程时，先停止原进程，再删除 owners 表中的对应记录。
+    """
+
+    shared = True
+    # 领取记录保留时间（秒），过期后定期清理
+    CLAIM_RETENTION = 86400
+
+    def __init__(self, path: str, worker_id: Optional[str] = None):
+        super().__init__(worker_id)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS records ('
+            'group_id TEXT NOT NULL, user_id TEXT NOT NULL, version INTEGER NOT NULL, data TEXT NOT NULL, '
+            'PRIMARY KEY (group_id, user_id))'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS claims ('
+            'job_id TEXT NOT NULL, due REAL NOT NULL, worker TEXT NOT NULL, claimed_at REAL NOT NULL, '
+            'PRIMARY KEY (job_id, due))'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS owners ('
+            'group_id TEXT PRIMARY KEY, worker TEXT NOT NULL, claimed_at REAL NOT NULL)'
+        )
+        self._claims = 0
+
+    def _load(self, group_id, user_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT version, data FROM records WHERE group_id = ? AND user_id = ?', (group_id, user_id)
+            ).fetchone()
+        if row is None:
+            return 0, None
+        return row[0], json.loads(row[1])
+
+    def _store(self, group_id, records):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                current = {}
+                for user_id in records:
+                    row = self._conn.execute(
+                        'SELECT version FROM records WHERE group_id = ? AND user_id = ?', (group_id, user_id)
+                    ).fetchone()
+                    current[user_id] = row[0] if row else 0
+                stale = [uid for uid, (expected, _) in records.items()
+                         if expected is not None and current[uid] != expected]
+                if stale:
+                    raise StaleRecord(group_id, stale)
+                versions = {uid: current[uid] + 1 for uid in records}
+                self._conn.executemany(
+                    'INSERT OR REPLACE INTO records (group_id, user_id, version, data) VALUES (?, ?, ?, ?)',
+                    [(group_id, uid, versions[uid], json.dumps(data, ensure_ascii=False))
+                     for uid, (_, data) in records.items()]
+                )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return versions
+
+    def _claim(self, job_id, due):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO claims (job_id, due, worker, claimed_at) VALUES (?, ?, ?, ?)',
+                (job_id, due, self.worker_id, now)
+            )
+            claimed = cursor.rowcount == 1
+            self._claims += 1
+            if self._claims % 1000 == 0:
+                self._conn.execute('DELETE FROM claims WHERE claimed_at < ?', (now - self.CLAIM_RETENTION,))
+        return claimed
+
+    def _claim_group(self, group_id):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO owners (group_id, worker, claimed_at) VALUES (?, ?, ?)',
+                (group_id, self.worker_id, time.time())
+            )
+            row = self._conn.execute('SELECT worker FROM owners WHERE group_id = ?', (group_id,)).fetchone()
+        return row[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_state_backend(kind: str, path: str, worker_id: Optional[str] = None) -> StateBackend:
+    """根据配置创建共享状态后端
+
+    Args:
+        kind: 'memory'（默认，单进程）或 'sqlite'（同机多进程共享）
+        path: SQLite数据库路径
+        worker_id: 进程标识，默认为 主机名:进程号
+    """
+    if kind == 'sqlite':
+        return SQLiteBackend(path, worker_id)
+    return MemoryBackend(worker_id)
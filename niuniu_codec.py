@@ -0,0 +1,147 @@
+import os
+import json
+import yaml
+from typing import Callable, Optional
+from astrbot.api import logger
+from niuniu_fileio import atomic_write, load_with_fallback, CorruptedDataError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 优先使用 libyaml 的C实现
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+FORMAT_EXTENSIONS = {
+    'yaml': '.yml',
+    'json': '.json',
+    'msgpack': '.msgpack',
+}
+EXTENSION_FORMATS = {
+    '.yml': 'yaml',
+    '.yaml': 'yaml',
+    '.json': 'json',
+    '.msgpack': 'msgpack',
+}
+
+
+def available_formats() -> list:
+    """当前环境可用的数据格式"""
+    formats = ['yaml', 'json']
+    if msgpack is not None:
+        formats.append('msgpack')
+    return formats
+
+
+def detect_format(path: str, raw: bytes = b'') -> str:
+    """根据扩展名判断格式，扩展名未知时根据文件头判断"""
+    fmt = EXTENSION_FORMATS.get(os.path.splitext(path)[1].lower())
+    if fmt:
+        return fmt
+    head = raw.lstrip()[:1]
+    if head in (b'{', b'['):
+        return 'json'
+    if raw[:1] and (0x80 <= raw[0] <= 0x8f or raw[0] in (0xde, 0xdf)):
+        return 'msgpack'
+    return 'yaml'
+
+
+def encode(data, fmt: str) -> bytes:
+    """把数据编码为指定格式"""
+    if fmt == 'json':
+        if orjson is not None:
+            return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError("未安装msgpack，无法使用msgpack格式")
+        return msgpack.packb(data, use_bin_type=True)
+    return yaml.dump(data, Dumper=YamlDumper, allow_unicode=True).encode('utf-8')
+
+
+def decode(raw: bytes, fmt: str):
+    """按指定格式解码数据"""
+    if fmt == 'json':
+        if orjson is not None:
+            return orjson.loads(raw)
+        return json.loads(raw.decode('utf-8'))
+    if fmt == 'msgpack':
+        if msgpack is None:
+            raise RuntimeError("未安装msgpack，无法读取msgpack格式")
+        return msgpack.unpackb(raw, raw=False, strict_map_key=False)
+    return yaml.load(raw, Loader=YamlLoader)
+
+
+class DataCodec:
+    """数据文件编解码器
+
+    各数据文件以不带扩展名的基础路径标识，实际文件名由当前格式决定。
+    读取时会在所有格式的文件中选择最新的一个，因此切换格式后旧文件仍可透明读取。
+    """
+
+    def __init__(self, fmt: str = 'json'):
+        self.format = 'yaml'
+        self.set_format(fmt)
+
+    def set_format(self, fmt: str) -> bool:
+        """切换写入格式，格式不可用时保持原格式"""
+        if fmt not in available_formats():
+            logger.warning(f"数据格式 {fmt} 不可用，继续使用 {self.format}")
+            return False
+        self.format = fmt
+        return True
+
+    def path(self, base_path: str, fmt: Optional[str] = None) -> str:
+        """获取基础路径在指定格式下的文件名"""
+        return base_path + FORMAT_EXTENSIONS[fmt or self.format]
+
+    def _candidates(self, base_path: str) -> list:
+        """所有格式中已存在的文件（含历史版本），按修改时间从新到旧排序"""
+        found = []
+        for ext in EXTENSION_FORMATS:
+            path = base_path + ext
+            stamps = [os.path.getmtime(p) for p in (path, f"{path}.1") if os.path.exists(p)]
+            if stamps:
+                found.append((max(stamps), path))
+        found.sort(reverse=True)
+        return [path for _, path in found]
+
+    def load(self, base_path: str, validate: Optional[Callable[[object], bool]] = None):
+        """读取数据文件，自动识别格式并在损坏时回退到历史版本
+
+        最新格式的文件及其历史版本都已损坏时，继续尝试较旧格式的文件（如切换格式前的YAML）。
+
+        Returns:
+            解析后的数据；任何格式的文件都不存在时返回None
+
+        Raises:
+            CorruptedDataError: 所有格式的文件及历史版本都已损坏
+        """
+        error = None
+        for path in self._candidates(base_path):
+            fmt = EXTENSION_FORMATS[os.path.splitext(path)[1]]
+            try:
+                data = load_with_fallback(path, lambda raw: decode(raw, fmt), validate)
+            except CorruptedDataError as e:
+                logger.error(f"{str(e)}，尝试其他格式的文件")
+                error = e
+                continue
+            if error is not None:
+                logger.warning(f"{base_path} 已回退到 {path}")
+            return data
+        if error is not None:
+            raise error
+        return None
+
+    def write(self, base_path: str, data, fmt: Optional[str] = None):
+        """以当前格式原子写入数据文件"""
+        fmt = fmt or self.format
+        # 文本YAML被截断后仍可能解析成功，需要校验行；JSON/msgpack截断后无法解析
+        atomic_write(self.path(base_path, fmt), encode(data, fmt), checksum=(fmt == 'yaml'))
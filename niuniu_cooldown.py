@@ -0,0 +1,143 @@
+import copy
+import time
+from typing import Callable, Dict, Optional
+
+# 字段值不再需要时返回False的判断函数：(group_id, user_id) -> 是否保留
+KeepPredicate = Callable[[str, str], bool]
+
+
+class _Rule:
+    __slots__ = ('ttl', 'nested', 'keep', 'compact')
+
+    def __init__(self, ttl: Optional[float], nested: bool, keep: Optional[KeepPredicate], compact: bool):
+        self.ttl = ttl
+        self.nested = nested
+        self.keep = keep
+        self.compact = compact
+
+
+def _timestamp(value) -> Optional[float]:
+    """记录中的时间戳：数字本身，或列表（如限流计数）中最近的时间戳"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, (list, tuple)):
+        stamps = [v for v in value if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        return max(stamps) if stamps else None
+    return None
+
+
+def _compact(value):
+    """把时间戳取整到秒（只用于登记了有效期的字段）"""
+    if isinstance(value, float):
+        return int(value)
+    if isinstance(value, list):
+        return [_compact(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _compact(v) for k, v in value.items()}
+    return value
+
+
+class CooldownStore:
+    """冷却与频率记录 {群ID: {用户ID: {字段: 值}}}
+
+    字段值为时间戳、包含时间戳的列表（如限流计数，以其中最近的时间戳为准），或 {目标ID: 时间戳} 形式的嵌套记录。
+    每个字段可以登记：
+    - 有效期：时间戳超过有效期后记录不再影响冷却判断，清理时删除
+    - 保留条件：条件不成立时删除（如购买道具后等待使用的标记，道具用掉后删除）
+    未登记的字段原样保留。清理后为空的用户与群一并删除，文件大小只与近期活跃的用户数有关。
+
+    冷却判断仍是普通的字典查找；清理在后台定期进行，保存时登记了有效期的字段取整到秒，
+    其余字段（如打工时长）以及登记时声明不取整的字段（如令牌桶中的剩余令牌数）原样保存。
+    """
+
+    def __init__(self, data: Optional[dict] = None):
+        self.data: Dict[str, Dict[str, dict]] = data if isinstance(data, dict) else {}
+        self._rules: Dict[str, _Rule] = {}
+
+    def expire(self, field: str, ttl: Optional[float] = None, nested: bool = False,
+               keep: Optional[KeepPredicate] = None, compact: bool = True):
+        """登记字段的清理规则
+
+        Args:
+            field: 字段名
+            ttl: 有效期（秒），为None表示不按时间清理
+            nested: 字段值是否为 {目标ID: 时间戳}，是则逐个目标按有效期清理
+            keep: 保留条件
+            compact: 保存时是否把数值取整到秒，字段中含有非时间戳的小数时应为False
+        """
+        self._rules[field] = _Rule(ttl, nested, keep, compact)
+
+    def user(self, group_id, user_id) -> dict:
+        """用户的记录（不存在时创建）"""
+        return self.data.setdefault(str(group_id), {}).setdefault(str(user_id), {})
+
+    def peek(self, group_id, user_id) -> dict:
+        """只读获取用户的记录，不存在时返回空字典"""
+        return self.data.get(str(group_id), {}).get(str(user_id), {})
+
+    def vacuum(self, now: Optional[float] = None) -> int:
+        """删除过期和不再需要的记录，返回删除的字段数"""
+        now = time.time() if now is None else now
+        removed = 0
+        for group_id in list(self.data):
+            users = self.data[group_id]
+            if not isinstance(users, dict):
+                continue
+            for user_id in list(users):
+                actions = users[user_id]
+                if isinstance(actions, dict):
+                    removed += self._vacuum_user(group_id, user_id, actions, now)
+                if not actions:
+                    del users[user_id]
+            if not users:
+                del self.data[group_id]
+        return removed
+
+    def _vacuum_user(self, group_id: str, user_id: str, actions: dict, now: float) -> int:
+        removed = 0
+        for field in list(actions):
+            rule = self._rules.get(field)
+            if rule is None:
+                continue
+            value = actions[field]
+            if rule.keep is not None and not rule.keep(group_id, user_id):
+                expired = True
+            elif rule.ttl is None:
+                expired = False
+            elif rule.nested and isinstance(value, dict):
+                for key in [k for k, v in value.items() if (_timestamp(v) or 0) + rule.ttl <= now]:
+                    del value[key]
+                expired = not value
+            else:
+                stamp = _timestamp(value)
+                expired = stamp is not None and stamp + rule.ttl <= now
+            if expired:
+                del actions[field]
+                removed += 1
+        return removed
+
+    def snapshot(self) -> dict:
+        """生成用于保存的副本（登记了有效期的时间戳取整到秒）"""
+        result = {}
+        for group_id, users in self.data.items():
+            if not isinstance(users, dict):
+                result[group_id] = copy.deepcopy(users)
+                continue
+            result[group_id] = {
+                user_id: self._snapshot_user(actions) if isinstance(actions, dict) else copy.deepcopy(actions)
+                for user_id, actions in users.items()
+            }
+        return result
+
+    def _snapshot_user(self, actions: dict) -> dict:
+        result = {}
+        for field, value in actions.items():
+            rule = self._rules.get(field)
+            if rule is not None and rule.ttl is not None and rule.compact:
+                result[field] = _compact(value)
+            else:
+                result[field] = copy.deepcopy(value)
+        return result
+
+    def __len__(self):
+        return sum(len(users) for users in self.data.values() if isinstance(users, dict))
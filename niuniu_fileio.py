@@ -0,0 +1,129 @@
+import os
+import zlib
+from typing import Callable, Optional, Tuple
+from astrbot.api import logger
+
+# 保留的历史版本数量：xxx.yml.1 为最近一次，数字越大越旧
+BACKUP_GENERATIONS = 3
+CHECKSUM_PREFIX = b'# niuniu-crc32: '
+
+
+class CorruptedDataError(Exception):
+    """数据文件及其所有历史版本都已损坏"""
+    pass
+
+
+def _backup_path(path: str, generation: int) -> str:
+    return f"{path}.{generation}"
+
+
+def _fsync_dir(path: str):
+    """同步目录项，保证rename落盘（Windows不支持时忽略）"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _with_checksum(content: bytes) -> bytes:
+    """在文本末尾追加校验行（YAML注释，不影响原插件读取）"""
+    if not content.endswith(b'\n'):
+        content += b'\n'
+    return content + CHECKSUM_PREFIX + b'%08x\n' % zlib.crc32(content)
+
+
+def verify_checksum(raw: bytes) -> Tuple[bool, bytes]:
+    """校验文件末尾的校验行
+
+    Returns:
+        Tuple[bool, bytes]: (是否完整, 去掉校验行后的内容)；没有校验行的旧文件视为完整
+    """
+    body, sep, tail = raw.rstrip(b'\n').rpartition(b'\n')
+    if not tail.startswith(CHECKSUM_PREFIX):
+        return True, raw
+    body += sep
+    try:
+        expected = int(tail[len(CHECKSUM_PREFIX):].strip(), 16)
+    except ValueError:
+        return False, body
+    return zlib.crc32(body) == expected, body
+
+
+def atomic_write(path: str, content, generations: int = BACKUP_GENERATIONS, checksum: bool = True):
+    """原子写入文件：写临时文件 -> fsync -> 轮换历史版本 -> rename
+
+    Args:
+        path: 目标文件路径
+        content: 文件内容（str 或 bytes）
+        generations: 保留的历史版本数量
+        checksum: 是否在末尾追加校验行，仅适用于文本格式
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if checksum:
+        content = _with_checksum(content)
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if generations > 0 and os.path.exists(path):
+        for generation in range(generations, 1, -1):
+            older = _backup_path(path, generation - 1)
+            if os.path.exists(older):
+                os.replace(older, _backup_path(path, generation))
+        os.replace(path, _backup_path(path, 1))
+    os.replace(tmp_path, path)
+    _fsync_dir(path)
+
+
+def load_with_fallback(path: str, parse: Callable[[bytes], object],
+                       validate: Optional[Callable[[object], bool]] = None,
+                       generations: int = BACKUP_GENERATIONS):
+    """读取数据文件，损坏时依次回退到最新的有效历史版本
+
+    Args:
+        path: 数据文件路径
+        parse: 把文件内容解析为数据的函数
+        validate: 额外的结构校验，返回False视为损坏
+        generations: 最多回退的历史版本数量
+
+    Returns:
+        解析后的数据；文件及历史版本都不存在时返回None
+
+    Raises:
+        CorruptedDataError: 存在数据文件但所有版本都无法通过校验
+    """
+    candidates = [path] + [_backup_path(path, g) for g in range(1, generations + 1)]
+    found = False
+    for candidate in candidates:
+        if not os.path.exists(candidate):
+            continue
+        found = True
+        try:
+            with open(candidate, 'rb') as f:
+                raw = f.read()
+            intact, body = verify_checksum(raw)
+            if not intact:
+                raise ValueError("校验和不匹配，文件可能被截断")
+            data = parse(body)
+            if validate is not None and not validate(data):
+                raise ValueError("数据结构无效")
+        except Exception as e:
+            logger.error(f"数据文件 {candidate} 已损坏: {str(e)}")
+            continue
+        if candidate != path:
+            logger.warning(f"{path} 不可用，已回退到历史版本 {candidate}")
+        return data
+    if found:
+        raise CorruptedDataError(f"{path} 及其历史版本均已损坏")
+    return None
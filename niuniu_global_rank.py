@@ -0,0 +1,163 @@
+import math
+import heapq
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 参与全服统计的字段
+METRICS = ('length', 'coins', 'max_win_streak')
+
+
+class LogHistogram:
+    """对数分桶的计数直方图（分位数估计）
+
+    每个2倍区间分为 BUCKETS_PER_OCTAVE 个桶，相对误差约为 2^(1/4)-1≈19%。
+    与 t-digest/KLL 等流式摘要不同，计数直方图支持删除，用户数值变化时可以先减后加；
+    桶的数量固定，查询分位数的开销与用户数无关。
+    """
+
+    BUCKETS_PER_OCTAVE = 4
+    MAX_OCTAVES = 40
+
+    def __init__(self):
+        self.counts = [0] * (self.BUCKETS_PER_OCTAVE * self.MAX_OCTAVES + 1)
+        self.total = 0
+
+    def _bucket(self, value) -> int:
+        if value <= 0:
+            return 0
+        index = 1 + int(math.log2(value + 1) * self.BUCKETS_PER_OCTAVE)
+        return min(index, len(self.counts) - 1)
+
+    def add(self, value, count: int = 1):
+        self.counts[self._bucket(value)] += count
+        self.total += count
+
+    def remove(self, value):
+        self.add(value, -1)
+
+    def fraction_above(self, value) -> float:
+        """估计数值严格大于value的比例（同桶的用户按一半计）"""
+        if self.total <= 0:
+            return 0.0
+        bucket = self._bucket(value)
+        above = sum(self.counts[bucket + 1:]) + self.counts[bucket] / 2
+        return max(0.0, min(1.0, above / self.total))
+
+
+class GlobalRanking:
+    """跨群的全服排行统计
+
+    - 每个字段一个对数直方图，用于回答“位于全服前百分之几”
+    - 长度维护一个精确的前K名候选列表，用户数值变化时增量调整，只有列表不足K名时才全量重建
+
+    数据变化通过 touch 记录，在查询或保存前统一应用，同一用户的多次修改只处理一次。
+    """
+
+    def __init__(self, top_k: int = 20):
+        self.top_k = top_k
+        self._capacity = top_k * 3
+        # {(group_id, user_id): (length, coins, max_win_streak, nickname)}
+        self.values: Dict[Tuple[str, str], tuple] = {}
+        self.histograms = {metric: LogHistogram() for metric in METRICS}
+        # 前K名候选：按 (-长度, group_id, user_id) 排序，始终是全服精确的前 len(_top) 名
+        self._top: List[tuple] = []
+        self._pending = set()
+
+    @staticmethod
+    def _record(user_data: dict) -> Optional[tuple]:
+        if not isinstance(user_data, dict) or 'length' not in user_data:
+            return None
+        return (user_data['length'], user_data.get('coins', 0),
+                user_data.get('max_win_streak', 0), user_data.get('nickname', ''))
+
+    def load(self, records: Dict[str, Dict[str, list]]):
+        """从保存的数据恢复 {group_id: {user_id: [长度, 金币, 最高连胜, 昵称]}}"""
+        for group_id, users in (records or {}).items():
+            for user_id, record in users.items():
+                self._set((str(group_id), str(user_id)), tuple(record))
+        self._rebuild_top()
+
+    def dump(self) -> Dict[str, Dict[str, list]]:
+        """导出当前数据"""
+        records = {}
+        for (group_id, user_id), record in self.values.items():
+            records.setdefault(group_id, {})[user_id] = list(record)
+        return records
+
+    def add_group(self, group_id, group_data: dict):
+        """统计一个群的所有用户（用于首次建立）"""
+        for user_id, user_data in group_data.items():
+            record = self._record(user_data)
+            if record is not None:
+                self._set((str(group_id), str(user_id)), record)
+
+    def touch(self, group_id, user_ids: Iterable):
+        """记录数据发生变化的用户"""
+        group_id = str(group_id)
+        self._pending.update((group_id, str(uid)) for uid in user_ids if uid is not None)
+
+    @property
+    def has_pending(self) -> bool:
+        return bool(self._pending)
+
+    def apply(self, loader):
+        """应用所有待处理的变化
+
+        Args:
+            loader: 根据群ID返回群数据（只读）
+        """
+        pending, self._pending = self._pending, set()
+        for key in pending:
+            record = self._record(loader(key[0]).get(key[1]))
+            if record != self.values.get(key):
+                self._set(key, record)
+        if len(self._top) < self.top_k and len(self.values) > len(self._top):
+            self._rebuild_top()
+
+    def _set(self, key, record):
+        old = self.values.pop(key, None)
+        if old is not None:
+            for metric, value in zip(METRICS, old):
+                self.histograms[metric].remove(value)
+            self._remove_top(key, old[0])
+        if record is not None:
+            self.values[key] = record
+            for metric, value in zip(METRICS, record):
+                self.histograms[metric].add(value)
+            self._offer_top(key, record[0])
+
+    def _remove_top(self, key, length):
+        entry = (-length,) + key
+        index = bisect_left(self._top, entry)
+        if index < len(self._top) and self._top[index] == entry:
+            del self._top[index]
+
+    def _offer_top(self, key, length):
+        entry = (-length,) + key
+        # 列表包含全部用户时直接加入；否则只有比列表中最后一名更好才加入
+        if len(self._top) >= len(self.values) - 1 or (self._top and entry < self._top[-1]):
+            insort(self._top, entry)
+            if len(self._top) > self._capacity:
+                self._top.pop()
+
+    def _rebuild_top(self):
+        self._top = heapq.nsmallest(
+            self._capacity, ((-record[0],) + key for key, record in self.values.items())
+        )
+
+    def top(self, k: Optional[int] = None) -> List[Tuple[int, str, str, tuple]]:
+        """全服长度前k名，返回 [(排名, group_id, user_id, 记录)]"""
+        k = min(k or self.top_k, self.top_k)
+        return [(rank, group_id, user_id, self.values[(group_id, user_id)])
+                for rank, (_, group_id, user_id) in enumerate(self._top[:k], 1)]
+
+    def percentile(self, group_id, user_id) -> Optional[Dict[str, float]]:
+        """用户各字段位于全服前百分之几（0-100），未注册时返回None"""
+        record = self.values.get((str(group_id), str(user_id)))
+        if record is None:
+            return None
+        return {metric: self.histograms[metric].fraction_above(value) * 100
+                for metric, value in zip(METRICS, record)}
+
+    def __len__(self):
+        return len(self.values)
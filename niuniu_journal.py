@@ -0,0 +1,340 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from typing import Iterator, Optional
+from astrbot.api import logger
+from niuniu_fileio import atomic_write
+
+
+class EventJournal:
+    """金币/长度变动的追加式日志（WAL）
+
+    每次变动追加一行JSON记录：
+        {"seq": 序号, "ts": 时间, "group": 群, "user": 用户, "dlen": 长度变化, "dcoins": 金币变化,
+         "reason": 原因, "length": 变化后长度, "coins": 变化后金币}
+    追加只写入内存缓冲区，由后台按时间窗口批量写入并fsync。
+
+    牛牛数据落盘后调用 checkpoint 记录已包含在快照中的最大序号，
+    启动时只需重放序号更大的记录；记录中带有变化后的绝对值，重复重放不会重复累加。
+    compact 会丢弃已包含在快照中的记录。
+
+    日志同时记住每个用户最近一次记录的绝对值：保存用户数据时 append_changed
+    为没有通过 append 记录过的变化补一条记录，保证所有变动都能重放。
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 1.0):
+        """初始化日志
+
+        Args:
+            path: 日志文件路径，检查点保存在同目录的 <path>.checkpoint
+            fsync_interval: 批量写入的时间窗口（秒）
+        """
+        self.path = path
+        self.checkpoint_path = f"{path}.checkpoint"
+        self.fsync_interval = fsync_interval
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_handle = None
+        # (群, 用户) -> 最近一次记录（或首次读取）时的 (长度, 金币)
+        self._last = {}
+        self.checkpoint_seq = self._load_checkpoint()
+        self.seq = max(self.checkpoint_seq, self._last_seq())
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = open(path, 'ab')
+
+    def _load_checkpoint(self) -> int:
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logger.error(f"读取日志检查点失败: {str(e)}")
+            return 0
+
+    def _last_seq(self) -> int:
+        last = 0
+        for record in self.records():
+            last = max(last, record['seq'])
+        return last
+
+    def records(self, since: int = 0) -> Iterator[dict]:
+        """按顺序读取序号大于since的记录，末尾写了一半的记录会被忽略"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get('seq', 0) > since:
+                    yield record
+
+    def append(self, group_id, user_id, dlen: int = 0, dcoins: int = 0, reason: str = '',
+               user_data: Optional[dict] = None) -> int:
+        """追加一条变动记录
+
+        Args:
+            group_id: 群ID
+            user_id: 用户ID
+            dlen: 长度变化
+            dcoins: 金币变化
+            reason: 变动原因
+            user_data: 变化后的用户数据，用于记录绝对值
+
+        Returns:
+            int: 记录序号
+        """
+        self.seq += 1
+        record = {
+            'seq': self.seq,
+            'ts': int(time.time()),
+            'group': str(group_id),
+            'user': str(user_id),
+            'dlen': dlen,
+            'dcoins': dcoins,
+            'reason': reason,
+        }
+        if user_data is not None:
+            record['length'] = user_data.get('length')
+            record['coins'] = user_data.get('coins', 0)
+            self._last[(record['group'], record['user'])] = (record['length'], record['coins'])
+        self._push(record)
+        return self.seq
+
+    def observe(self, group_id, user_id, user_data: dict):
+        """记住用户首次读取时的长度和金币，作为之后计算变化量的基准"""
+        self._last.setdefault((str(group_id), str(user_id)),
+                              (user_data.get('length'), user_data.get('coins', 0)))
+
+    def append_changed(self, group_id, user_id, reason: str, user_data: dict) -> Optional[int]:
+        """用户的长度或金币与最近一次记录不同时追加一条记录
+
+        已经通过 append 记录过的变化不会重复记录；没有基准值时变化量记为0，
+        重放只依赖记录中的绝对值。
+
+        Returns:
+            Optional[int]: 记录序号，没有变化时为None
+        """
+        key = (str(group_id), str(user_id))
+        length, coins = user_data.get('length'), user_data.get('coins', 0)
+        last = self._last.get(key)
+        if last == (length, coins):
+            return None
+        dlen = dcoins = 0
+        if last is not None:
+            try:
+                dlen, dcoins = length - last[0], coins - last[1]
+            except TypeError:
+                pass
+        return self.append(group_id, user_id, dlen, dcoins, reason, user_data)
+
+    def forget(self, group_id, user_id=None):
+        """丢弃群（或单个用户）的基准值，用于淘汰内存数据或与其他进程同步之后"""
+        group_id = str(group_id)
+        if user_id is not None:
+            self._last.pop((group_id, str(user_id)), None)
+            return
+        for key in [key for key in self._last if key[0] == group_id]:
+            del self._last[key]
+
+    def _push(self, record: dict):
+        """把记录放入缓冲区，等待批量写入"""
+        self._buffer.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.sync()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.fsync_interval, self._start_sync)
+
+    def _start_sync(self):
+        self._flush_handle = None
+        lines, self._buffer = self._buffer, []
+        if lines:
+            asyncio.get_running_loop().run_in_executor(None, self._write_lines, lines)
+
+    def _write_lines(self, lines: list):
+        with self._lock:
+            try:
+                self._file.write(''.join(lines).encode('utf-8'))
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except Exception as e:
+                logger.error(f"写入变动日志失败: {str(e)}")
+
+    def sync(self):
+        """同步写入缓冲区中的所有记录"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        lines, self._buffer = self._buffer, []
+        if lines:
+            self._write_lines(lines)
+
+    def checkpoint(self, seq: int):
+        """记录序号不大于seq的变动都已包含在牛牛数据快照中（可在线程池中执行）"""
+        if seq <= self.checkpoint_seq:
+            return
+        atomic_write(self.checkpoint_path, str(seq), generations=0, checksum=False)
+        self.checkpoint_seq = seq
+
+    def replay(self, data: dict) -> set:
+        """把检查点之后的记录重放到牛牛数据中
+
+        Returns:
+            set: 被修改的 (group_id, user_id)
+        """
+        changed = set()
+        # 各批次在线程池中写入，文件中的顺序不一定严格递增
+        for record in sorted(self.records(self.checkpoint_seq), key=lambda r: r['seq']):
+            if record.get('length') is None:
+                continue
+            group_data = data.get(record['group'])
+            user_data = group_data.get(record['user']) if isinstance(group_data, dict) else None
+            if not isinstance(user_data, dict):
+                continue
+            user_data['length'] = record['length']
+            user_data['coins'] = record['coins']
+            changed.add((record['group'], record['user']))
+        if changed:
+            logger.info(f"已从变动日志恢复 {len(changed)} 个用户的数据")
+        return changed
+
+    def compact(self) -> int:
+        """丢弃已包含在快照中的记录（可在线程池中执行）
+
+        Returns:
+            int: 丢弃的记录数
+        """
+        with self._lock:
+            kept, dropped = [], []
+            for record in self.records():
+                if record['seq'] > self.checkpoint_seq:
+                    kept.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+                else:
+                    dropped.append(record)
+            if not dropped:
+                return 0
+            self._archive(dropped)
+            self._file.close()
+            try:
+                atomic_write(self.path, ''.join(kept), generations=0, checksum=False)
+            finally:
+                self._file = open(self.path, 'ab')
+            return len(dropped)
+
+    def _archive(self, records: list):
+        """压缩前处理将被丢弃的记录（默认直接丢弃）"""
+        pass
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            self._file.close()
+
+
+class TaxLedger(EventJournal):
+    """群账户收支的追加式明细
+
+    每笔税收或群账户支出追加一行JSON记录：
+        {"seq": 序号, "ts": 时间, "group": 群, "source": 来源, "payer": 缴税用户,
+         "amount": 税前金额, "rate": 税率, "delta": 群账户变化, "balance": 变化后余额}
+    写入方式与检查点与 EventJournal 相同；群账户余额保存后调用 checkpoint，
+    启动时用检查点之后记录中的余额恢复。
+    压缩时已保存的记录不会删除，而是按月追加到归档文件 <文件名>.<年月>.jsonl，
+    主文件只保留尚未保存的记录，归档文件作为完整的收支明细长期保存。
+    """
+
+    def archive_path(self, month: str) -> str:
+        """某月（YYYYMM）的归档文件路径"""
+        root, ext = os.path.splitext(self.path)
+        return f"{root}.{month}{ext}"
+
+    def _archive(self, records: list):
+        # 先写入归档再改写主文件；两步之间意外退出时归档中可能出现重复的序号，读取时按序号去重
+        by_month = {}
+        for record in records:
+            month = time.strftime('%Y%m', time.localtime(record.get('ts', 0)))
+            by_month.setdefault(month, []).append(
+                json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+        for month, lines in by_month.items():
+            with open(self.archive_path(month), 'ab') as f:
+                f.write(''.join(lines).encode('utf-8'))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def history(self, since: float) -> Iterator[dict]:
+        """读取时间不早于since的全部记录（含归档），按序号排序并去重"""
+        records = {}
+        start, end = time.localtime(since), time.localtime()
+        for index in range(start.tm_year * 12 + start.tm_mon - 1, end.tm_year * 12 + end.tm_mon):
+            path = self.archive_path(f"{index // 12:04d}{index % 12 + 1:02d}")
+            if not os.path.exists(path):
+                continue
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('ts', 0) >= since:
+                        records[record['seq']] = record
+        for record in self.records():
+            if record.get('ts', 0) >= since:
+                records[record['seq']] = record
+        for seq in sorted(records):
+            yield records[seq]
+
+    def entry(self, group_id, source: str, delta: int, balance: int, payer=None,
+              amount: int = 0, rate: float = 0.0) -> int:
+        """追加一笔收支记录
+
+        Args:
+            group_id: 群ID
+            source: 来源（如 compare_win、market_sell、salary）
+            delta: 群账户变化，支出为负数
+            balance: 变化后的群账户余额
+            payer: 缴税用户
+            amount: 税前金额
+            rate: 适用税率
+
+        Returns:
+            int: 记录序号
+        """
+        self.seq += 1
+        self._push({
+            'seq': self.seq,
+            'ts': int(time.time()),
+            'group': str(group_id),
+            'source': source,
+            'payer': None if payer is None else str(payer),
+            'amount': amount,
+            'rate': rate,
+            'delta': delta,
+            'balance': balance,
+        })
+        return self.seq
+
+    def replay(self, balances: dict) -> set:
+        """把检查点之后的记录重放到群账户余额 {group_id: 余额} 中
+
+        Returns:
+            set: 被修改的群ID
+        """
+        changed = set()
+        for record in sorted(self.records(self.checkpoint_seq), key=lambda r: r['seq']):
+            if 'balance' not in record:
+                continue
+            balances[record['group']] = record['balance']
+            changed.add(record['group'])
+        if changed:
+            logger.info(f"已从群账户明细恢复 {len(changed)} 个群的余额")
+        return changed
@@ -0,0 +1,131 @@
+from bisect import bisect_left, insort
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+
+class GroupLeaderboard:
+    """单个群按长度排序的索引
+
+    有序列表中保存 (-长度, user_id)，排名即元素下标：
+    前K名直接切片 O(K)，查询某人排名为一次二分查找 O(log n)。
+    """
+
+    __slots__ = ('keys', 'positions', 'pending')
+
+    def __init__(self, group_data: dict):
+        self.keys: List[Tuple] = []
+        self.positions: Dict[str, Tuple] = {}
+        self.pending = set()
+        for user_id, user_data in group_data.items():
+            key = self._key(user_id, user_data)
+            if key is not None:
+                self.keys.append(key)
+                self.positions[key[1]] = key
+        self.keys.sort()
+
+    @staticmethod
+    def _key(user_id, user_data) -> Optional[Tuple]:
+        if isinstance(user_data, dict) and 'length' in user_data:
+            return -user_data['length'], str(user_id)
+        return None
+
+    def refresh(self, group_data: dict):
+        """重新放置长度发生变化的用户"""
+        for user_id in self.pending:
+            key = self._key(user_id, group_data.get(user_id))
+            old = self.positions.get(user_id)
+            if old == key:
+                continue
+            if old is not None:
+                index = bisect_left(self.keys, old)
+                if index < len(self.keys) and self.keys[index] == old:
+                    del self.keys[index]
+                del self.positions[user_id]
+            if key is not None:
+                insort(self.keys, key)
+                self.positions[user_id] = key
+        self.pending.clear()
+
+    def top(self, k: int) -> List[str]:
+        return [user_id for _, user_id in self.keys[:k]]
+
+    def rank(self, user_id: str) -> Optional[int]:
+        """从1开始的排名，未上榜时返回None"""
+        key = self.positions.get(user_id)
+        if key is None:
+            return None
+        return bisect_left(self.keys, key) + 1
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class Leaderboard:
+    """按群维护的长度排行索引
+
+    每个群在首次查询时建立索引；之后长度变化通过 touch 记录，
+    下次查询时只重新放置这些用户，无需对整个群重新排序。
+    """
+
+    def __init__(self, loader: Callable[[str], dict]):
+        """初始化排行索引
+
+        Args:
+            loader: 根据群ID返回群数据（只读）
+        """
+        self._loader = loader
+        self._groups: Dict[str, GroupLeaderboard] = {}
+
+    def touch(self, group_id=None, user_ids: Optional[Iterable] = None):
+        """记录数据发生变化的用户
+
+        Args:
+            group_id: 群ID，为None表示所有群都需要重建
+            user_ids: 发生变化的用户，为None表示整个群都需要重建
+        """
+        if group_id is None:
+            self._groups.clear()
+            return
+        group_id = str(group_id)
+        board = self._groups.get(group_id)
+        if board is None:
+            return
+        if user_ids is None:
+            del self._groups[group_id]
+        else:
+            board.pending.update(str(uid) for uid in user_ids if uid is not None)
+
+    def forget(self, group_id):
+        """丢弃群的索引（群数据移出内存时调用）"""
+        self._groups.pop(str(group_id), None)
+
+    def _board(self, group_id) -> Tuple[GroupLeaderboard, dict]:
+        group_id = str(group_id)
+        group_data = self._loader(group_id)
+        board = self._groups.get(group_id)
+        if board is None:
+            board = GroupLeaderboard(group_data)
+            self._groups[group_id] = board
+        elif board.pending:
+            board.refresh(group_data)
+        return board, group_data
+
+    def top(self, group_id, k: int = 10) -> List[Tuple[int, str, dict]]:
+        """前k名，返回 [(排名, user_id, 用户数据)]"""
+        board, group_data = self._board(group_id)
+        return [(rank, user_id, group_data[user_id])
+                for rank, user_id in enumerate(board.top(k), 1)]
+
+    def rank(self, group_id, user_id) -> Tuple[Optional[int], int]:
+        """用户的排名与上榜总人数，未上榜时排名为None"""
+        board, _ = self._board(group_id)
+        return board.rank(str(user_id)), len(board)
+
+    def around(self, group_id, user_id, radius: int = 2) -> List[Tuple[int, str, dict]]:
+        """用户前后各radius名，返回 [(排名, user_id, 用户数据)]，未上榜时返回空列表"""
+        board, group_data = self._board(group_id)
+        rank = board.rank(str(user_id))
+        if rank is None:
+            return []
+        start = max(0, rank - 1 - radius)
+        return [(start + offset + 1, uid, group_data[uid])
+                for offset, (_, uid) in enumerate(board.keys[start:rank + radius])]
@@ -1,13 +1,86 @@
 import os
-import yaml
+import copy
 import time
 import math
+from bisect import bisect_left, insort
 from typing import Dict, List, Tuple, Any, Optional
+from astrbot.api import logger
 from astrbot.api.message_components import Plain
 from astrbot.core.utils.session_waiter import session_waiter, SessionController
+from niuniu_txn import Transaction
+
+class OrderBook:
+    """单个群的集市挂单索引
+
+    商品本身仍保存在集市数据的 {item_id: item} 字典中，这里只维护索引：
+    - 卖家 -> 商品ID，用于检查是否已有挂单
+    - 按编号、价格、长度、单价排序的有序列表，用于分页浏览
+
+    商品ID单调递增，成交或下架后不会重新编号。
+    """
+
+    # 排序方式 -> 排序键
+    SORTS = {
+        'id': lambda item_id, item: (int(item_id),),
+        'price': lambda item_id, item: (item['price'], int(item_id)),
+        'length': lambda item_id, item: (-item['length'], int(item_id)),
+        'unit': lambda item_id, item: (item['price'] / max(item['length'], 1), int(item_id)),
+    }
+
+    def __init__(self, items: dict):
+        self.items = items
+        self.by_seller: Dict[str, str] = {}
+        self.indexes: Dict[str, List[tuple]] = {sort: [] for sort in self.SORTS}
+        for item_id, item in items.items():
+            self._index(item_id, item)
+        for index in self.indexes.values():
+            index.sort()
+
+    def _index(self, item_id: str, item: dict, insert: bool = False):
+        self.by_seller[item['seller_id']] = item_id
+        for sort, key in self.SORTS.items():
+            entry = key(item_id, item) + (item_id,)
+            if insert:
+                insort(self.indexes[sort], entry)
+            else:
+                self.indexes[sort].append(entry)
+
+    def add(self, item_id: str, item: dict):
+        self.items[item_id] = item
+        self._index(item_id, item, insert=True)
+
+    def remove(self, item_id: str) -> Optional[dict]:
+        item = self.items.pop(item_id, None)
+        if item is None:
+            return None
+        if self.by_seller.get(item['seller_id']) == item_id:
+            del self.by_seller[item['seller_id']]
+        for sort, key in self.SORTS.items():
+            index = self.indexes[sort]
+            entry = key(item_id, item) + (item_id,)
+            pos = bisect_left(index, entry)
+            if pos < len(index) and index[pos] == entry:
+                del index[pos]
+        return item
+
+    def seller_item(self, seller_id: str) -> Optional[str]:
+        return self.by_seller.get(seller_id)
+
+    def page(self, sort: str = 'id', page: int = 1, size: int = 10) -> List[Tuple[str, dict]]:
+        """按指定排序取一页商品"""
+        start = (page - 1) * size
+        return [(entry[-1], self.items[entry[-1]]) for entry in self.indexes[sort][start:start + size]]
+
+    def __len__(self):
+        return len(self.items)
+
 
 class NiuniuMarket:
     """牛牛集市类，管理牛牛的上架、购买、回收等功能"""
+
+    PAGE_SIZE = 10
+    # 查看集市的排序参数
+    SORT_NAMES = {'编号': 'id', '价格': 'price', '长度': 'length', '单价': 'unit'}
     
     def __init__(self, plugin):
         """初始化牛牛集市
@@ -17,24 +90,41 @@ class NiuniuMarket:
         """
         self.plugin = plugin
         # 修改为data目录下的路径，而非插件目录，确保数据不会在更新时被覆盖
-        self.market_file = os.path.join('data', 'niuniu_market.yml')
+        self.market_file = os.path.join('data', 'niuniu_market')  # 不含扩展名，由数据格式决定
         self.market_data = self._load_market_data()
+        # 各群的挂单索引
+        self.books: Dict[str, OrderBook] = {
+            group_id: OrderBook(items) for group_id, items in self.market_data['groups'].items()
+        }
+        self.plugin.persistence.register(
+            'market',
+            lambda keys: copy.deepcopy(self.market_data),
+            self._write_market_data
+        )
         self.current_event = None
+        # 注册命令
+        router = self.plugin.router
+        router.add(('牛牛集市', '回收牛牛', '确认回收牛牛'),
+                   self.process_market_command, exact=True, name='牛牛集市')
+        router.add(('查看集市', '集市列表'), self.process_market_command, name='查看集市')
+        router.add(('上架牛牛', '购买牛牛', '下架牛牛'), self.process_market_command, name='集市交易')
         
     def _load_market_data(self) -> dict:
-        """加载集市数据"""
-        if not os.path.exists(self.market_file):
-            return {'groups': {}, 'next_id': {}}
-        
+        """加载集市数据，文件损坏时回退到最新的有效历史版本"""
         try:
-            with open(self.market_file, 'r', encoding='utf-8') as f:
-                data = yaml.safe_load(f)
-                if not data:
-                    data = {'groups': {}, 'next_id': {}}
-                elif not isinstance(data.get('groups'), dict):
-                    data['groups'] = {}
-                elif not isinstance(data.get('next_id'), dict):
-                    data['next_id'] = {}
+            data = self.plugin.load_data_file(self.market_file, lambda d: d is None or isinstance(d, dict))
+            if not data:
+                data = {'groups': {}, 'next_id': {}}
+            elif not isinstance(data.get('groups'), dict):
+                data['groups'] = {}
+            elif not isinstance(data.get('next_id'), dict):
+                data['next_id'] = {}
+            data.setdefault('next_id', {})
+
+            # 旧版本会在成交后重新编号，确保新编号大于所有现存编号
+            for group_id, items in data['groups'].items():
+                max_id = max((int(item_id) for item_id in items), default=0)
+                data['next_id'][group_id] = max(int(data['next_id'].get(group_id, 1)), max_id + 1)
                     
             return data
         except Exception as e:
@@ -42,23 +132,37 @@ class NiuniuMarket:
             return {'groups': {}, 'next_id': {}}
             
     def _save_market_data(self):
-        """保存集市数据"""
-        try:
-            os.makedirs(os.path.dirname(self.market_file), exist_ok=True)
-            with open(self.market_file, 'w', encoding='utf-8') as f:
-                yaml.dump(self.market_data, f, allow_unicode=True)
-        except Exception as e:
-            logger.error(f"保存集市数据失败: {str(e)}")
-            
-    def list_market(self) -> str:
-        """查看集市上的牛牛列表"""
+        """标记集市数据待保存"""
+        self.plugin.persistence.mark_dirty('market')
+
+    def _write_market_data(self, data: dict):
+        """把集市数据快照写入文件"""
+        self.plugin.codec.write(self.plugin.worker_file(self.market_file), data)
+            
+    def _book(self, group_id: str) -> OrderBook:
+        """获取群的挂单索引，不存在时创建"""
+        book = self.books.get(group_id)
+        if book is None:
+            book = OrderBook(self.market_data['groups'].setdefault(group_id, {}))
+            self.books[group_id] = book
+        return book
+
+    def list_market(self, sort: str = 'id', page: int = 1) -> str:
+        """查看集市上的牛牛列表
+
+        Args:
+            sort: 排序方式（id/price/length/unit）
+            page: 页码，从1开始
+        """
         group_id = str(self.current_event.message_obj.group_id)
-        items = self.market_data.get('groups', {}).get(group_id, {})
-        if not items:
+        book = self.books.get(group_id)
+        if not book:
             return "🏪 牛牛集市空空如也，快来上架你的牛牛吧！"
-            
-        result = ["🏪 牛牛集市商品列表："]
-        for item_id, item in items.items():
+
+        pages = max(1, math.ceil(len(book) / self.PAGE_SIZE))
+        page = min(max(page, 1), pages)
+        result = [f"🏪 牛牛集市商品列表（第{page}/{pages}页，共{len(book)}件）："]
+        for item_id, item in book.page(sort, page, self.PAGE_SIZE):
             seller_nickname = self._get_nickname(group_id, item['seller_id']) or "未知用户"
             result.append(
                 f"编号: {item_id} | {seller_nickname}的牛牛 | "
@@ -71,7 +175,7 @@ class NiuniuMarket:
         
     def _get_nickname(self, group_id: str, user_id: str) -> str:
         """获取用户昵称"""
-        group_data = self.plugin.get_group_data(group_id)
+        group_data = self.plugin.peek_group_data(group_id)
         user_data = group_data.get(user_id, {})
         return user_data.get('nickname', '未知用户') if isinstance(user_data, dict) else '未知用户'
         
@@ -95,9 +199,9 @@ class NiuniuMarket:
             return False, "你的牛牛长度太小，无法上架"
             
         # 检查是否已经有牛牛在集市上
-        for item in self.market_data.get('groups', {}).get(group_id, {}).values():
-            if item['seller_id'] == user_id:
-                return False, "你已经有牛牛在集市上了"
+        book = self.books.get(group_id)
+        if book and book.seller_item(user_id) is not None:
+            return False, "你已经有牛牛在集市上了"
                 
         return True, ""
         
@@ -126,32 +230,22 @@ class NiuniuMarket:
         length = user_data.get('length', 0)
         hardness = user_data.get('hardness', 1)
         
-        # 初始化群组数据，确保字典存在
-        if 'groups' not in self.market_data:
-            self.market_data['groups'] = {}
-        if 'next_id' not in self.market_data:
-            self.market_data['next_id'] = {}
-        if group_id not in self.market_data['groups']:
-            self.market_data['groups'][group_id] = {}
-        if group_id not in self.market_data['next_id']:
-            self.market_data['next_id'][group_id] = 1
-
-        # 生成商品ID
-        item_id = str(self.market_data['next_id'][group_id])
-        self.market_data['next_id'][group_id] = int(self.market_data['next_id'][group_id]) + 1
+        # 生成商品ID（单调递增，不会重复使用）
+        item_id = str(self.market_data['next_id'].get(group_id, 1))
+        self.market_data['next_id'][group_id] = int(item_id) + 1
         
         # 添加到集市
-        self.market_data['groups'][group_id][item_id] = {
+        self._book(group_id).add(item_id, {
             'seller_id': user_id,
             'length': length,
             'hardness': hardness,
             'price': price,
             'time': time.time()
-        }
+        })
         
         # 清空用户的牛牛长度
         user_data['length'] = 0
-        self.plugin._save_niuniu_lengths()
+        self.plugin._save_niuniu_lengths(group_id, user_id)
         
         # 保存集市数据
         self._save_market_data()
@@ -170,10 +264,10 @@ class NiuniuMarket:
             Tuple[bool, str]: (是否成功, 结果信息)
         """
         # 检查商品是否存在
-        if group_id not in self.market_data['groups'] or item_id not in self.market_data['groups'][group_id]:
+        book = self.books.get(group_id)
+        item = book.items.get(item_id) if book else None
+        if item is None:
             return False, "该商品不存在或已被购买"
-            
-        item = self.market_data['groups'][group_id][item_id]
         
         # 检查是否是自己的商品
         if item['seller_id'] == buyer_id:
@@ -204,22 +298,27 @@ class NiuniuMarket:
         # 买家支付金币
         buyer_data['coins'] -= item['price']
         # 计算卖家获得的税后金额
-        after_tax, tax = self.plugin.tax_system.process_coins(group_id, item['price'])
+        after_tax, tax = self.plugin.tax_system.process_coins(group_id, item['price'], seller_id, 'market_sell')
         # 卖家获得税后金币
         seller_data['coins'] = seller_data.get('coins', 0) + after_tax
         # 买家获得牛牛
         buyer_data['length'] = buyer_data.get('length', 0) + item['length']
         buyer_data['hardness'] = max(buyer_data.get('hardness', 1), item['hardness'])
-        
-        # 从集市中移除商品
-        del self.market_data['groups'][group_id][item_id]
-        
-        # 重新排序剩余商品ID
-        self._reorder_items(group_id)
+        self.plugin.record_change(group_id, buyer_id, 'market_buy', dlen=item['length'], dcoins=-item['price'])
+        self.plugin.record_change(group_id, seller_id, 'market_sell', dcoins=after_tax)
         
         # 保存数据
-        self.plugin._save_niuniu_lengths()
-        self._save_market_data()
+        self.plugin._save_niuniu_lengths(group_id, buyer_id, seller_id)
+        
+        # 从集市中移除商品（其余商品编号不变）；在事务中时等提交后再移除，事务撤销时商品仍在集市上
+        def remove_item():
+            book.remove(item_id)
+            self._save_market_data()
+        txn = Transaction.current(group_id)
+        if txn is not None:
+            txn.on_commit(remove_item)
+        else:
+            remove_item()
         
         seller_nickname = self._get_nickname(group_id, seller_id)
         return True, (
@@ -260,14 +359,15 @@ class NiuniuMarket:
         coins = math.ceil(length / 20)
         
         # 计算税后金额
-        after_tax, tax = self.plugin.tax_system.process_coins(group_id, coins)
+        after_tax, tax = self.plugin.tax_system.process_coins(group_id, coins, user_id, 'recycle')
         
         # 更新用户数据
         user_data['coins'] = user_data.get('coins', 0) + after_tax
         user_data['length'] = 0
+        self.plugin.record_change(group_id, user_id, 'market_recycle', dlen=-length, dcoins=after_tax)
         
         # 保存数据
-        self.plugin._save_niuniu_lengths()
+        self.plugin._save_niuniu_lengths(group_id, user_id)
         
         return True, f"🔄 成功回收牛牛！\n长度: {self.plugin.format_length(length)}\n获得金币: {after_tax}（缴纳税款：{tax}金币）\n当前金币: {user_data['coins']}"
         
@@ -283,10 +383,10 @@ class NiuniuMarket:
             Tuple[bool, str]: (是否成功, 结果信息)
         """
         # 检查商品是否存在
-        if group_id not in self.market_data['groups'] or item_id not in self.market_data['groups'][group_id]:
+        book = self.books.get(group_id)
+        item = book.items.get(item_id) if book else None
+        if item is None:
             return False, "该商品不存在"
-            
-        item = self.market_data['groups'][group_id][item_id]
         
         # 检查是否是自己的商品
         if item['seller_id'] != user_id:
@@ -310,16 +410,13 @@ class NiuniuMarket:
             user_data['hardness'] = hardness
             
         # 将罚款金币添加到群账户
-        self.plugin.tax_system.add_tax_to_treasury(group_id, penalty_coins)
+        self.plugin.tax_system.add_tax_to_treasury(group_id, penalty_coins, 'market_remove_penalty', user_id)
         
-        # 从集市中移除商品
-        del self.market_data['groups'][group_id][item_id]
-        
-        # 重新排序剩余商品ID
-        self._reorder_items(group_id)
+        # 从集市中移除商品（其余商品编号不变）
+        book.remove(item_id)
         
         # 保存数据
-        self.plugin._save_niuniu_lengths()
+        self.plugin._save_niuniu_lengths(group_id, user_id)
         self._save_market_data()
         
         # 获取当前群账户余额
@@ -334,38 +431,12 @@ class NiuniuMarket:
             f"群账户余额: {group_balance}金币"
         )
 
-    def _reorder_items(self, group_id: str):
-        """重新排序指定群组的商品ID"""
-        if group_id not in self.market_data['groups']:
-            return
-            
-        items = self.market_data['groups'][group_id]
-        if not items:
-            self.market_data['next_id'][group_id] = 1
-            return
-            
-        # 获取所有商品并按旧ID排序
-        sorted_items = []
-        for old_id, item in items.items():
-            sorted_items.append((old_id, item))
-        sorted_items.sort(key=lambda x: int(x[0]))
-        
-        # 清空原有商品
-        self.market_data['groups'][group_id] = {}
-        
-        # 使用新ID重新添加商品
-        for i, (_, item) in enumerate(sorted_items, 1):
-            self.market_data['groups'][group_id][str(i)] = item
-            
-        # 更新next_id
-        self.market_data['next_id'][group_id] = len(sorted_items) + 1
-
     def show_market_menu(self) -> str:
         """显示集市菜单"""
         menu = [
             "🏪 牛牛集市功能菜单：",
             "📌 上架牛牛 [价格] - 将你的牛牛上架到集市",
-            "📋 查看集市 - 查看所有在售的牛牛",
+            "📋 查看集市 [编号/价格/长度/单价] [页码] - 分页查看在售的牛牛",
             "💰 购买牛牛 [编号] - 购买集市上的牛牛",
             "⬇️ 下架牛牛 [编号] - 下架自己上架的牛牛",
             "♻️ 回收牛牛 - 直接回收自己的牛牛（每20cm=1金币）",
@@ -390,8 +461,7 @@ class NiuniuMarket:
         msg = event.message_str.strip()
         
         # 检查插件是否启用与打工状态
-        group_data = self.plugin.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.plugin.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
             
@@ -404,9 +474,18 @@ class NiuniuMarket:
             # 显示集市菜单
             yield event.plain_result(self.show_market_menu())
             
-        elif msg == "查看集市" or msg == "集市列表":
-            # 直接显示集市列表
-            result = self.list_market()
+        elif msg.startswith("查看集市") or msg.startswith("集市列表"):
+            # 解析排序方式与页码，例如：查看集市 单价 2
+            sort, page = 'id', 1
+            for arg in msg[4:].split():
+                if arg in self.SORT_NAMES:
+                    sort = self.SORT_NAMES[arg]
+                elif arg.isdigit():
+                    page = int(arg)
+                else:
+                    yield event.plain_result("❌ 用法：查看集市 [编号/价格/长度/单价] [页码]")
+                    return
+            result = self.list_market(sort, page)
             yield event.plain_result(f"{result}\n\n💡 使用\"购买牛牛 编号\"购买，\"下架牛牛 编号\"下架自己的牛牛")
             
         elif msg.startswith("购买牛牛"):
@@ -417,7 +496,12 @@ class NiuniuMarket:
                     yield event.plain_result("❌ 请输入正确的商品编号，例如：购买牛牛 1")
                     return
                     
-                success, result = self.buy_niuniu(group_id, user_id, item_id)
+                # 锁定买卖双方，同一商品或同一买家的并发购买依次处理
+                book = self.books.get(group_id)
+                item = book.items.get(item_id) if book else None
+                seller_id = item['seller_id'] if item else None
+                async with self.plugin.transaction(group_id, user_id, seller_id):
+                    success, result = self.buy_niuniu(group_id, user_id, item_id)
                 yield event.plain_result(result)
             except Exception as e:
                 logger.error(f"购买牛牛出错: {str(e)}")
@@ -0,0 +1,148 @@
+from typing import Callable, Dict, List, Optional, Set
+
+
+class AmbiguousNickname(Exception):
+    """按昵称查找目标时匹配到多个用户"""
+
+    def __init__(self, name: str, nicknames: List[str]):
+        self.name = name
+        self.nicknames = nicknames
+        shown = '、'.join(nicknames[:5])
+        more = f" 等{len(nicknames)}人" if len(nicknames) > 5 else ''
+        super().__init__(f"❌ “{name}”匹配到多个用户：{shown}{more}\n请@对方或输入完整昵称")
+
+
+def _grams(text: str) -> Set[str]:
+    """文本的所有单字与相邻二字片段"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+class _GroupIndex:
+    """单个群的昵称索引"""
+
+    __slots__ = ('names', 'folded', 'exact', 'postings')
+
+    def __init__(self):
+        self.names: Dict[str, str] = {}      # user_id -> 原始昵称
+        self.folded: Dict[str, str] = {}     # user_id -> 大小写折叠后的昵称
+        self.exact: Dict[str, Set[str]] = {}     # 折叠后的昵称 -> user_id集合
+        self.postings: Dict[str, Set[str]] = {}  # 单字/二字片段 -> user_id集合
+
+    def add(self, user_id: str, nickname: str):
+        if self.names.get(user_id) == nickname:
+            return
+        self.discard(user_id)
+        folded = nickname.casefold()
+        self.names[user_id] = nickname
+        self.folded[user_id] = folded
+        self.exact.setdefault(folded, set()).add(user_id)
+        for gram in _grams(folded):
+            self.postings.setdefault(gram, set()).add(user_id)
+
+    def discard(self, user_id: str):
+        folded = self.folded.pop(user_id, None)
+        if folded is None:
+            return
+        del self.names[user_id]
+        self._remove(self.exact, folded, user_id)
+        for gram in _grams(folded):
+            self._remove(self.postings, gram, user_id)
+
+    @staticmethod
+    def _remove(mapping: dict, key: str, user_id: str):
+        users = mapping.get(key)
+        if users is not None:
+            users.discard(user_id)
+            if not users:
+                del mapping[key]
+
+    def search(self, query: str) -> List[str]:
+        """查找昵称包含query（忽略大小写）的用户，有完全相同的昵称时只返回这些用户"""
+        exact = self.exact.get(query)
+        if exact:
+            return sorted(exact)
+        # 用各片段的倒排表求交集得到候选，再逐个确认子串
+        grams = [query] if len(query) == 1 else [query[i:i + 2] for i in range(len(query) - 1)]
+        sets = []
+        for gram in set(grams):
+            users = self.postings.get(gram)
+            if not users:
+                return []
+            sets.append(users)
+        sets.sort(key=len)
+        candidates = set(sets[0]).intersection(*sets[1:])
+        return sorted(uid for uid in candidates if query in self.folded[uid])
+
+
+class NicknameIndex:
+    """按群维护的昵称搜索索引
+
+    每个群在首次查找时从群数据建立索引，之后在注册等修改昵称的地方增量更新。
+    查找时忽略大小写，完全相同的昵称优先；否则按单字/二字片段的倒排表求交集，
+    只需确认少量候选，不必遍历整个群。
+    """
+
+    def __init__(self, loader: Callable[[str], dict]):
+        """初始化索引
+
+        Args:
+            loader: 根据群ID返回群数据（只读），用于首次建立索引
+        """
+        self._loader = loader
+        self._groups: Dict[str, _GroupIndex] = {}
+
+    def _group(self, group_id: str) -> _GroupIndex:
+        index = self._groups.get(group_id)
+        if index is None:
+            index = _GroupIndex()
+            for user_id, user_data in self._loader(group_id).items():
+                if isinstance(user_data, dict) and user_data.get('nickname'):
+                    index.add(str(user_id), str(user_data['nickname']))
+            self._groups[group_id] = index
+        return index
+
+    def add(self, group_id, user_id, nickname: str):
+        """新增或更新用户昵称"""
+        group_id = str(group_id)
+        if group_id in self._groups and nickname:
+            self._groups[group_id].add(str(user_id), str(nickname))
+
+    def discard(self, group_id, user_id):
+        """移除用户"""
+        index = self._groups.get(str(group_id))
+        if index is not None:
+            index.discard(str(user_id))
+
+    def search(self, group_id, name: str) -> List[str]:
+        """查找昵称匹配的所有用户"""
+        query = name.strip().casefold()
+        if not query:
+            return []
+        return self._group(str(group_id)).search(query)
+
+    def forget(self, group_id):
+        """丢弃群的索引（群数据移出内存时调用），下次查找时重建"""
+        self._groups.pop(str(group_id), None)
+
+    def find(self, group_id, name: str) -> Optional[str]:
+        """查找唯一匹配的用户
+
+        Args:
+            group_id: 群ID
+            name: 昵称或昵称片段
+
+        Returns:
+            匹配的用户ID，没有匹配时返回None
+
+        Raises:
+            AmbiguousNickname: 匹配到多个用户
+        """
+        matches = self.search(group_id, name)
+        if not matches:
+            return None
+        if len(matches) > 1:
+            names = self._groups[str(group_id)].names
+            raise AmbiguousNickname(name.strip(), [names[uid] for uid in matches])
+        return matches[0]
@@ -0,0 +1,139 @@
+import asyncio
+import threading
+from typing import Callable, Dict, Optional, Set
+from astrbot.api import logger
+
+
+class PersistenceManager:
+    """写回式持久化管理器
+
+    各数据存储以名字注册 snapshot/write 两个回调：
+    - snapshot(keys) 在事件循环中执行，负责拷贝需要落盘的数据（keys为None表示全量）
+    - write(payload) 在线程池中执行，负责真正的磁盘写入
+
+    调用 mark_dirty 只会记录脏数据，同一时间窗口内的多次保存合并为一次落盘。
+    """
+
+    def __init__(self, delay: float = 2.0):
+        """初始化持久化管理器
+
+        Args:
+            delay: 合并保存的时间窗口（秒），为0时每次保存都立即在后台落盘
+        """
+        self.delay = delay
+        self._stores: Dict[str, tuple] = {}
+        # {store_name: set(keys) 或 None(全量)}
+        self._dirty: Dict[str, Optional[Set]] = {}
+        self._flush_handle = None
+        self._flush_task = None
+        self._flush_lock = None
+        self._write_lock = threading.Lock()
+        self.flush_count = 0
+
+    def register(self, name: str, snapshot: Callable, write: Callable):
+        """注册一个数据存储"""
+        self._stores[name] = (snapshot, write)
+
+    def mark_dirty(self, name: str, keys=None):
+        """标记数据需要保存
+
+        Args:
+            name: 数据存储名
+            keys: 发生变化的键集合，为None表示整个存储都需要保存
+        """
+        if name in self._dirty:
+            pending = self._dirty[name]
+            if pending is not None:
+                if keys is None:
+                    self._dirty[name] = None
+                else:
+                    pending.update(keys)
+        else:
+            self._dirty[name] = None if keys is None else set(keys)
+        self._schedule()
+
+    def is_dirty(self, name: str, match: Optional[Callable] = None) -> bool:
+        """数据存储是否还有未落盘的修改
+
+        Args:
+            name: 数据存储名
+            match: 只检查满足条件的键，为None时检查整个存储
+        """
+        if name not in self._dirty:
+            return False
+        keys = self._dirty[name]
+        if keys is None or match is None:
+            return True
+        return any(match(key) for key in keys)
+
+    def _schedule(self):
+        """安排一次延迟落盘，没有运行中的事件循环时直接同步保存"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_now()
+            return
+        if self._flush_handle is None and self._flush_task is None:
+            self._flush_handle = loop.call_later(self.delay, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _take_snapshots(self) -> list:
+        """在事件循环中取出所有脏数据的快照"""
+        dirty, self._dirty = self._dirty, {}
+        payloads = []
+        for name, keys in dirty.items():
+            snapshot, write = self._stores[name]
+            try:
+                payloads.append((name, write, snapshot(keys)))
+            except Exception as e:
+                logger.error(f"生成 {name} 数据快照失败: {str(e)}")
+        return payloads
+
+    def _write_all(self, payloads: list):
+        with self._write_lock:
+            for name, write, payload in payloads:
+                try:
+                    write(payload)
+                except Exception as e:
+                    logger.error(f"保存 {name} 数据失败: {str(e)}")
+            self.flush_count += 1
+
+    async def flush(self):
+        """把当前所有脏数据写入磁盘（写入在线程池中进行）"""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        try:
+            async with self._flush_lock:
+                payloads = self._take_snapshots()
+                if payloads:
+                    loop = asyncio.get_running_loop()
+                    await loop.run_in_executor(None, self._write_all, payloads)
+        finally:
+            self._flush_task = None
+            # 落盘期间又产生了新的脏数据，继续安排下一次
+            if self._dirty:
+                self._schedule()
+
+    def flush_now(self):
+        """同步落盘所有脏数据，用于插件关闭时"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        payloads = self._take_snapshots()
+        if payloads:
+            self._write_all(payloads)
+
+    async def shutdown(self):
+        """等待进行中的落盘完成，并同步写入剩余的脏数据"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            try:
+                await self._flush_task
+            except Exception as e:
+                logger.error(f"等待数据落盘失败: {str(e)}")
+        self.flush_now()
@@ -0,0 +1,199 @@
+import time
+from array import array
+from typing import Callable, Dict, Optional, Tuple
+
+
+class SlidingLog:
+    """滑动日志：任意 window 秒内最多 limit 次
+
+    每个键只保存最近 limit 次的时间戳，存放在定长的环形缓冲区中：
+    下一个写入位置上的就是最早的一次，判断是否允许只需比较这一个时间戳，O(1)。
+    """
+
+    def __init__(self, limit: int, window: float):
+        self.limit = max(1, int(limit))
+        self.window = float(window)
+        self.ttl = self.window  # 最后一次操作之后多久记录失效
+
+    def new_state(self) -> array:
+        # [下一个写入位置, 时间戳 * limit]，未使用的位置为0
+        return array('d', [0.0] * (self.limit + 1))
+
+    def valid(self, state) -> bool:
+        """保存的记录是否与当前策略匹配（配置修改后可能不匹配）"""
+        return len(state) == self.limit + 1 and 0 <= state[0] < self.limit
+
+    def wait(self, state, now: float) -> float:
+        """返回0表示允许，否则返回还需等待的秒数（不记录）"""
+        stamp = state[1 + int(state[0])]
+        return max(0.0, stamp + self.window - now) if stamp else 0.0
+
+    def record(self, state, now: float):
+        """记录一次操作"""
+        slot = 1 + int(state[0])
+        state[slot] = now
+        state[0] = (int(state[0]) + 1) % self.limit
+
+    def idle(self, state, now: float) -> bool:
+        """记录是否已全部过期（可以删除）"""
+        return max(state[1:]) + self.window <= now
+
+
+class TokenBucket:
+    """令牌桶：最多积攒 capacity 个令牌，每秒补充 rate 个，每次操作消耗一个"""
+
+    def __init__(self, capacity: float, rate: float):
+        self.capacity = max(1.0, float(capacity))
+        self.rate = float(rate)
+        self.ttl = self.capacity / self.rate if self.rate > 0 else None  # 从空桶恢复为满桶的时间
+
+    def new_state(self) -> array:
+        # [令牌数, 上次更新时间]，初始为满桶
+        return array('d', [self.capacity, 0.0])
+
+    def valid(self, state) -> bool:
+        return len(state) == 2
+
+    def _refill(self, state, now: float) -> float:
+        if state[1] == 0.0:
+            return state[0]
+        return min(self.capacity, state[0] + (now - state[1]) * self.rate)
+
+    def wait(self, state, now: float) -> float:
+        tokens = self._refill(state, now)
+        if tokens < 1:
+            return (1 - tokens) / self.rate if self.rate > 0 else float('inf')
+        return 0.0
+
+    def record(self, state, now: float):
+        state[0] = self._refill(state, now) - 1
+        state[1] = now
+
+    def idle(self, state, now: float) -> bool:
+        return self._refill(state, now) >= self.capacity
+
+
+POLICIES = {
+    'sliding_log': lambda spec: SlidingLog(spec['limit'], spec['window']),
+    'token_bucket': lambda spec: TokenBucket(spec['capacity'], spec['rate']),
+}
+
+
+class RateLimiter:
+    """按名称声明的限流策略
+
+    每个名称对应一种策略（见 POLICIES），调用方以任意键（如群ID、用户ID）分别计数：
+        limiter.hit('比划', group_id, user_id)
+    只有操作成功才计数时，先用 check 判断，成功后再 hit。
+    未声明的名称不做限制。计数默认只保存在内存中，已全部过期的记录由 vacuum 清理；
+    通过 persist 指定的名称（键为 群ID, 用户ID）保存在冷却数据中，重启后仍然有效。
+    """
+
+    def __init__(self, specs: Optional[Dict[str, dict]] = None, store=None,
+                 on_change: Optional[Callable[[], None]] = None):
+        """初始化限流器
+
+        Args:
+            specs: {名称: 策略配置}
+            store: 保存计数的冷却数据（niuniu_cooldown.CooldownStore）
+            on_change: 保存的计数变化后调用（标记冷却数据待保存）
+        """
+        self._policies: Dict[str, object] = {}
+        self._states: Dict[str, Dict[Tuple, array]] = {}
+        self._persisted = set()
+        self._store = store
+        self._on_change = on_change
+        for name, spec in (specs or {}).items():
+            self.configure(name, spec)
+
+    @staticmethod
+    def _field(name: str) -> str:
+        return f"rate:{name}"
+
+    def persist(self, *names: str):
+        """把这些名称的计数保存在冷却数据中，并按策略登记过期时间（计数中有小数，保存时不取整）"""
+        for name in names:
+            self._persisted.add(name)
+            self._states.pop(name, None)
+            policy = self._policies.get(name)
+            self._store.expire(self._field(name), policy.ttl if policy is not None else 0, compact=False)
+
+    def configure(self, name: str, spec: Optional[dict]):
+        """声明或替换策略，spec为空表示取消限制
+
+        Args:
+            spec: {'policy': 'sliding_log', 'limit': 次数, 'window': 秒}
+                  或 {'policy': 'token_bucket', 'capacity': 容量, 'rate': 每秒补充数}
+        """
+        self._states.pop(name, None)
+        if not spec:
+            self._policies.pop(name, None)
+        else:
+            factory = POLICIES.get(spec.get('policy', 'sliding_log'))
+            if factory is None:
+                raise ValueError(f"未知的限流策略: {spec.get('policy')}")
+            self._policies[name] = factory(spec)
+        if name in self._persisted:
+            self.persist(name)
+
+    def _state(self, policy, name: str, key: Tuple, create: bool):
+        """键的计数，不存在（或与当前策略不匹配）且create为False时返回None"""
+        if name in self._persisted:
+            field = self._field(name)
+            actions = self._store.user(*key) if create else self._store.peek(*key)
+            state = actions.get(field)
+            if state is None or not policy.valid(state):
+                if not create:
+                    return None
+                state = actions[field] = list(policy.new_state())
+            return state
+        states = self._states.setdefault(name, {})
+        state = states.get(key)
+        if state is None and create:
+            state = states[key] = policy.new_state()
+        return state
+
+    def check(self, name: str, *key, now: Optional[float] = None) -> float:
+        """判断是否允许一次操作（不计数）
+
+        Returns:
+            0表示允许；否则为还需等待的秒数
+        """
+        policy = self._policies.get(name)
+        if policy is None:
+            return 0.0
+        state = self._state(policy, name, key, create=False)
+        return policy.wait(state, time.time() if now is None else now) if state is not None else 0.0
+
+    def hit(self, name: str, *key, now: Optional[float] = None) -> float:
+        """判断并记录一次操作（不允许时不记录）
+
+        Returns:
+            0表示允许；否则为还需等待的秒数
+        """
+        policy = self._policies.get(name)
+        if policy is None:
+            return 0.0
+        now = time.time() if now is None else now
+        state = self._state(policy, name, key, create=True)
+        wait = policy.wait(state, now)
+        if wait:
+            return wait
+        policy.record(state, now)
+        if name in self._persisted and self._on_change is not None:
+            self._on_change()
+        return 0.0
+
+    def vacuum(self, now: Optional[float] = None) -> int:
+        """删除内存中已全部过期的计数，返回删除的数量（保存在冷却数据中的计数随冷却数据清理）"""
+        now = time.time() if now is None else now
+        removed = 0
+        for name, states in self._states.items():
+            policy = self._policies[name]
+            for key in [k for k, state in states.items() if policy.idle(state, now)]:
+                del states[key]
+                removed += 1
+        return removed
+
+    def __len__(self):
+        return sum(len(states) for states in self._states.values())
@@ -1,8 +1,9 @@
 import random
 import time
-import asyncio
 import re
+from astrbot.api import logger
 from astrbot.api.all import At, Plain, MessageChain
+from niuniu_txn import Transaction
 
 class NiuniuRedPacket:
     """牛牛红包功能类"""
@@ -14,12 +15,23 @@ class NiuniuRedPacket:
         self.niuniu_lengths = niuniu_plugin.niuniu_lengths
         # 红包数据结构
         self.red_packets = {}  # {group_id: {packet_id: {sender, sender_nickname, amount, count, remaining, remaining_amount, timestamp, participants}}}
-        # 存储红包任务
-        self.tasks = {}
+        # 红包过期由调度器处理，红包数据保存在过期任务中，重启后继续有效
+        niuniu_plugin.scheduler.register('red_packet', self._on_red_packet_expired)
+        for job in niuniu_plugin.scheduler.jobs('red_packet'):
+            packet = job.payload.get('packet')
+            if packet:
+                self.red_packets.setdefault(job.group_id, {})[job.payload['packet_id']] = packet
+        # 注册命令
+        niuniu_plugin.router.add('发红包', self.handle_send_red_packet)
+        niuniu_plugin.router.add('抢红包', self.handle_grab_red_packet, exact=True)
+
+    @staticmethod
+    def _job_id(group_id, packet_id):
+        return f"red_packet:{group_id}:{packet_id}"
         
-    def _save_data(self):
+    def _save_data(self, group_id=None, *user_ids):
         """保存用户数据"""
-        self.plugin._save_niuniu_lengths()
+        self.plugin._save_niuniu_lengths(group_id, *user_ids)
         
     async def handle_send_red_packet(self, event):
         """处理发红包命令"""
@@ -28,8 +40,7 @@ class NiuniuRedPacket:
         nickname = event.get_sender_name()
         
         # 检查插件是否启用
-        group_data = self.plugin.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.plugin.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
         
@@ -70,7 +81,7 @@ class NiuniuRedPacket:
         
         # 扣除用户金币
         user_data['coins'] -= amount
-        self._save_data()
+        self._save_data(group_id, user_id)
         
         # 生成红包ID
         packet_id = f"{int(time.time())}_{user_id}"
@@ -90,20 +101,12 @@ class NiuniuRedPacket:
             'participants': []
         }
         
-        # 设置红包过期任务
-        unified_msg_origin = event.unified_msg_origin
-        task_id = f"red_packet_{group_id}_{packet_id}"
-        task = asyncio.create_task(self._red_packet_expiration(
-            group_id=group_id,
-            packet_id=packet_id,
-            unified_msg_origin=unified_msg_origin
-        ))
-        
-        # 存储任务引用
-        self.tasks[task_id] = task
-        
-        # 设置清理回调
-        task.add_done_callback(lambda t: self.tasks.pop(task_id, None))
+        # 设置红包过期任务（5分钟），红包数据与任务共用同一个字典
+        self.plugin.scheduler.schedule(
+            self._job_id(group_id, packet_id), time.time() + 300, 'red_packet',
+            group_id, user_id, event.unified_msg_origin,
+            {'packet_id': packet_id, 'packet': self.red_packets[group_id][packet_id]}
+        )
         
         # 发送红包通知
         chain = [
@@ -119,8 +122,7 @@ class NiuniuRedPacket:
         nickname = event.get_sender_name()
         
         # 检查插件是否启用
-        group_data = self.plugin.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.plugin.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
         
@@ -140,37 +142,13 @@ class NiuniuRedPacket:
             yield event.plain_result("❌ 当前没有可抢的红包")
             return
         
-        # 获取最新的红包
-        packet_id, packet_data = self._get_latest_red_packet(group_id)
-        if not packet_data:
-            yield event.plain_result("❌ 当前没有可抢的红包")
-            return
-        
-        # 检查用户是否已经抢过这个红包
-        if user_id in packet_data['participants']:
-            yield event.plain_result("❌ 你已经抢过这个红包了")
-            return
-        
-        # 检查是否是发红包的人自己
-        if user_id == packet_data['sender']:
-            yield event.plain_result("❌ 不能抢自己的红包")
+        # 锁定抢红包的用户，同一用户的并发请求依次处理，不会重复领取
+        async with self.plugin.transaction(group_id, user_id):
+            error, after_tax, tax, packet_data = self._grab(group_id, user_id)
+        if error:
+            yield event.plain_result(error)
             return
         
-        # 计算获得的金币数量
-        amount_received = self._calculate_red_packet_amount(packet_data)
-        
-        # 计算税后金额
-        after_tax, tax = self.plugin.tax_system.process_coins(group_id, amount_received)
-        
-        # 更新红包数据
-        packet_data['remaining'] -= 1
-        packet_data['remaining_amount'] -= amount_received
-        packet_data['participants'].append(user_id)
-        
-        # 更新用户金币
-        user_data['coins'] = user_data.get('coins', 0) + after_tax
-        self._save_data()
-        
         # 发送抢红包成功通知
         chain = [
             At(qq=event.get_sender_id()),
@@ -186,11 +164,59 @@ class NiuniuRedPacket:
                 Plain(f"\n🧧 你发的红包已被抢完！")
             ]
             await self.context.send_message(event.unified_msg_origin, MessageChain(sender_chain))
-            
-            del self.red_packets[group_id][packet_id]
-            if not self.red_packets[group_id]:
-                del self.red_packets[group_id]
     
+    def _grab(self, group_id, user_id):
+        """领取最新的红包（需在事务内调用）
+
+        Returns:
+            (错误信息, 税后金额, 税款, 红包数据)，成功时错误信息为None
+        """
+        # 获取最新的红包
+        packet_id, packet_data = self._get_latest_red_packet(group_id)
+        if not packet_data or packet_data['remaining'] <= 0:
+            return "❌ 当前没有可抢的红包", 0, 0, None
+        
+        # 检查用户是否已经抢过这个红包
+        if user_id in packet_data['participants']:
+            return "❌ 你已经抢过这个红包了", 0, 0, None
+        
+        # 检查是否是发红包的人自己
+        if user_id == packet_data['sender']:
+            return "❌ 不能抢自己的红包", 0, 0, None
+        
+        # 计算获得的金币数量
+        amount_received = self._calculate_red_packet_amount(packet_data)
+        
+        # 计算税后金额
+        after_tax, tax = self.plugin.tax_system.process_coins(group_id, amount_received, user_id, 'red_packet_grab')
+        
+        # 更新用户金币
+        user_data = self.plugin.get_user_data(group_id, user_id)
+        user_data['coins'] = user_data.get('coins', 0) + after_tax
+        self.plugin.record_change(group_id, user_id, 'red_packet_grab', dcoins=after_tax)
+        self._save_data(group_id, user_id)
+        
+        # 红包数据在事务提交后再更新，事务撤销时红包保持原样
+        txn = Transaction.current(group_id)
+        if txn is not None:
+            txn.on_commit(lambda: self._take_share(group_id, packet_id, packet_data, user_id, amount_received))
+        else:
+            self._take_share(group_id, packet_id, packet_data, user_id, amount_received)
+        return None, after_tax, tax, packet_data
+
+    def _take_share(self, group_id, packet_id, packet_data, user_id, amount):
+        """从红包中扣除一份，红包被抢完时立即移除，之后的请求不会再领到这个红包"""
+        packet_data['remaining'] -= 1
+        packet_data['remaining_amount'] -= amount
+        packet_data['participants'].append(user_id)
+        if packet_data['remaining'] > 0:
+            self.plugin.scheduler.touch(self._job_id(group_id, packet_id))
+            return
+        self.plugin.scheduler.cancel(self._job_id(group_id, packet_id))
+        del self.red_packets[group_id][packet_id]
+        if not self.red_packets[group_id]:
+            del self.red_packets[group_id]
+
     def _get_latest_red_packet(self, group_id):
         """获取群内最新的红包"""
         if group_id not in self.red_packets or not self.red_packets[group_id]:
@@ -218,12 +244,10 @@ class NiuniuRedPacket:
         
         return random.randint(1, max_amount)
         
-    async def _red_packet_expiration(self, group_id, packet_id, unified_msg_origin):
+    async def _on_red_packet_expired(self, job):
         """处理红包过期"""
+        group_id, packet_id, unified_msg_origin = job.group_id, job.payload['packet_id'], job.origin
         try:
-            # 等待5分钟
-            await asyncio.sleep(300)  # 5分钟 = 300秒
-            
             # 检查红包是否仍然存在
             if (group_id in self.red_packets and 
                 packet_id in self.red_packets[group_id]):
@@ -239,7 +263,7 @@ class NiuniuRedPacket:
                     if sender_data:
                         # 更新金币
                         sender_data['coins'] = sender_data.get('coins', 0) + packet_data['remaining_amount']
-                        self._save_data()
+                        self._save_data(group_id, sender_id)
                         
                         # 发送提醒消息
                         try:
@@ -0,0 +1,96 @@
+import re
+from typing import Callable, Dict, Iterable, Optional, Union
+
+
+class Route:
+    """一条命令路由"""
+
+    __slots__ = ('name', 'handler', 'exact', 'pattern')
+
+    def __init__(self, name: str, handler: Callable, exact: bool = False, pattern=None):
+        self.name = name
+        self.handler = handler
+        self.exact = exact
+        self.pattern = re.compile(pattern) if isinstance(pattern, str) else pattern
+
+    def match(self, rest: str):
+        """匹配关键词之后的剩余部分，成功时返回传给处理函数的额外参数"""
+        if self.pattern is not None:
+            m = self.pattern.fullmatch(rest)
+            return None if m is None else (m,)
+        if self.exact and rest:
+            return None
+        return ()
+
+
+class CommandRouter:
+    """基于前缀树的命令路由
+
+    所有命令关键词（含别名）组成一棵前缀树，消息只需从头逐字沿树查找一次：
+    首字不是任何命令的开头时立即返回，绝大多数普通聊天消息不会进入任何处理逻辑。
+    多个关键词都是消息的前缀时，优先匹配最长的关键词（如“购买牛牛”优先于“购买”）。
+
+    每条路由可以是：
+    - 前缀匹配（默认）：消息以关键词开头即可
+    - 精确匹配（exact=True）：消息与关键词完全相同
+    - 参数匹配（pattern）：关键词之后的部分需完整匹配正则，匹配结果作为第二个参数传给处理函数
+    """
+
+    def __init__(self):
+        # 前缀树节点：{字符: 子节点}，路由列表保存在键None下
+        self._root: Dict = {}
+        self.hits: Dict[str, int] = {}
+
+    def add(self, keywords: Union[str, Iterable[str]], handler: Callable, exact: bool = False,
+            pattern=None, name: Optional[str] = None):
+        """注册命令
+
+        Args:
+            keywords: 命令关键词，多个关键词表示别名
+            handler: 处理函数，接收event（参数匹配时还会接收正则匹配结果），返回异步生成器
+            exact: 是否要求消息与关键词完全相同
+            pattern: 关键词之后参数部分的正则
+            name: 统计命中次数所用的名称，默认为第一个关键词
+        """
+        if isinstance(keywords, str):
+            keywords = [keywords]
+        keywords = list(keywords)
+        route = Route(name or keywords[0], handler, exact, pattern)
+        for keyword in keywords:
+            node = self._root
+            for ch in keyword:
+                node = node.setdefault(ch, {})
+            node.setdefault(None, []).append(route)
+        self.hits.setdefault(route.name, 0)
+
+    def match(self, msg: str):
+        """查找消息对应的命令
+
+        Returns:
+            (处理函数, 额外参数) 或 None
+        """
+        node = self._root.get(msg[:1]) if msg else None
+        if node is None:
+            return None
+        # 沿前缀树记录所有命中的关键词，再从最长的开始尝试
+        candidates = []
+        depth = 1
+        while node is not None:
+            if None in node:
+                candidates.append((depth, node[None]))
+            if depth >= len(msg):
+                break
+            node = node.get(msg[depth])
+            depth += 1
+        for depth, routes in reversed(candidates):
+            rest = msg[depth:]
+            for route in routes:
+                args = route.match(rest)
+                if args is not None:
+                    self.hits[route.name] += 1
+                    return route.handler, args
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        """各命令的命中次数（从高到低）"""
+        return dict(sorted(self.hits.items(), key=lambda item: item[1], reverse=True))
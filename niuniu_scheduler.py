@@ -0,0 +1,341 @@
+import os
+import copy
+import json
+import time
+import heapq
+import sqlite3
+import asyncio
+import itertools
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+from astrbot.api import logger
+
+
+class Job:
+    """定时任务
+
+    任务只包含可序列化的数据（不持有event等对象），发送消息所需的会话ID保存在origin中。
+    """
+
+    __slots__ = ('job_id', 'due', 'kind', 'group_id', 'user_id', 'origin', 'payload', 'cancelled')
+
+    def __init__(self, job_id: str, due: float, kind: str, group_id=None, user_id=None,
+                 origin: Optional[str] = None, payload: Optional[dict] = None):
+        self.job_id = job_id
+        self.due = due
+        self.kind = kind
+        self.group_id = None if group_id is None else str(group_id)
+        self.user_id = None if user_id is None else str(user_id)
+        self.origin = origin
+        self.payload = payload if payload is not None else {}
+        self.cancelled = False
+
+    def to_dict(self) -> dict:
+        return {
+            'job_id': self.job_id,
+            'due': self.due,
+            'kind': self.kind,
+            'group_id': self.group_id,
+            'user_id': self.user_id,
+            'origin': self.origin,
+            # payload 可能与业务数据共用，拷贝后才能交给线程池写入
+            'payload': copy.deepcopy(self.payload),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Job':
+        return cls(data['job_id'], data['due'], data['kind'], data.get('group_id'),
+                   data.get('user_id'), data.get('origin'), data.get('payload'))
+
+
+# 任务处理函数：返回新的到期时间表示继续执行（周期任务），返回None表示任务结束
+JobHandler = Callable[[Job], Awaitable[Optional[float]]]
+
+
+class Scheduler:
+    """集中式定时任务调度器
+
+    所有定时任务保存在一个按到期时间排序的最小堆中，由单个循环等待最早到期的任务。
+    插入为 O(log n)；取消采用延迟删除（只做标记，出堆时跳过），过期条目过多时重建堆。
+    """
+
+    def __init__(self, on_change: Optional[Callable[[str], None]] = None,
+                 claim: Optional[Callable[[Job], bool]] = None):
+        """初始化调度器
+
+        Args:
+            on_change: 任务发生变化（新增、修改、完成、取消）时以任务ID调用的回调，用于标记持久化
+            claim: 多进程部署时领取任务本次执行的回调，返回False表示已由其他进程执行
+        """
+        self._heap: List[tuple] = []
+        self._jobs: Dict[str, Job] = {}
+        # 正在执行的任务，执行完成前仍会被持久化
+        self._active: Dict[str, Job] = {}
+        self._handlers: Dict[str, JobHandler] = {}
+        self._counter = itertools.count()
+        self._stale = 0
+        self._wakeup = None
+        self._loop_task = None
+        self._running = set()
+        self._on_change = on_change
+        self._claim = claim
+
+    def register(self, kind: str, handler: JobHandler):
+        """注册某类任务的处理函数"""
+        self._handlers[kind] = handler
+
+    def load(self, jobs: List[dict]):
+        """加载持久化的任务（到期时间已过的任务会在启动后立即执行）"""
+        for data in jobs or []:
+            try:
+                self._push(Job.from_dict(data))
+            except Exception as e:
+                logger.error(f"加载定时任务失败: {str(e)}")
+
+    def _pending(self, job_id: str) -> Optional[Job]:
+        """待执行或执行中的任务"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            job = self._active.get(job_id)
+            if job is not None and job.cancelled:
+                job = None
+        return job
+
+    def dump(self) -> List[dict]:
+        """导出所有待执行（含执行中）的任务"""
+        jobs = {job_id: job for job_id, job in self._active.items() if not job.cancelled}
+        jobs.update(self._jobs)
+        return [job.to_dict() for job in jobs.values()]
+
+    def snapshot(self, keys=None):
+        """生成持久化快照
+
+        Returns:
+            (是否全量, [(job_id, 任务数据或None)])，None表示任务已结束需要删除
+        """
+        if keys is None:
+            return True, [(job['job_id'], job) for job in self.dump()]
+        changes = []
+        for job_id in keys:
+            job = self._pending(job_id)
+            changes.append((job_id, None if job is None else job.to_dict()))
+        return False, changes
+
+    def _push(self, job: Job):
+        old = self._jobs.get(job.job_id)
+        if old is not None:
+            old.cancelled = True
+            self._stale += 1
+        self._jobs[job.job_id] = job
+        heapq.heappush(self._heap, (job.due, next(self._counter), job))
+
+    def _changed(self, job_id: str):
+        if self._on_change is not None:
+            self._on_change(job_id)
+
+    def touch(self, job_id: str):
+        """任务数据（payload）被修改后调用，以便持久化"""
+        if self._pending(job_id) is not None:
+            self._changed(job_id)
+
+    def schedule(self, job_id: str, due: float, kind: str, group_id=None, user_id=None,
+                 origin: Optional[str] = None, payload: Optional[dict] = None) -> Job:
+        """安排一个任务，已存在同ID的任务时替换
+
+        Args:
+            job_id: 任务ID
+            due: 到期时间（时间戳）
+            kind: 任务类型，对应 register 注册的处理函数
+            group_id: 群ID
+            user_id: 用户ID
+            origin: 发送提醒所用的会话ID
+            payload: 任务数据（需可序列化）
+        """
+        job = Job(job_id, due, kind, group_id, user_id, origin, payload)
+        self._push(job)
+        self._changed(job_id)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """取消任务"""
+        active = self._active.get(job_id)
+        if active is not None:
+            # 执行中的周期任务不再继续安排
+            active.cancelled = True
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            if active is not None:
+                self._changed(job_id)
+            return active is not None
+        job.cancelled = True
+        self._stale += 1
+        if self._stale > len(self._jobs) and self._stale > 64:
+            self._rebuild()
+        self._changed(job_id)
+        return True
+
+    def _rebuild(self):
+        """清除堆中已取消的条目"""
+        self._heap = [entry for entry in self._heap if not entry[2].cancelled]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """获取待执行的任务"""
+        return self._jobs.get(job_id)
+
+    def jobs(self, kind: Optional[str] = None) -> List[Job]:
+        """获取所有（或某类）待执行的任务"""
+        return [job for job in self._jobs.values() if kind is None or job.kind == kind]
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def start(self):
+        """启动调度循环（所有模块注册处理函数后调用）"""
+        if self._loop_task is None:
+            self._wakeup = asyncio.Event()
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                # 丢弃堆顶已取消的条目
+                while self._heap and self._heap[0][2].cancelled:
+                    heapq.heappop(self._heap)
+                    self._stale = max(0, self._stale - 1)
+
+                self._wakeup.clear()
+                if not self._heap:
+                    await self._wakeup.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+
+                _, _, job = heapq.heappop(self._heap)
+                if job.cancelled:
+                    self._stale = max(0, self._stale - 1)
+                    continue
+                del self._jobs[job.job_id]
+                self._active[job.job_id] = job
+                task = asyncio.create_task(self._execute(job))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"定时任务调度异常: {str(e)}")
+                await asyncio.sleep(1)
+
+    async def _execute(self, job: Job):
+        handler = self._handlers.get(job.kind)
+        next_due = None
+        try:
+            claimed = self._claim is None or self._claim(job)
+        except Exception as e:
+            logger.error(f"领取定时任务 {job.job_id} 失败: {str(e)}")
+            claimed, next_due = False, time.time() + 60
+        if not claimed:
+            # 已由其他进程执行（周期任务的后续安排也由该进程负责），领取出错时稍后重试
+            if next_due is None:
+                logger.debug(f"定时任务 {job.job_id} 已由其他进程执行")
+                # 只移出本进程内存，不标记变更：任务表中的记录归执行的进程所有，
+                # 删除会把它刚安排的下一次执行一并删掉
+                if self._active.get(job.job_id) is job:
+                    del self._active[job.job_id]
+                return
+        elif handler is None:
+            logger.error(f"未知的定时任务类型: {job.kind}")
+        else:
+            try:
+                next_due = await handler(job)
+            except asyncio.CancelledError:
+                # 调度器关闭，任务保留在持久化数据中，下次启动时重新执行
+                raise
+            except Exception as e:
+                logger.error(f"定时任务 {job.job_id} 执行异常: {str(e)}")
+        if self._active.get(job.job_id) is job:
+            del self._active[job.job_id]
+        # 周期任务：处理期间未被替换或取消时继续安排
+        if next_due is not None and not job.cancelled and job.job_id not in self._jobs:
+            job.due = next_due
+            self._push(job)
+            if self._wakeup is not None:
+                self._wakeup.set()
+        self._changed(job.job_id)
+
+    def shutdown(self):
+        """停止调度循环（未执行的任务保留在持久化数据中）"""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            self._loop_task = None
+        for task in list(self._running):
+            task.cancel()
+
+
+class JobStore:
+    """定时任务的SQLite存储
+
+    每个待执行的任务一行，按到期时间建立索引；任务完成或取消后删除对应行，
+    启动时按到期时间顺序读取剩余的任务即可恢复，无需扫描业务数据。
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'job_id TEXT PRIMARY KEY, due REAL NOT NULL, kind TEXT NOT NULL, '
+            'group_id TEXT, user_id TEXT, origin TEXT, payload TEXT NOT NULL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_jobs_due ON jobs (due)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+
+    def load(self) -> List[dict]:
+        """按到期时间顺序读取所有待执行的任务"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT job_id, due, kind, group_id, user_id, origin, payload FROM jobs ORDER BY due'
+            ).fetchall()
+        return [{
+            'job_id': job_id, 'due': due, 'kind': kind, 'group_id': group_id,
+            'user_id': user_id, 'origin': origin, 'payload': json.loads(payload),
+        } for job_id, due, kind, group_id, user_id, origin, payload in rows]
+
+    def write(self, payload):
+        """写入 Scheduler.snapshot 生成的快照（可在线程池中执行）"""
+        full, changes = payload
+        upserts = [(job['job_id'], job['due'], job['kind'], job['group_id'], job['user_id'],
+                    job['origin'], json.dumps(job['payload'], ensure_ascii=False))
+                   for _, job in changes if job is not None]
+        deletes = [(job_id,) for job_id, job in changes if job is None]
+        with self._lock, self._conn:
+            if full:
+                self._conn.execute('DELETE FROM jobs')
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO jobs (job_id, due, kind, group_id, user_id, origin, payload) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)', upserts)
+            self._conn.executemany('DELETE FROM jobs WHERE job_id = ?', deletes)
+
+    def get_flag(self, key: str) -> bool:
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM meta WHERE key = ?', (key,)).fetchone() is not None
+
+    def set_flag(self, key: str):
+        with self._lock, self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, '1'))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
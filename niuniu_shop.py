@@ -26,14 +26,23 @@ class NiuniuShop:
         self.context = niuniu_plugin.context
         self.niuniu_lengths = niuniu_plugin.niuniu_lengths
         self.last_actions = niuniu_plugin.last_actions
-        # 存储各种定时任务的引用
-        self.tasks = {}
-        # 移除贞操锁监控任务的启动
-        asyncio.create_task(self.monitor_gender_surgeries())
+        # 注册定时任务
+        niuniu_plugin.scheduler.register('gender_restore', self._on_gender_restore)
+        niuniu_plugin.scheduler.register('spring_fairy', self._on_spring_fairy)
+        niuniu_plugin.scheduler.register('parasite_expire', self._on_parasite_expired)
+        # 注册命令（集市的“购买牛牛”是更长的关键词，会优先匹配）
+        niuniu_plugin.router.add('购买', self.process_purchase_command)
+        niuniu_plugin.router.add(('解锁绝育', '解除绝育'), self.unlock_sterilization, exact=True)
+        niuniu_plugin.router.add('牛牛背包', self.show_backpack)
     
-    def _save_data(self):
-        """保存数据"""
-        self.plugin._save_niuniu_lengths()
+    def _save_data(self, group_id=None, *user_ids):
+        """保存数据
+
+        Args:
+            group_id: 发生变化的群，为None表示全部数据
+            *user_ids: 发生变化的用户
+        """
+        self.plugin._save_niuniu_lengths(group_id, *user_ids)
         self.plugin._save_last_actions()
     
     def get_shop_text(self, user_coins):
@@ -96,7 +105,7 @@ class NiuniuShop:
         if asyncio.iscoroutine(result):
             result = await result
             
-        self._save_data()
+        self._save_data(group_id, user_id)
         
         if isinstance(result, str):
             yield event.plain_result(result)
@@ -171,41 +180,10 @@ class NiuniuShop:
         }
         # 设置长度为0
         user_data['length'] = 0
-        self._save_data()
-        
-        # 创建定时任务24小时后恢复
-        async def restore_gender():
-            # 计算睡眠时间
-            sleep_seconds = (end_time - datetime.datetime.now()).total_seconds()
-            if sleep_seconds > 0:
-                await asyncio.sleep(sleep_seconds)
-                
-            try:
-                user_data = self.plugin.get_user_data(group_id, user_id)
-                if user_data and 'gender_surgery' in user_data:
-                    original_length = user_data['gender_surgery']['original_length']
-                    # 在恢复前保存当前洞洞深度
-                    current_hole_depth = user_data['gender_surgery'].get('hole_depth', 0)
-                    user_data['saved_hole_depth'] = current_hole_depth
-                    
-                    user_data['length'] = original_length
-                    del user_data['gender_surgery']
-                    self._save_data()
-                    
-                    # 发送恢复消息
-                    try:
-                        message_chain = MessageChain([
-                            At(qq=user_id),
-                            Plain(f"\n小南娘：你的洞洞已经变回牛牛了哦，长度为 {self.plugin.format_length(original_length)}")
-                        ])
-                        await self.context.send_message(event.unified_msg_origin, message_chain)
-                    except Exception as e:
-                        print(f"发送牛牛恢复消息失败: {str(e)}")
-            except Exception as e:
-                print(f"恢复牛牛失败: {str(e)}")
-                
-        task = asyncio.create_task(restore_gender())
-        self.tasks[f"gender_surgery_{group_id}_{user_id}"] = task
+        self._save_data(group_id, user_id)
+        
+        # 24小时后恢复
+        self._schedule_gender_restore(group_id, user_id, end_time.timestamp(), event.unified_msg_origin)
         
         # 添加现有洞洞深度信息到返回消息
         depth_msg = f"\n🕳️ 继承之前的洞洞深度: {previous_hole_depth}cm" if previous_hole_depth > 0 else ""
@@ -213,6 +191,53 @@ class NiuniuShop:
         return f"✅ 手术成功！你的牛牛变成了洞洞(0cm)，24小时后会恢复为 {self.plugin.format_length(original_length)}{depth_msg}\n" \
                f"💰 期间打工金币翻倍！"
                
+    def _schedule_gender_restore(self, group_id, user_id, end_time, unified_msg_origin):
+        self.plugin.scheduler.schedule(
+            f"gender_restore:{group_id}:{user_id}", end_time, 'gender_restore',
+            group_id, user_id, unified_msg_origin
+        )
+
+    def restore_gender_surgery_jobs(self):
+        """为旧版本中没有定时任务的变性手术补建恢复任务"""
+        # 分片布局下启动时还没有加载任何群，需要逐个读取分片
+        for group_id, group_data in self.plugin.iter_all_groups():
+            for user_id, user_data in group_data.items():
+                if not isinstance(user_data, dict) or not isinstance(user_data.get('gender_surgery'), dict):
+                    continue
+                if self.plugin.scheduler.get(f"gender_restore:{group_id}:{user_id}"):
+                    continue
+                # 旧数据没有保存会话ID，到期时只恢复长度
+                self._schedule_gender_restore(group_id, user_id, user_data['gender_surgery'].get('end_time', 0), None)
+
+    async def _on_gender_restore(self, job):
+        """变性手术到期：恢复牛牛长度并提醒"""
+        group_id, user_id = job.group_id, job.user_id
+        try:
+            user_data = self.plugin.get_user_data(group_id, user_id)
+            if user_data and 'gender_surgery' in user_data:
+                original_length = user_data['gender_surgery']['original_length']
+                # 在恢复前保存当前洞洞深度
+                current_hole_depth = user_data['gender_surgery'].get('hole_depth', 0)
+                user_data['saved_hole_depth'] = current_hole_depth
+                
+                user_data['length'] = original_length
+                del user_data['gender_surgery']
+                self._save_data(group_id, user_id)
+                
+                # 发送恢复消息
+                if not job.origin:
+                    return None
+                try:
+                    message_chain = MessageChain([
+                        At(qq=user_id),
+                        Plain(f"\n小南娘：你的洞洞已经变回牛牛了哦，长度为 {self.plugin.format_length(original_length)}")
+                    ])
+                    await self.context.send_message(job.origin, message_chain)
+                except Exception as e:
+                    print(f"发送牛牛恢复消息失败: {str(e)}")
+        except Exception as e:
+            print(f"恢复牛牛失败: {str(e)}")
+
     def _prepare_exchange(self, user_data, group_id, user_id):
         """牛子转换器购买准备"""
         items = user_data.setdefault('items', {})
@@ -232,95 +257,83 @@ class NiuniuShop:
             'end_time': time.time() + 3600  # 1小时后结束
         }
         
-        nickname = event.get_sender_name()
-        
-        # 创建异步任务处理自动打胶
-        async def auto_dajiao():
-            end_time = time.time() + 3600
-            next_check = time.time() + 10  # 开始时10秒后检查
-            
-            while time.time() < end_time:
-                await asyncio.sleep(max(1, next_check - time.time()))
-                
-                try:
-                    # 检查是否仍有效
-                    updated_user_data = self.plugin.get_user_data(group_id, user_id)
-                    if not updated_user_data or 'spring_fairy' not in updated_user_data.get('items', {}):
-                        break
-                    
-                    # 检查用户是否变性了，如果变性则停止效果
-                    if self.is_gender_surgery_active(group_id, user_id):
-                        # 移除春风精灵效果
-                        if 'spring_fairy' in updated_user_data.get('items', {}):
-                            del updated_user_data['items']['spring_fairy']
-                            self._save_data()
-                            
-                            try:
-                                message_chain = MessageChain([
-                                    At(qq=user_id),
-                                    Plain(f"\n🧚 由于你变性了，春风精灵效果已自动结束")
-                                ])
-                                await self.context.send_message(event.unified_msg_origin, message_chain)
-                            except Exception as e:
-                                print(f"发送春风精灵效果结束消息失败: {str(e)}")
-                        break
-                        
-                    current_time = time.time()
-                    last_dajiao = self.last_actions.get(group_id, {}).get(user_id, {}).get('dajiao', 0)
-                    cooldown = self.plugin.COOLDOWN_10_MIN
-                    
-                    # 如果冷却已完成
-                    if current_time - last_dajiao >= cooldown:
-                        # 模拟打胶效果
-                        change = random.randint(2, 5)  # 固定增加长度
-                        updated_user_data['length'] += change
-                        self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})['dajiao'] = current_time
-                        self._save_data()
-                        
-                        # 发送提醒消息
-                        try:
-                            message_chain = MessageChain([
-                                At(qq=user_id),
-                                Plain(f"\n🧚 春风精灵帮你打胶成功！\n📏 长度增加: +{change}cm\n"
-                                      f"💪 当前长度: {self.plugin.format_length(updated_user_data['length'])}")
-                            ])
-                            await self.context.send_message(event.unified_msg_origin, message_chain)
-                        except Exception as e:
-                            print(f"发送自动打胶提醒失败: {str(e)}")
-                            
-                        # 计算下次冷却完成时间
-                        next_check = current_time + cooldown
-                    else:
-                        # 计算下次检查时间
-                        next_check = last_dajiao + cooldown
-                except Exception as e:
-                    print(f"自动打胶出错: {str(e)}")
-                    next_check = time.time() + 60  # 出错后1分钟再检查
-                    
-            # 效果结束时移除春风精灵
-            try:
-                final_user_data = self.plugin.get_user_data(group_id, user_id)
-                if final_user_data and 'spring_fairy' in final_user_data.get('items', {}):
-                    del final_user_data['items']['spring_fairy']
-                    self._save_data()
-                    
-                    # 发送效果结束消息
-                    try:
-                        message_chain = MessageChain([
-                            At(qq=user_id),
-                            Plain(f"\n🧚 春风精灵效果已结束")
-                        ])
-                        await self.context.send_message(event.unified_msg_origin, message_chain)
-                    except Exception as e:
-                        print(f"发送春风精灵效果结束消息失败: {str(e)}")
-            except Exception as e:
-                print(f"清理春风精灵数据失败: {str(e)}")
-                
-        task = asyncio.create_task(auto_dajiao())
-        self.tasks[f"spring_fairy_{group_id}_{user_id}"] = task
+        # 开始时10秒后检查，之后每次冷却完毕时自动打胶
+        self.plugin.scheduler.schedule(
+            f"spring_fairy:{group_id}:{user_id}", time.time() + 10, 'spring_fairy',
+            group_id, user_id, event.unified_msg_origin,
+            {'end_time': user_data['items']['spring_fairy']['end_time']}
+        )
         
         return "✅ 购买成功！春风精灵将在1小时内帮你自动打胶"
         
+    async def _send_fairy_message(self, job, text):
+        try:
+            message_chain = MessageChain([At(qq=job.user_id), Plain(text)])
+            await self.context.send_message(job.origin, message_chain)
+        except Exception as e:
+            print(f"发送春风精灵消息失败: {str(e)}")
+
+    async def _on_spring_fairy(self, job):
+        """春风精灵：冷却完毕时自动打胶，返回下次检查时间"""
+        group_id, user_id = job.group_id, job.user_id
+        end_time = job.payload.get('end_time', 0)
+        
+        # 检查是否仍有效
+        user_data = self.plugin.get_user_data(group_id, user_id)
+        if not user_data or 'spring_fairy' not in user_data.get('items', {}):
+            return None
+        
+        # 效果结束时移除春风精灵
+        if time.time() >= end_time:
+            del user_data['items']['spring_fairy']
+            self._save_data(group_id, user_id)
+            await self._send_fairy_message(job, f"\n🧚 春风精灵效果已结束")
+            return None
+        
+        # 检查用户是否变性了，如果变性则停止效果
+        if self.is_gender_surgery_active(group_id, user_id):
+            del user_data['items']['spring_fairy']
+            self._save_data(group_id, user_id)
+            await self._send_fairy_message(job, f"\n🧚 由于你变性了，春风精灵效果已自动结束")
+            return None
+        
+        try:
+            cooldown = self.plugin.COOLDOWN_10_MIN
+            # 锁定用户后检查冷却并打胶，与用户自己的命令依次处理
+            async with self.plugin.transaction(group_id, user_id):
+                # 多进程部署时事务开始会同步用户数据，需要重新读取
+                user_data = self.plugin.get_user_data(group_id, user_id)
+                current_time = time.time()
+                last_dajiao = self.last_actions.get(group_id, {}).get(user_id, {}).get('dajiao', 0)
+                ready = current_time - last_dajiao >= cooldown
+                if ready:
+                    # 模拟打胶效果
+                    change = random.randint(2, 5)  # 固定增加长度
+                    user_data['length'] += change
+                    self.last_actions.setdefault(group_id, {}).setdefault(user_id, {})['dajiao'] = current_time
+                    self.plugin.record_change(group_id, user_id, 'spring_fairy', dlen=change)
+                    self._save_data(group_id, user_id)
+            
+            # 如果冷却已完成
+            if ready:
+                # 发送提醒消息
+                await self._send_fairy_message(
+                    job,
+                    f"\n🧚 春风精灵帮你打胶成功！\n📏 长度增加: +{change}cm\n"
+                    f"💪 当前长度: {self.plugin.format_length(user_data['length'])}"
+                )
+                # 计算下次冷却完成时间
+                next_check = current_time + cooldown
+            else:
+                # 计算下次检查时间
+                next_check = last_dajiao + cooldown
+        except Exception as e:
+            print(f"自动打胶出错: {str(e)}")
+            next_check = time.time() + 60  # 出错后1分钟再检查
+        
+        # 到期时再执行一次以结束效果
+        return max(time.time() + 1, min(next_check, end_time))
+
     async def _handle_mystery_box(self, user_data, group_id, user_id, event):
         """神秘礼盒效果处理"""
         # 50%概率获得商品，50%概率获得金币
@@ -404,7 +417,7 @@ class NiuniuShop:
             original_length = user_data['gender_surgery']['original_length']
             user_data['length'] = original_length
             del user_data['gender_surgery']
-            self._save_data()
+            self._save_data(group_id, user_id)
             return False
             
         return True
@@ -427,14 +440,7 @@ class NiuniuShop:
             target_name = msg[len(command_prefix):].strip()
             if target_name:
                 group_id = str(event.message_obj.group_id)
-                group_data = self.plugin.get_group_data(group_id)
-                # 遍历查找匹配的用户名
-                for user_id, user_data in group_data.items():
-                    if not isinstance(user_data, dict):
-                        continue
-                    nickname = user_data.get('nickname', '')
-                    if nickname and target_name in nickname:
-                        return user_id
+                return self.plugin.nickname_index.find(group_id, target_name)
         return None
         
     def use_viagra_for_dajiao(self, group_id, user_id):
@@ -454,7 +460,7 @@ class NiuniuShop:
         if remaining <= 0:
             del user_data['items']['viagra']
             
-        self._save_data()
+        self._save_data(group_id, user_id)
         return remaining  # 返回剩余次数
 
     async def process_purchase_command(self, event):
@@ -464,8 +470,7 @@ class NiuniuShop:
         nickname = event.get_sender_name()
         
         # 检查插件是否启用
-        group_data = self.plugin.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.plugin.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
             
@@ -528,60 +533,6 @@ class NiuniuShop:
         
         return f"{hours}小时{minutes}分钟"
     
-    # 删除贞操锁监控任务
-    async def monitor_gender_surgeries(self):
-        """监控并处理过期的变性手术"""
-        while True:
-            try:
-                now = time.time()
-                for group_id, group_data in self.plugin.niuniu_lengths.items():
-                    if not isinstance(group_data, dict):
-                        continue
-                        
-                    for user_id, user_data in group_data.items():
-                        if not isinstance(user_data, dict) or 'gender_surgery' not in user_data:
-                            continue
-                            
-                        surgery_data = user_data['gender_surgery']
-                        if not isinstance(surgery_data, dict):
-                            del user_data['gender_surgery']
-                            self._save_data()
-                            continue
-                            
-                        end_time = surgery_data.get('end_time', 0)
-                        
-                        if end_time and now > end_time:
-                            # 变性手术过期，恢复长度
-                            original_length = surgery_data.get('original_length', 10)
-                            
-                            # 保存当前的洞洞深度
-                            current_hole_depth = surgery_data.get('hole_depth', 0)
-                            user_data['saved_hole_depth'] = current_hole_depth
-                            
-                            user_data['length'] = original_length
-                            del user_data['gender_surgery']
-                            self._save_data()
-                            
-                            try:
-                                # 构建消息链
-                                message_chain = MessageChain([
-                                    At(qq=user_id),
-                                    Plain(f"\n小南娘：你的洞洞已经变回牛牛了哦，长度为 {self.plugin.format_length(original_length)}")
-                                ])
-                                # 获取该群的第一个会话ID
-                                for event in self.context.unified_msg_list:
-                                    if str(event.message_obj.group_id) == str(group_id):
-                                        unified_msg = event.unified_msg_origin
-                                        await self.context.send_message(unified_msg, message_chain)
-                                        break
-                            except Exception as e:
-                                print(f"发送变性结束提醒失败: {str(e)}")
-                            
-            except Exception as e:
-                print(f"监控变性手术时出错: {str(e)}")
-                
-            await asyncio.sleep(600)
-    
     def get_spring_fairy_time_left(self, group_id, user_id):
         """获取春风精灵剩余时间文本"""
         user_data = self.plugin.get_user_data(group_id, user_id)
@@ -614,8 +565,7 @@ class NiuniuShop:
         nickname = event.get_sender_name()
 
         # 检查插件是否启用
-        group_data = self.plugin.get_group_data(group_id)
-        if not group_data.get('plugin_enabled', False):
+        if not self.plugin.is_plugin_enabled(group_id):
             yield event.plain_result("❌ 插件未启用")
             return
 
@@ -715,7 +665,7 @@ class NiuniuShop:
         # 增加洞洞深度
         surgery_data['hole_depth'] += depth_increase
         target_data['gender_surgery'] = surgery_data
-        self._save_data()
+        self._save_data(group_id, target_id)
         
         # 显示结果
         yield event.plain_result(f"💦 {target_nickname}被{nickname}扣爽了，洞洞深了{depth_increase}cm！\n现在洞洞深度: {surgery_data['hole_depth']}cm")
@@ -770,7 +720,7 @@ class NiuniuShop:
         if current_time > parasite_info['end_time']:
             # 寄生已过期，清除信息
             del user_data['parasite_info']
-            self._save_data()
+            self._save_data(group_id, user_id)
             return False, None
             
         return True, parasite_info['parasite_owner']
@@ -800,7 +750,7 @@ class NiuniuShop:
         # 扣钱并解锁
         user_data['coins'] -= cost
         user_data['items']['sterilized'] = False
-        self._save_data()
+        self._save_data(group_id, user_id)
 
         yield event.plain_result(f"🔓 {nickname} 成功解锁了绝育，现在可以自由打胶啦！\n💸 扣除{cost}金币")
 
@@ -816,7 +766,7 @@ class NiuniuShop:
         
         if remaining <= 0:
             del user_data['parasite_info']
-            self._save_data()
+            self._save_data(group_id, user_id)
             return None
             
         hours = int(remaining // 3600)
@@ -860,11 +810,23 @@ class NiuniuShop:
         if 'parasite' in user_data.get('items', {}):
             del user_data['items']['parasite']
             
-        self._save_data()
+        self._save_data(group_id, user_id, target_id)
+        # 到期时清除寄生效果
+        self.plugin.scheduler.schedule(
+            f"parasite:{group_id}:{target_id}", end_time, 'parasite_expire', group_id, target_id
+        )
         
         yield event.plain_result(f"🦠 {nickname} 成功将寄生虫放入了 {target_data['nickname']} 的牛牛中！\n"
                                f"接下来24小时内，ta牛牛增长的50%都会被你窃取！")
 
+    async def _on_parasite_expired(self, job):
+        """寄生虫到期：清除寄生效果"""
+        user_data = self.plugin.get_user_data(job.group_id, job.user_id)
+        parasite_info = user_data.get('parasite_info') if user_data else None
+        if parasite_info and time.time() >= parasite_info.get('end_time', 0):
+            del user_data['parasite_info']
+            self._save_data(job.group_id, job.user_id)
+
     async def use_sterilization(self, event, target_id):
         """使用绝育环"""
         group_id = str(event.message_obj.group_id)
@@ -897,7 +859,7 @@ class NiuniuShop:
         if 'items' in user_data and 'sterilization_ring' in user_data['items']:
             del user_data['items']['sterilization_ring']
             
-        self._save_data()
+        self._save_data(group_id, user_id, target_id)
         
         target_nickname = target_data['nickname']
         yield event.plain_result(f"🔒 {nickname} 成功给 {target_nickname} 戴上了绝育环！\n"
@@ -929,25 +891,26 @@ class NiuniuShop:
             yield event.plain_result("❌ 你正处于变性状态，无法调换牛牛长度")
             return
 
-        # 获取数据
-        user_data = self.plugin.get_user_data(group_id, user_id)
-        user_length = user_data['length']
-        target_length = target_data['length']
-        target_nickname = target_data['nickname']
+        # 锁定双方后调换，避免与其他修改长度的命令交错
+        async with self.plugin.transaction(group_id, user_id, target_id):
+            user_data = self.plugin.get_user_data(group_id, user_id)
+            target_data = self.plugin.get_user_data(group_id, target_id)
+            user_length = user_data['length']
+            target_length = target_data['length']
+            target_nickname = target_data['nickname']
 
-        if random.random() <= 0.05:
-            user_data['length'] = target_length
-            target_data['length'] = user_length
+            success = random.random() <= 0.05
+            if success:
+                user_data['length'] = target_length
+                target_data['length'] = user_length
             if 'exchanger' in user_data.get('items', {}):
                 del user_data['items']['exchanger']
-            self._save_data()
+
+        if success:
             yield event.plain_result(f"🔄 {nickname} 使用牛子转换器与 {target_nickname} 的牛牛长度调换成功！\n"
                                      f"你的牛牛长度：{self.plugin.format_length(target_length)}\n"
                                      f"{target_nickname} 的牛牛长度：{self.plugin.format_length(user_length)}")
         else:
-            if 'exchanger' in user_data.get('items', {}):
-                del user_data['items']['exchanger']
-            self._save_data()
             yield event.plain_result(f"💥 {nickname} 使用牛子转换器试图调换 {target_nickname} 的牛牛长度，但失败了！\n"
                                      f"💸 道具已失效，牛牛保持不变")
 
@@ -0,0 +1,440 @@
+import os
+import copy
+import json
+import sqlite3
+import time
+import threading
+from urllib.parse import quote, unquote
+from astrbot.api import logger
+
+
+class NiuniuStorage:
+    """牛牛数据存储后端基类
+
+    数据结构与原插件保持一致：{group_id: {'plugin_enabled': bool, user_id: {...}}}
+    群字典中非字典类型的值视为群设置，字典类型的值视为用户数据。
+    """
+
+    # 是否以数据文件保存（受 data_format 影响）
+    file_based = False
+
+    def load(self) -> dict:
+        """加载全部数据"""
+        raise NotImplementedError
+
+    def snapshot(self, data: dict, keys=None):
+        """在事件循环中生成待写入的快照
+
+        Args:
+            data: 当前内存中的全部数据
+            keys: 发生变化的 (group_id, user_id) 集合，user_id为None表示整个群；
+                  keys为None表示全量
+        """
+        return copy.deepcopy(data)
+
+    def write(self, payload):
+        """把快照写入磁盘，可在线程池中执行"""
+        raise NotImplementedError
+
+    def save(self, data: dict):
+        """同步保存全部数据"""
+        self.write(self.snapshot(data))
+
+    def save_user(self, data: dict, group_id: str, user_id: str):
+        """同步保存单个用户"""
+        self.write(self.snapshot(data, {(str(group_id), str(user_id))}))
+
+    def close(self):
+        """释放资源"""
+        pass
+
+
+class FileStorage(NiuniuStorage):
+    """整文件存储，格式由编解码器决定（YAML格式与原插件的 niuniu_lengths.yml 完全兼容）"""
+
+    file_based = True
+
+    def __init__(self, codec, base_path: str):
+        self.codec = codec
+        self.base_path = base_path
+
+    def load(self) -> dict:
+        data = self.codec.load(self.base_path, lambda d: isinstance(d, dict))
+        if data is None:
+            self.save({})
+            return {}
+        return data
+
+    def write(self, payload):
+        self.codec.write(self.base_path, payload)
+
+
+class SqliteStorage(NiuniuStorage):
+    """SQLite存储，每个用户一行，使用WAL日志
+
+    全量保存时会与上次写入的内容比对，只写入发生变化的行；
+    save_user 则直接只写入指定用户。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS groups ('
+            'group_id TEXT PRIMARY KEY, settings TEXT NOT NULL)'
+        )
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS users ('
+            'group_id TEXT NOT NULL, user_id TEXT NOT NULL, data TEXT NOT NULL, '
+            'PRIMARY KEY (group_id, user_id))'
+        )
+        self._conn.commit()
+        # 上次写入的行内容 {(group_id, user_id or None): json}
+        self._rows = {}
+
+    @staticmethod
+    def _split_group(group_data) -> tuple:
+        """拆分群设置与用户数据"""
+        settings, users = {}, {}
+        if isinstance(group_data, dict):
+            for key, value in group_data.items():
+                if isinstance(value, dict):
+                    users[str(key)] = value
+                else:
+                    settings[str(key)] = value
+        return settings, users
+
+    @staticmethod
+    def _dumps(value) -> str:
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+    def is_empty(self) -> bool:
+        """数据库中是否还没有任何数据"""
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM groups LIMIT 1').fetchone()
+        return row is None
+
+    def load(self) -> dict:
+        data = {}
+        rows = {}
+        with self._lock:
+            for group_id, settings in self._conn.execute('SELECT group_id, settings FROM groups'):
+                data[group_id] = json.loads(settings)
+                rows[(group_id, None)] = settings
+            for group_id, user_id, user_data in self._conn.execute('SELECT group_id, user_id, data FROM users'):
+                data.setdefault(group_id, {})[user_id] = json.loads(user_data)
+                rows[(group_id, user_id)] = user_data
+        self._rows = rows
+        return data
+
+    def snapshot(self, data: dict, keys=None):
+        """只序列化发生变化的行，返回 (upsert_groups, upsert_users, removed)"""
+        upsert_groups, upsert_users, removed = [], [], []
+        if keys is None:
+            targets = {str(group_id): None for group_id in data}
+            removed = [key for key in self._rows if key[0] not in targets]
+        else:
+            targets = {}
+            for group_id, user_id in keys:
+                group_id = str(group_id)
+                if user_id is None:
+                    targets[group_id] = None
+                elif targets.get(group_id, ()) is not None:
+                    targets.setdefault(group_id, set()).add(str(user_id))
+
+        for group_id, user_ids in targets.items():
+            group_data = data.get(group_id)
+            settings, users = self._split_group(group_data)
+            if group_data is None:
+                removed.append((group_id, None))
+                removed.extend(key for key in self._rows if key[0] == group_id and key[1] is not None)
+                continue
+            encoded = self._dumps(settings)
+            if self._rows.get((group_id, None)) != encoded:
+                upsert_groups.append((group_id, encoded))
+            if user_ids is None:
+                # 整个群：比对所有用户并找出被删除的用户
+                user_ids = set(users)
+                removed.extend(key for key in self._rows
+                               if key[0] == group_id and key[1] is not None and key[1] not in users)
+            for user_id in user_ids:
+                if user_id not in users:
+                    if (group_id, user_id) in self._rows:
+                        removed.append((group_id, user_id))
+                    continue
+                encoded = self._dumps(users[user_id])
+                if self._rows.get((group_id, user_id)) != encoded:
+                    upsert_users.append((group_id, user_id, encoded))
+        return upsert_groups, upsert_users, removed
+
+    def write(self, payload):
+        upsert_groups, upsert_users, removed = payload
+        if not (upsert_groups or upsert_users or removed):
+            return
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO groups (group_id, settings) VALUES (?, ?)', upsert_groups)
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO users (group_id, user_id, data) VALUES (?, ?, ?)', upsert_users)
+            for group_id, user_id in removed:
+                if user_id is None:
+                    self._conn.execute('DELETE FROM groups WHERE group_id = ?', (group_id,))
+                else:
+                    self._conn.execute('DELETE FROM users WHERE group_id = ? AND user_id = ?', (group_id, user_id))
+
+            for group_id, encoded in upsert_groups:
+                self._rows[(group_id, None)] = encoded
+            for group_id, user_id, encoded in upsert_users:
+                self._rows[(group_id, user_id)] = encoded
+            for key in removed:
+                self._rows.pop(key, None)
+
+    def import_file(self, codec, base_path: str) -> bool:
+        """从原插件的数据文件一次性导入数据（仅在数据库为空时执行）
+
+        Returns:
+            bool: 是否执行了导入
+        """
+        if not self.is_empty():
+            return False
+        data = codec.load(base_path, lambda d: isinstance(d, dict))
+        if not data:
+            return False
+        self.save(data)
+        logger.info(f"已从 {base_path} 导入 {len(data)} 个群的牛牛数据")
+        return True
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def normalize_group(group_data) -> dict:
+    """校验单个群的数据结构"""
+    if not isinstance(group_data, dict):
+        return {'plugin_enabled': False}
+    group_data.setdefault('plugin_enabled', False)
+    return group_data
+
+
+class ShardedGroups(dict):
+    """按群懒加载的数据字典
+
+    首次访问某个群（in / [] / get）时才从分片加载，并记录最近访问时间供淘汰使用；
+    items()/keys() 等遍历操作只包含当前已加载的群。
+    """
+
+    def __init__(self, storage: 'ShardedStorage'):
+        super().__init__()
+        self._storage = storage
+        self.last_access = {}
+
+    def _ensure(self, group_id) -> bool:
+        group_id = str(group_id)
+        if not dict.__contains__(self, group_id):
+            group_data = self._storage.load_group(group_id)
+            if group_data is None:
+                return False
+            dict.__setitem__(self, group_id, normalize_group(group_data))
+        self.last_access[group_id] = time.monotonic()
+        return True
+
+    def __contains__(self, group_id):
+        return self._ensure(group_id)
+
+    def __getitem__(self, group_id):
+        if not self._ensure(group_id):
+            raise KeyError(group_id)
+        return dict.__getitem__(self, str(group_id))
+
+    def __setitem__(self, group_id, group_data):
+        group_id = str(group_id)
+        dict.__setitem__(self, group_id, group_data)
+        self.last_access[group_id] = time.monotonic()
+
+    def get(self, group_id, default=None):
+        return self[group_id] if self._ensure(group_id) else default
+
+    def peek(self, group_id):
+        """获取已加载的群数据，不触发加载"""
+        return dict.get(self, str(group_id))
+
+    def idle_groups(self, ttl: float) -> list:
+        """超过ttl秒未访问的已加载群"""
+        deadline = time.monotonic() - ttl
+        return [group_id for group_id in dict.keys(self)
+                if self.last_access.get(group_id, 0) < deadline]
+
+    def evict(self, group_id):
+        """从内存中移除群数据（调用前需确保已落盘）"""
+        dict.pop(self, group_id, None)
+        self.last_access.pop(group_id, None)
+
+
+class ShardedStorage(NiuniuStorage):
+    """按群分片存储：data/niuniu/<group_id>.<ext|db>
+
+    每个分片是一个独立的 FileStorage 或 SqliteStorage，只包含一个群；
+    数据按群懒加载，保存时只写入发生变化的群对应的分片。
+    """
+
+    def __init__(self, backend: str, codec, shard_dir: str):
+        self.backend = backend
+        self.codec = codec
+        self.shard_dir = shard_dir
+        self.file_based = backend == 'file'
+        self._shards = {}
+        self._lock = threading.Lock()
+        os.makedirs(shard_dir, exist_ok=True)
+        # 磁盘上已存在分片的群
+        self._known = self._scan()
+
+    def _shard_base(self, group_id: str) -> str:
+        # 群号可能包含路径分隔符等字符（如webchat），需要转义
+        return os.path.join(self.shard_dir, quote(str(group_id), safe=''))
+
+    def _scan(self) -> set:
+        known = set()
+        for name in os.listdir(self.shard_dir):
+            base, ext = os.path.splitext(name)
+            if self.backend == 'file':
+                if ext in ('.yml', '.yaml', '.json', '.msgpack'):
+                    known.add(unquote(base))
+            elif ext == '.db':
+                known.add(unquote(base))
+        return known
+
+    def shard(self, group_id: str) -> NiuniuStorage:
+        """获取群对应的分片存储，不存在时创建"""
+        with self._lock:
+            shard = self._shards.get(group_id)
+            if shard is None:
+                base = self._shard_base(group_id)
+                if self.backend == 'file':
+                    shard = FileStorage(self.codec, base)
+                else:
+                    shard = SqliteStorage(base + '.db')
+                self._shards[group_id] = shard
+            return shard
+
+    def release(self, group_id: str):
+        """释放已淘汰群的分片资源"""
+        with self._lock:
+            shard = self._shards.pop(group_id, None)
+        if shard is not None:
+            shard.close()
+
+    def is_empty(self) -> bool:
+        return not self._known
+
+    def load(self) -> dict:
+        """返回懒加载字典，不读取任何分片"""
+        return ShardedGroups(self)
+
+    def load_group(self, group_id: str):
+        """读取单个群的数据，分片不存在时返回None"""
+        if group_id not in self._known:
+            return None
+        return self.shard(group_id).load().get(group_id)
+
+    def iter_groups(self):
+        """依次读取所有分片中的群数据（不放入内存），用于一次性统计"""
+        for group_id in sorted(self._known):
+            with self._lock:
+                opened = group_id in self._shards
+            try:
+                group_data = self.load_group(group_id)
+            finally:
+                if not opened:
+                    self.release(group_id)
+            if group_data is not None:
+                yield group_id, group_data
+
+    def snapshot(self, data: dict, keys=None):
+        """按群拆分快照，返回 [(group_id, 分片快照)]"""
+        if keys is None:
+            targets = {group_id: None for group_id in dict.keys(data)}
+        else:
+            targets = {}
+            for group_id, user_id in keys:
+                group_id = str(group_id)
+                if user_id is None:
+                    targets[group_id] = None
+                elif targets.get(group_id, ()) is not None:
+                    targets.setdefault(group_id, set()).add((group_id, str(user_id)))
+
+        payload = []
+        for group_id, shard_keys in targets.items():
+            group_data = data.peek(group_id) if isinstance(data, ShardedGroups) else data.get(group_id)
+            # 未落过盘的空群（只有默认设置）不创建分片
+            if group_id not in self._known and group_data in (None, {'plugin_enabled': False}):
+                continue
+            shard_data = {} if group_data is None else {group_id: group_data}
+            payload.append((group_id, self.shard(group_id).snapshot(shard_data, shard_keys)))
+        return payload
+
+    def write(self, payload):
+        for group_id, shard_payload in payload:
+            self.shard(group_id).write(shard_payload)
+            self._known.add(group_id)
+
+    def import_data(self, data: dict) -> bool:
+        """从单文件/单库布局一次性拆分导入（仅在还没有任何分片时执行）"""
+        if not self.is_empty() or not data:
+            return False
+        for group_id, group_data in data.items():
+            self.shard(str(group_id)).save({str(group_id): group_data})
+            self._known.add(str(group_id))
+        logger.info(f"已把 {len(data)} 个群的牛牛数据拆分到 {self.shard_dir}")
+        return True
+
+    def close(self):
+        with self._lock:
+            shards, self._shards = list(self._shards.values()), {}
+        for shard in shards:
+            shard.close()
+
+
+def create_storage(backend: str, codec, base_path: str, db_path: str,
+                   layout: str = 'single', shard_dir: str = '') -> NiuniuStorage:
+    """根据配置创建存储后端
+
+    Args:
+        backend: 'sqlite' 或 'file'（兼容旧配置值 'yaml'）
+        codec: 数据文件编解码器
+        base_path: 整文件存储的基础路径（同时作为SQLite的导入来源）
+        db_path: SQLite数据库路径
+        layout: 'single' 所有群存放在一起，'sharded' 每个群一个分片
+        shard_dir: 分片布局的目录
+    """
+    backend = 'file' if backend in ('file', 'yaml') else 'sqlite'
+    if layout == 'sharded':
+        storage = ShardedStorage(backend, codec, shard_dir)
+        if storage.is_empty():
+            try:
+                if os.path.exists(db_path):
+                    source = SqliteStorage(db_path)
+                    try:
+                        data = source.load()
+                    finally:
+                        source.close()
+                else:
+                    data = codec.load(base_path, lambda d: isinstance(d, dict))
+                storage.import_data(data or {})
+            except Exception as e:
+                logger.error(f"拆分原牛牛数据失败: {str(e)}")
+        return storage
+
+    if backend == 'file':
+        return FileStorage(codec, base_path)
+    storage = SqliteStorage(db_path)
+    try:
+        storage.import_file(codec, base_path)
+    except Exception as e:
+        logger.error(f"导入原牛牛数据失败: {str(e)}")
+    return storage
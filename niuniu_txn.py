@@ -0,0 +1,169 @@
+import asyncio
+import copy
+from contextvars import ContextVar
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# 当前任务所在的事务（每个asyncio任务有独立的上下文，并发的命令互不影响）
+_current: ContextVar[Optional['Transaction']] = ContextVar('niuniu_transaction', default=None)
+
+
+class LockManager:
+    """按 (群ID, 用户ID) 划分的异步锁
+
+    同时锁定多个用户时先对键排序再依次获取，两个事务不会互相等待对方持有的锁；
+    没有任务持有或等待的锁立即回收，锁的数量只与正在处理的用户数有关。
+    """
+
+    def __init__(self):
+        # {(group_id, user_id): [锁, 持有与等待的任务数]}
+        self._locks: Dict[Tuple[str, str], list] = {}
+
+    async def acquire(self, keys: Iterable[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """按顺序获取一组锁，返回已获取的键（用于之后释放）"""
+        acquired = []
+        try:
+            for key in sorted(set(keys)):
+                entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+                entry[1] += 1
+                try:
+                    await entry[0].acquire()
+                except BaseException:
+                    self._unref(key)
+                    raise
+                acquired.append(key)
+        except BaseException:
+            self.release(acquired)
+            raise
+        return acquired
+
+    def release(self, keys: List[Tuple[str, str]]):
+        """释放acquire获取的锁"""
+        for key in reversed(keys):
+            self._locks[key][0].release()
+            self._unref(key)
+
+    def _unref(self, key):
+        entry = self._locks[key]
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
+
+
+class Transaction:
+    """一组用户数据修改，全部生效或全部撤销
+
+    用法：
+        async with plugin.transaction(group_id, user_id, target_id):
+            ...  # 检查并修改用户数据
+
+    - 进入时按顺序锁定参与的用户，并保存这些用户数据的副本
+    - 事务内通过 get_user_data 读取的其他用户（如寄生虫主人）在首次读取时同样保存副本
+    - 事务内的变动日志、保存请求和 on_commit 回调先暂存，正常结束时统一写入日志，并合并为一次保存；
+      长度或金币发生变化但没有记录原因的用户同样写入一条日志
+    - 出现异常时把保存过副本的用户全部恢复原样，暂存的日志和保存请求一并丢弃
+    - 配置了共享状态时，开始时同步其他进程写入的数据，提交时检查版本（见 niuniu_backend）
+
+    事务内不应yield消息或等待网络请求，以免长时间占用锁；不支持嵌套。
+    """
+
+    def __init__(self, plugin, group_id, *user_ids):
+        self.plugin = plugin
+        self.group_id = str(group_id)
+        self.user_ids = [str(uid) for uid in user_ids if uid is not None]
+        self._keys: List[Tuple[str, str]] = []
+        self._before: Dict[str, Tuple[dict, dict]] = {}  # user_id -> (用户数据, 副本)
+        self._changes: List[tuple] = []
+        self._dirty = set()
+        self._on_commit: List = []
+        self._token = None
+
+    @staticmethod
+    def current(group_id=None) -> Optional['Transaction']:
+        """当前任务所在的事务，指定group_id时只返回该群的事务"""
+        txn = _current.get()
+        if txn is not None and group_id is not None and txn.group_id != str(group_id):
+            return None
+        return txn
+
+    async def __aenter__(self):
+        if _current.get() is not None:
+            raise RuntimeError("不支持嵌套事务")
+        self._keys = await self.plugin.locks.acquire((self.group_id, uid) for uid in self.user_ids)
+        try:
+            # 多进程部署时先取得其他进程写入的最新数据
+            for user_id in self.user_ids:
+                self.plugin.sync_user(self.group_id, user_id)
+        except BaseException:
+            self.plugin.locks.release(self._keys)
+            raise
+        self._token = _current.set(self)
+        for user_id in self.user_ids:
+            self.include(user_id, self.plugin.get_user_data(self.group_id, user_id))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        try:
+            if exc_type is None:
+                try:
+                    self._commit()
+                except BaseException:
+                    self._rollback()
+                    raise
+            else:
+                self._rollback()
+        finally:
+            self.plugin.locks.release(self._keys)
+        return False
+
+    def include(self, user_id, user_data):
+        """在首次修改前保存用户数据的副本"""
+        user_id = str(user_id)
+        if isinstance(user_data, dict) and user_id not in self._before:
+            self._before[user_id] = (user_data, copy.deepcopy(user_data))
+
+    def record(self, user_id, reason: str, dlen: int = 0, dcoins: int = 0):
+        """暂存一条变动日志"""
+        self._changes.append((str(user_id), reason, dlen, dcoins))
+
+    def on_commit(self, callback):
+        """事务提交后执行（用于用户数据之外的修改，如群账户入账）"""
+        self._on_commit.append(callback)
+
+    def mark_dirty(self, user_ids: Iterable):
+        """暂存保存请求"""
+        self._dirty.update(str(uid) for uid in user_ids if uid is not None)
+
+    def _commit(self):
+        touched = set(self._dirty)
+        touched.update(user_id for user_id, *_ in self._changes)
+        touched.update(user_id for user_id, (data, before) in self._before.items() if data != before)
+        if not touched:
+            self._run_on_commit()
+            return
+        # 先按版本写入共享状态，期间被其他进程修改时抛出 StaleRecord，本地修改随之撤销
+        users = {}
+        for user_id in touched:
+            user_data = self.plugin.get_user_data(self.group_id, user_id)
+            if user_data is not None:
+                users[user_id] = user_data
+        self.plugin.state.commit(self.group_id, users)
+        for user_id, reason, dlen, dcoins in self._changes:
+            self.plugin.record_change(self.group_id, user_id, reason, dlen, dcoins)
+        # 没有通过 record_change 记录原因的变化也按绝对值补写日志
+        for user_id, user_data in users.items():
+            self.plugin.journal.append_changed(self.group_id, user_id, 'txn', user_data)
+        self.plugin._mark_niuniu_dirty(self.group_id, *sorted(touched))
+        self._run_on_commit()
+
+    def _run_on_commit(self):
+        for callback in self._on_commit:
+            callback()
+
+    def _rollback(self):
+        for user_data, before in self._before.values():
+            user_data.clear()
+            user_data.update(before)
@@ -1,396 +1,535 @@
 import os
+import time
+import hashlib
+import sqlite3
+import asyncio
 import datetime
 import calendar
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 from PIL import Image, ImageDraw, ImageFont
 
-class SignImageGenerator:
-    def __init__(self):
-        self.base_dir = os.path.dirname(os.path.abspath(__file__))
-        self.lu_path = os.path.join(self.base_dir, 'lu.jpg')
-        self.deer_path = os.path.join(self.base_dir, 'deer_1f98c.png')
-        self.check_mark_path = os.path.join(self.base_dir, 'heavy-check-mark_2714.png')
-        self.signimg_dir = os.path.join(self.base_dir, 'signimg')
-        self.record_path = os.path.join(self.base_dir, 'signrecord.txt')
-        os.makedirs(self.signimg_dir, exist_ok=True)
+SIGN_DB_PATH = os.path.join('data', 'niuniu_sign.db')
+SIGN_TMP_TTL = 3600  # 未能按时删除的签到图片临时文件保留的时间（秒）
 
-    def get_month_name(self):
-        return datetime.datetime.now().strftime('%B')
 
-    def get_sign_image_path(self, group_id=None):
-        month = self.get_month_name()
-        if group_id:
-            return os.path.join(self.signimg_dir, f'sign{month}_{group_id}.png')
-        else:
-            return os.path.join(self.signimg_dir, f'sign{month}.png')
+class SignRecordStore:
+    """签到记录存储
 
-    def load_sign_records(self, user_id, group_id):
-        if not os.path.exists(self.record_path):
-            return set()
-        records = set()
-        
-        # 获取当前年月
-        now = datetime.datetime.now()
-        current_year = now.year
-        current_month = now.month
-        
-        try:
-            with open(self.record_path, 'r', encoding='utf-8') as f:
+    以 (群, 用户, 年月) 为主键，每月的签到日期保存为31位的位图，
+    查询某月签到记录只需一次主键查找，与历史记录的多少无关。
+    """
+
+    def __init__(self, path, legacy_path=None):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS sign_records ('
+            'group_id TEXT NOT NULL, user_id TEXT NOT NULL, month INTEGER NOT NULL, days INTEGER NOT NULL, '
+            'PRIMARY KEY (group_id, user_id, month))'
+        )
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+        if legacy_path:
+            self._migrate(legacy_path)
+
+    @staticmethod
+    def _month_key(year, month):
+        return year * 100 + month
+
+    def _migrate(self, legacy_path):
+        """一次性导入原 signrecord.txt（日期,用户,群）"""
+        with self._lock:
+            if self._conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_imported'").fetchone():
+                return
+        bitmaps = {}
+        if os.path.exists(legacy_path):
+            with open(legacy_path, 'r', encoding='utf-8') as f:
                 for line in f:
-                    if line.strip():
-                        parts = line.strip().split(',')
-                        if len(parts) == 3:  # 确保记录格式正确
-                            date, uid, gid = parts
-                            # 确保类型一致性
-                            if str(uid) == str(user_id) and str(gid) == str(group_id):
-                                try:
-                                    # 解析日期
-                                    date_parts = date.split('-')
-                                    year = int(date_parts[0])
-                                    month = int(date_parts[1])
-                                    day = int(date_parts[2])
-                                    
-                                    # 只添加当前年月的记录
-                                    if year == current_year and month == current_month:
-                                        records.add(day)
-                                except (IndexError, ValueError):
-                                    print(f"Invalid date format: {date}")
-        except Exception as e:
-            print(f"Error loading sign records: {e}")
-        return records
+                    parts = line.strip().split(',')
+                    if len(parts) != 3:
+                        continue
+                    date, uid, gid = parts
+                    try:
+                        year, month, day = (int(x) for x in date.split('-'))
+                        if not (1 <= month <= 12 and 1 <= day <= 31):
+                            raise ValueError(date)
+                    except ValueError:
+                        print(f"Invalid date format: {date}")
+                        continue
+                    key = (str(gid), str(uid), self._month_key(year, month))
+                    bitmaps[key] = bitmaps.get(key, 0) | (1 << (day - 1))
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO sign_records (group_id, user_id, month, days) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (group_id, user_id, month) DO UPDATE SET days = days | excluded.days',
+                [key + (days,) for key, days in bitmaps.items()]
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('legacy_imported', '1')")
+        if bitmaps:
+            print(f"已导入 {len(bitmaps)} 条月度签到记录")
 
-    def save_sign_record(self, user_id, group_id):
-        current_date = datetime.datetime.now().strftime('%Y-%m-%d')
-        try:
-            # 确保目录存在
-            os.makedirs(os.path.dirname(self.record_path), exist_ok=True)
-            # 以追加模式打开文件，如果文件不存在则创建
-            with open(self.record_path, 'a', encoding='utf-8') as f:
-                f.write(f"{current_date},{user_id},{group_id}\n")
-        except Exception as e:
-            print(f"Error saving sign record: {e}")
+    def get_bitmap(self, user_id, group_id, year, month):
+        """某月的签到位图，第n位表示第n+1天已签到"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT days FROM sign_records WHERE group_id = ? AND user_id = ? AND month = ?',
+                (str(group_id), str(user_id), self._month_key(year, month))
+            ).fetchone()
+        return row[0] if row else 0
 
-    def generate_sign_image(self, nickname, coins):
-        # 检查lu.jpg是否存在
-        if not os.path.exists(self.lu_path):
-            raise FileNotFoundError("lu.jpg not found")
+    def get_days(self, user_id, group_id, year, month):
+        """某月已签到的日期集合"""
+        bitmap = self.get_bitmap(user_id, group_id, year, month)
+        return {day for day in range(1, 32) if bitmap >> (day - 1) & 1}
+
+    def add(self, user_id, group_id, date):
+        """记录某天已签到"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT INTO sign_records (group_id, user_id, month, days) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (group_id, user_id, month) DO UPDATE SET days = days | excluded.days',
+                (str(group_id), str(user_id), self._month_key(date.year, date.month), 1 << (date.day - 1))
+            )
+
+
+_sign_store = None
+_sign_store_lock = threading.Lock()
+
+
+def get_sign_store(legacy_path=None):
+    """获取进程内共享的签到记录存储"""
+    global _sign_store
+    with _sign_store_lock:
+        if _sign_store is None:
+            _sign_store = SignRecordStore(SIGN_DB_PATH, legacy_path)
+        return _sign_store
 
-        # 创建基础图像
-        width = 800
-        height = 1100
-        image = Image.new('RGB', (width, height), 'white')
-        draw = ImageDraw.Draw(image)
 
+class AssetCache:
+    """签到图片素材缓存
+
+    字体、鹿/勾/lu图片及其缩放结果只加载一次；
+    每个月的静态背景层（标题、日历格子、日期数字）预先渲染，
+    生成图片时只需拷贝背景层并绘制每个用户不同的部分。
+    """
+
+    WIDTH = 800
+    HEIGHT = 1100
+    LU_SIZE = 100
+    CHECK_SIZE = LU_SIZE // 2  # 勾的大小为鹿图片的一半
+    GRID_TOP = 250
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+        self.lu_path = os.path.join(base_dir, 'lu.jpg')
+        self.deer_path = os.path.join(base_dir, 'deer_1f98c.png')
+        self.check_mark_path = os.path.join(base_dir, 'heavy-check-mark_2714.png')
+        self._lock = threading.RLock()
+        self._font = None
+        self._images = {}
+        self._layers = {}
+
+    @property
+    def font(self):
+        with self._lock:
+            if self._font is None:
+                self._font = self._load_font()
+            return self._font
+
+    def _load_font(self):
         # 尝试多个可能的字体路径
-        font = None
         font_paths = [
             os.path.join(self.base_dir, 'SimHei.ttf'),
             os.path.join(self.base_dir, 'fonts', 'SimHei.ttf'),
             'C:\\Windows\\Fonts\\SimHei.ttf'
         ]
-        
         for font_path in font_paths:
             try:
                 if os.path.exists(font_path):
                     font = ImageFont.truetype(font_path, 32)
                     print(f"成功加载字体: {font_path}")
-                    break
+                    return font
             except Exception as e:
                 print(f"加载字体失败 {font_path}: {str(e)}")
-                continue
-        
-        if font is None:
-            print("警告: 无法加载SimHei字体，使用默认字体")
-            font = ImageFont.load_default()
-
-        # 绘制标题
-        title_text_1 = "今天你"
-        title_text_2 = "了吗？"
-        # 计算文本宽度
-        title_text_1_width = font.getsize(title_text_1)[0] if hasattr(font, 'getsize') else font.getbbox(title_text_1)[2]
-        title_text_2_width = font.getsize(title_text_2)[0] if hasattr(font, 'getsize') else font.getbbox(title_text_2)[2]
-        
-        # 计算标题总宽度（包括图片）
-        deer_size = font.getsize("鹿")[1] if hasattr(font, 'getsize') else font.getbbox("鹿")[3]
-        total_width = title_text_1_width + deer_size + title_text_2_width
-        
-        # 计算起始位置
-        start_x = (width - total_width) // 2
-        
-        # 绘制第一部分文本
-        draw.text((start_x, 20), title_text_1, font=font, fill='black')
-        
-        # 插入鹿图片
-        if os.path.exists(self.deer_path):
-            deer_img = Image.open(self.deer_path)
-            deer_img = deer_img.resize((deer_size, deer_size))
-            image.paste(deer_img, (start_x + title_text_1_width, 20), deer_img if deer_img.mode == 'RGBA' else None)
-        
-        # 绘制第二部分文本
-        draw.text((start_x + title_text_1_width + deer_size, 20), title_text_2, font=font, fill='black')
+        print("警告: 无法加载SimHei字体，使用默认字体")
+        return ImageFont.load_default()
 
-        # 绘制用户信息
-        current_date = datetime.datetime.now().strftime('%Y年%m月%d日')
-        draw.text((20, 80), f"用户：{nickname}", font=font, fill='black')
-        draw.text((20, 130), f"日期：{current_date}", font=font, fill='black')
-        
-        # 绘制签到信息
-        sign_text_1 = "今天你成功"
-        sign_text_2 = "了，获得"
-        sign_text_3 = f"{coins}金币"
-        
-        # 计算文本宽度
-        sign_text_1_width = font.getsize(sign_text_1)[0] if hasattr(font, 'getsize') else font.getbbox(sign_text_1)[2]
-        sign_text_2_width = font.getsize(sign_text_2)[0] if hasattr(font, 'getsize') else font.getbbox(sign_text_2)[2]
-        
-        # 绘制签到文本和图片
-        x = 20
-        draw.text((x, 180), sign_text_1, font=font, fill='black')
-        x += sign_text_1_width
-        
-        if os.path.exists(self.deer_path):
-            deer_img = Image.open(self.deer_path)
-            deer_img = deer_img.resize((deer_size, deer_size))
-            image.paste(deer_img, (x, 180), deer_img if deer_img.mode == 'RGBA' else None)
-        
-        x += deer_size
-        draw.text((x, 180), sign_text_2 + sign_text_3, font=font, fill='black')
+    def text_width(self, text):
+        # 兼容不同版本的PIL
+        font = self.font
+        if hasattr(font, 'getsize'):
+            return font.getsize(text)[0]
+        bbox = font.getbbox(text)
+        return bbox[2] - bbox[0]
 
-        # 加载鹿图片
-        lu_img = Image.open(self.lu_path)
-        lu_size = 100
-        lu_img = lu_img.resize((lu_size, lu_size))
+    @property
+    def deer_size(self):
+        """标题中鹿图片的边长（与一个汉字等高）"""
+        font = self.font
+        return font.getsize("鹿")[1] if hasattr(font, 'getsize') else font.getbbox("鹿")[3]
 
-        # 获取当月日历
-        now = datetime.datetime.now()
-        cal = calendar.monthcalendar(now.year, now.month)
+    def image(self, path, size):
+        """读取并缩放图片，文件不存在时返回None"""
+        key = (path, size)
+        with self._lock:
+            if key not in self._images:
+                if os.path.exists(path):
+                    img = Image.open(path)
+                    img.load()
+                    self._images[key] = img.resize((size, size))
+                else:
+                    self._images[key] = None
+            return self._images[key]
 
-        # 绘制日历
-        start_y = 250
-        for week in cal:
+    def paste(self, image, path, size, pos):
+        """把缓存的图片粘贴到画布上（保留透明通道）"""
+        img = self.image(path, size)
+        if img is not None:
+            image.paste(img, pos, img if img.mode == 'RGBA' else None)
+
+    def draw_with_deer(self, image, draw, pos, before, after):
+        """绘制"文字+鹿图片+文字"，鹿图片替代"鹿"字"""
+        x, y = pos
+        draw.text((x, y), before, font=self.font, fill='black')
+        x += self.text_width(before)
+        self.paste(image, self.deer_path, self.deer_size, (x, y))
+        draw.text((x + self.deer_size, y), after, font=self.font, fill='black')
+
+    def day_positions(self, year, month):
+        """日历中每一天的左上角坐标 {day: (x, y)}"""
+        positions = {}
+        start_y = self.GRID_TOP
+        for week in calendar.monthcalendar(year, month):
             x = 20
             for day in week:
                 if day != 0:
-                    # 粘贴鹿图片
-                    image.paste(lu_img, (x, start_y))
-                    # 添加日期数字
-                    day_str = str(day)
-                    # 兼容不同版本的PIL
-                    try:
-                        # 尝试使用新版PIL的getbbox方法
-                        bbox = font.getbbox(day_str)
-                        day_width = bbox[2] - bbox[0]
-                    except AttributeError:
-                        # 回退到旧版PIL的getsize方法
-                        day_width, _ = font.getsize(day_str)
-                    draw.text((x + (lu_size - day_width) // 2, start_y + lu_size), 
-                             day_str, font=font, fill='black')
-
-                    # 如果是今天的日期，添加签到标记
-                    if day == now.day:
-                        if os.path.exists(self.check_mark_path):
-                            check_img = Image.open(self.check_mark_path)
-                            check_size = lu_size // 2  # 设置勾的大小为鹿图片的一半
-                            check_img = check_img.resize((check_size, check_size))
-                            # 计算勾的位置，使其居中显示在鹿图片上
-                            check_x = x + (lu_size - check_size) // 2
-                            check_y = start_y + (lu_size - check_size) // 2
-                            image.paste(check_img, (check_x, check_y), check_img if check_img.mode == 'RGBA' else None)
-                    x += lu_size + 10
-                    # 如果是已签到的日期，添加签到标记
-                    if day in sign_records:
-                        if os.path.exists(self.check_mark_path):
-                            check_img = Image.open(self.check_mark_path)
-                            check_size = lu_size // 2  # 设置勾的大小为鹿图片的一半
-                            check_img = check_img.resize((check_size, check_size))
-                            # 计算勾的位置，使其居中显示在鹿图片上
-                            check_x = x + (lu_size - check_size) // 2
-                            check_y = start_y + (lu_size - check_size) // 2
-                            image.paste(check_img, (check_x, check_y), check_img if check_img.mode == 'RGBA' else None)
-                x += lu_size + 10
-            start_y += lu_size + 40
+                    positions[day] = (x, start_y)
+                x += self.LU_SIZE + 10
+            start_y += self.LU_SIZE + 40
+        return positions
 
-        return image
+    def background(self, kind, year, month):
+        """获取某个月的静态背景层（调用方需自行copy）
 
-    def create_sign_image(self, nickname, coins, group_id=None):
-        # 生成签到图片
-        image = self.generate_sign_image(nickname, coins)
-        
-        # 保存图片
-        save_path = self.get_sign_image_path(group_id)
-        image.save(save_path)
-        return save_path
+        Args:
+            kind: 'sign' 签到图片，'calendar' 日历图片
+        """
+        key = (kind, year, month)
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is None:
+                # 只保留当月的背景层
+                self._layers = {k: v for k, v in self._layers.items() if k[1:] == (year, month)}
+                layer = self._render_background(kind, year, month)
+                self._layers[key] = layer
+            return layer
 
-    def generate_calendar_image(self, nickname, user_id, group_id):
+    def _render_background(self, kind, year, month):
         # 检查lu.jpg是否存在
         if not os.path.exists(self.lu_path):
             raise FileNotFoundError("lu.jpg not found")
 
-        # 创建基础图像
-        width = 800
-        height = 1100
-        image = Image.new('RGB', (width, height), 'white')
+        image = Image.new('RGB', (self.WIDTH, self.HEIGHT), 'white')
         draw = ImageDraw.Draw(image)
 
-        # 尝试多个可能的字体路径
-        font = None
-        font_paths = [
-            os.path.join(self.base_dir, 'SimHei.ttf'),
-            os.path.join(self.base_dir, 'fonts', 'SimHei.ttf'),
-            'C:\\Windows\\Fonts\\SimHei.ttf'
-        ]
-        
-        for font_path in font_paths:
+        # 绘制居中的标题
+        if kind == 'sign':
+            before, after = "今天你", "了吗？"
+        else:
+            before, after = "本月", "关记录"
+        total_width = self.text_width(before) + self.deer_size + self.text_width(after)
+        self.draw_with_deer(image, draw, ((self.WIDTH - total_width) // 2, 20), before, after)
+
+        if kind == 'calendar':
+            # 绘制"你就是鹿关大师！"文本，将"鹿"替换为图片
+            self.draw_with_deer(image, draw, (20, 180), "你就是", "关大师！")
+
+        # 绘制日历格子和日期数字
+        lu_img = self.image(self.lu_path, self.LU_SIZE)
+        for day, (x, y) in self.day_positions(year, month).items():
+            image.paste(lu_img, (x, y))
+            day_str = str(day)
+            draw.text((x + (self.LU_SIZE - self.text_width(day_str)) // 2, y + self.LU_SIZE),
+                      day_str, font=self.font, fill='black')
+        return image
+
+    def draw_check_marks(self, image, year, month, days):
+        """在已签到的日期上居中绘制勾"""
+        positions = self.day_positions(year, month)
+        offset = (self.LU_SIZE - self.CHECK_SIZE) // 2
+        for day in days:
+            if day in positions:
+                x, y = positions[day]
+                self.paste(image, self.check_mark_path, self.CHECK_SIZE, (x + offset, y + offset))
+
+
+_asset_cache = None
+
+
+def get_asset_cache(base_dir):
+    """获取进程内共享的素材缓存"""
+    global _asset_cache
+    with _sign_store_lock:
+        if _asset_cache is None:
+            _asset_cache = AssetCache(base_dir)
+        return _asset_cache
+
+
+class SignImageGenerator:
+    def __init__(self):
+        self.base_dir = os.path.dirname(os.path.abspath(__file__))
+        self.assets = get_asset_cache(self.base_dir)
+        self.signimg_dir = os.path.join(self.base_dir, 'signimg')
+        self.calendar_dir = os.path.join(self.signimg_dir, 'calendar')  # 日历图片缓存
+        self.tmp_dir = os.path.join(self.signimg_dir, 'tmp')  # 签到图片，发送后删除
+        self.record_path = os.path.join(self.base_dir, 'signrecord.txt')  # 原签到记录，首次启动时导入
+        self.store = get_sign_store(self.record_path)
+        os.makedirs(self.calendar_dir, exist_ok=True)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def get_month_name(self):
+        return datetime.datetime.now().strftime('%B')
+
+    @staticmethod
+    def _user_prefix(user_id, group_id):
+        # 群号/用户ID可能包含路径分隔符等字符，需要转义
+        return f"{quote(str(group_id), safe='')}_{quote(str(user_id), safe='')}_"
+
+    def _calendar_user_dir(self, user_id, group_id):
+        # 每个用户一个缓存目录，清理时只需列出该用户自己的文件；'.'也转义，避免出现 '..' 目录
+        return os.path.join(self.calendar_dir, *(
+            quote(str(part), safe='').replace('.', '%2E') for part in (group_id, user_id)
+        ))
+
+    def new_sign_image_path(self, group_id=None, user_id=None):
+        """为一次签到创建临时图片文件，发送后由 remove_image 删除"""
+        fd, path = tempfile.mkstemp(prefix=f'sign_{self._user_prefix(user_id, group_id)}', suffix='.png',
+                                    dir=self.tmp_dir)
+        os.close(fd)
+        return path
+
+    @staticmethod
+    def remove_image(path):
+        """删除已发送的签到图片"""
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def clean_tmp(self, ttl=SIGN_TMP_TTL):
+        """删除超过ttl秒仍未删除的签到图片（如发送途中进程退出）"""
+        deadline = time.time() - ttl
+        try:
+            names = os.listdir(self.tmp_dir)
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.tmp_dir, name)
             try:
-                if os.path.exists(font_path):
-                    font = ImageFont.truetype(font_path, 32)
-                    print(f"成功加载字体: {font_path}")
-                    break
-            except Exception as e:
-                print(f"加载字体失败 {font_path}: {str(e)}")
-                continue
-        
-        if font is None:
-            print("警告: 无法加载SimHei字体，使用默认字体")
-            font = ImageFont.load_default()
+                if os.path.getmtime(path) < deadline:
+                    os.remove(path)
+            except OSError:
+                pass
 
-        # 绘制标题
-        title = "本月关记录"
-        # 兼容不同版本的PIL
+    def get_calendar_cache_path(self, nickname, user_id, group_id):
+        """日历图片的缓存路径，由 (用户, 群, 年月, 签到位图, 昵称) 决定
+
+        内容不变时路径不变，可直接复用已生成的图片。
+        """
+        now = datetime.datetime.now()
+        bitmap = self.store.get_bitmap(user_id, group_id, now.year, now.month)
+        digest = hashlib.sha1(
+            f"{group_id}|{user_id}|{now.year}-{now.month}|{bitmap}|{nickname}".encode('utf-8')
+        ).hexdigest()[:16]
+        return os.path.join(self._calendar_user_dir(user_id, group_id), f'{now:%Y%m}_{digest}.png')
+
+    def get_cached_calendar(self, nickname, user_id, group_id):
+        """已缓存的日历图片路径，没有缓存时返回None"""
+        path = self.get_calendar_cache_path(nickname, user_id, group_id)
+        return path if os.path.exists(path) else None
+
+    def invalidate_calendar(self, user_id, group_id, keep=None):
+        """删除用户已缓存的日历图片（keep为需要保留的路径）"""
+        user_dir = self._calendar_user_dir(user_id, group_id)
         try:
-            # 尝试使用新版PIL的getbbox方法
-            bbox = font.getbbox(title)
-            title_width = bbox[2] - bbox[0]
-        except AttributeError:
-            # 回退到旧版PIL的getsize方法
-            title_width, _ = font.getsize(title)
-        
-        # 计算标题位置
-        title_x = (width - title_width - font.getsize("鹿")[1] if hasattr(font, 'getsize') else font.getbbox("鹿")[3]) // 2
-        title_y = 20
-        
-        # 绘制标题文本的第一部分"本月"
-        # 绘制标题
-        month_text = "本月"
-        record_text = "关记录"
-        # 计算文本宽度
-        month_width = font.getsize(month_text)[0] if hasattr(font, 'getsize') else font.getbbox(month_text)[2]
-        record_width = font.getsize(record_text)[0] if hasattr(font, 'getsize') else font.getbbox(record_text)[2]
-        deer_size = font.getsize("鹿")[1] if hasattr(font, 'getsize') else font.getbbox("鹿")[3]
-        
-        # 计算总宽度（月 + 鹿 + 关记录）
-        total_width = month_width + deer_size + record_width
-        
-        # 计算起始位置以居中显示
-        title_x = (width - total_width) // 2
-        title_y = 20
-        
-        # 绘制第一部分文本
-        draw.text((title_x, title_y), month_text, font=font, fill='black')
-        
-        # 在"本月"后面插入鹿图片
-        if os.path.exists(self.deer_path):
-            deer_img = Image.open(self.deer_path)
-            deer_img = deer_img.resize((deer_size, deer_size))
-            image.paste(deer_img, (title_x + month_width, title_y), deer_img if deer_img.mode == 'RGBA' else None)
-            
-            # 绘制"关记录"部分
-            draw.text((title_x + month_width + deer_size, title_y), record_text, font=font, fill='black')
+            names = os.listdir(user_dir)
+        except OSError:
+            return  # 没有缓存
+        for name in names:
+            path = os.path.join(user_dir, name)
+            if name.endswith('.png') and path != keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
 
-        # 加载用户签到记录
-        sign_records = self.load_sign_records(user_id, group_id)
-        sign_count = len(sign_records)
+    @staticmethod
+    def _save_image(image, path):
+        # 先写临时文件再替换，发送中的图片不会读到写了一半的内容
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, format='PNG')
+        os.replace(tmp_path, path)
 
-        # 绘制用户信息
+    def load_sign_records(self, user_id, group_id):
+        # 获取当前年月的签到日期
         now = datetime.datetime.now()
-        current_month = now.strftime('%Y年%m月')
-        draw.text((20, 80), f"用户：{nickname}", font=font, fill='black')
-        # 绘制签到次数文本
-        sign_text_1 = "本月"
-        sign_text_2 = f"关{sign_count}次"
-        
-        # 计算文本宽度
-        sign_text_1_width = font.getsize(sign_text_1)[0] if hasattr(font, 'getsize') else font.getbbox(sign_text_1)[2]
-        
-        # 绘制第一部分文本
-        draw.text((20, 130), sign_text_1, font=font, fill='black')
-        
-        # 插入鹿图片
-        if os.path.exists(self.deer_path):
-            deer_img = Image.open(self.deer_path)
-            deer_size = font.getsize("鹿")[1] if hasattr(font, 'getsize') else font.getbbox("鹿")[3]
-            deer_img = deer_img.resize((deer_size, deer_size))
-            image.paste(deer_img, (20 + sign_text_1_width, 130), deer_img if deer_img.mode == 'RGBA' else None)
-        
-        # 绘制第二部分文本
-        draw.text((20 + sign_text_1_width + deer_size, 130), sign_text_2, font=font, fill='black')
-        
-        # 绘制"你就是鹿关大师！"文本，将"鹿"替换为图片
-        master_text_1 = "你就是"
-        master_text_2 = "关大师！"
-        master_text_1_width = font.getsize(master_text_1)[0] if hasattr(font, 'getsize') else font.getbbox(master_text_1)[2]
-        
-        # 绘制第一部分文本
-        draw.text((20, 180), master_text_1, font=font, fill='black')
-        
-        # 插入鹿图片
-        if os.path.exists(self.deer_path):
-            deer_img = Image.open(self.deer_path)
-            deer_img = deer_img.resize((deer_size, deer_size))
-            image.paste(deer_img, (20 + master_text_1_width, 180), deer_img if deer_img.mode == 'RGBA' else None)
+        try:
+            return self.store.get_days(user_id, group_id, now.year, now.month)
+        except Exception as e:
+            print(f"Error loading sign records: {e}")
+            return set()
+
+    def save_sign_record(self, user_id, group_id):
+        try:
+            self.store.add(user_id, group_id, datetime.date.today())
+            self.invalidate_calendar(user_id, group_id)
+        except Exception as e:
+            print(f"Error saving sign record: {e}")
+
+    def generate_sign_image(self, nickname, coins, user_id=None, group_id=None):
+        now = datetime.datetime.now()
+        assets = self.assets
+        image = assets.background('sign', now.year, now.month).copy()
+        draw = ImageDraw.Draw(image)
+
+        # 绘制用户信息
+        current_date = now.strftime('%Y年%m月%d日')
+        draw.text((20, 80), f"用户：{nickname}", font=assets.font, fill='black')
+        draw.text((20, 130), f"日期：{current_date}", font=assets.font, fill='black')
+
+        # 绘制签到信息
+        assets.draw_with_deer(image, draw, (20, 180), "今天你成功", f"了，获得{coins}金币")
+
+        # 标记今天及本月已签到的日期
+        sign_records = {now.day}
+        if user_id is not None and group_id is not None:
+            sign_records |= self.load_sign_records(user_id, group_id)
+        assets.draw_check_marks(image, now.year, now.month, sign_records)
+        return image
+
+    def create_sign_image(self, nickname, coins, group_id=None, user_id=None):
+        # 生成签到图片
+        image = self.generate_sign_image(nickname, coins, user_id, group_id)
         
-        # 绘制第二部分文本
-        draw.text((20 + master_text_1_width + deer_size, 180), master_text_2, font=font, fill='black')
+        # 保存到临时文件，每次签到一个文件，发送后删除
+        save_path = self.new_sign_image_path(group_id, user_id)
+        try:
+            image.save(save_path, format='PNG')
+        except BaseException:
+            self.remove_image(save_path)
+            raise
+        return save_path
 
-        # 加载鹿图片
-        lu_img = Image.open(self.lu_path)
-        lu_size = 100
-        lu_img = lu_img.resize((lu_size, lu_size))
+    def generate_calendar_image(self, nickname, user_id, group_id):
+        now = datetime.datetime.now()
+        assets = self.assets
+        image = assets.background('calendar', now.year, now.month).copy()
+        draw = ImageDraw.Draw(image)
 
-        # 获取当月日历
-        cal = calendar.monthcalendar(now.year, now.month)
+        # 加载用户签到记录
+        sign_records = self.load_sign_records(user_id, group_id)
 
-        # 绘制日历
-        start_y = 250
-        for week in cal:
-            x = 20
-            for day in week:
-                if day != 0:
-                    # 粘贴鹿图片
-                    image.paste(lu_img, (x, start_y))
-                    # 添加日期数字
-                    day_str = str(day)
-                    # 兼容不同版本的PIL
-                    try:
-                        # 尝试使用新版PIL的getbbox方法
-                        bbox = font.getbbox(day_str)
-                        day_width = bbox[2] - bbox[0]
-                    except AttributeError:
-                        # 回退到旧版PIL的getsize方法
-                        day_width, _ = font.getsize(day_str)
-                    draw.text((x + (lu_size - day_width) // 2, start_y + lu_size), 
-                             day_str, font=font, fill='black')
-
-                    # 如果是已签到的日期，添加签到标记
-                    if day in sign_records:
-                        if os.path.exists(self.check_mark_path):
-                            check_img = Image.open(self.check_mark_path)
-                            check_size = lu_size // 2  # 设置勾的大小为鹿图片的一半
-                            check_img = check_img.resize((check_size, check_size))
-                            # 计算勾的位置，使其居中显示在鹿图片上
-                            check_x = x + (lu_size - check_size) // 2
-                            check_y = start_y + (lu_size - check_size) // 2
-                            image.paste(check_img, (check_x, check_y), check_img if check_img.mode == 'RGBA' else None)
-                x += lu_size + 10
-            start_y += lu_size + 40
+        # 绘制用户信息和签到次数
+        draw.text((20, 80), f"用户：{nickname}", font=assets.font, fill='black')
+        assets.draw_with_deer(image, draw, (20, 130), "本月", f"关{len(sign_records)}次")
 
+        # 标记已签到的日期
+        assets.draw_check_marks(image, now.year, now.month, sign_records)
         return image
 
     def create_calendar_image(self, nickname, user_id, group_id):
+        # 签到记录没有变化时直接使用缓存
+        calendar_path = self.get_calendar_cache_path(nickname, user_id, group_id)
+        if os.path.exists(calendar_path):
+            return calendar_path
+
         # 生成日历图片
         image = self.generate_calendar_image(nickname, user_id, group_id)
-        
-        # 保存图片
-        month = self.get_month_name()
-        calendar_path = os.path.join(self.signimg_dir, f'calendar{month}_{group_id}.png')
-        image.save(calendar_path)
-        return calendar_path
\ No newline at end of file
+
+        # 保存图片（同时清理该用户旧的缓存）
+        os.makedirs(os.path.dirname(calendar_path), exist_ok=True)
+        self._save_image(image, calendar_path)
+        self.invalidate_calendar(user_id, group_id, keep=calendar_path)
+        return calendar_path
+
+class SignRenderService:
+    """异步签到图片渲染服务
+
+    在独立的线程池中绘制并编码PNG，避免阻塞事件循环；
+    等待中的渲染数超过上限时直接拒绝（返回None），由调用方回退到文字回复。
+    """
+
+    def __init__(self, max_workers=2, max_pending=8):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='niuniu_sign')
+        # 清理上次运行遗留的签到图片
+        self._executor.submit(lambda: SignImageGenerator().clean_tmp())
+        self.pending = 0
+        self.rendered = 0
+        self.rejected = 0
+        self.failed = 0
+        self.cache_hits = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self._total_latency = 0.0
+
+    async def _submit(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return None
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self._executor, func, *args)
+        except Exception as e:
+            self.failed += 1
+            print(f"渲染签到图片失败: {str(e)}")
+            return None
+        finally:
+            self.pending -= 1
+        latency = time.perf_counter() - start
+        self.rendered += 1
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self._total_latency += latency
+        return result
+
+    async def render_sign(self, nickname, coins, group_id, user_id):
+        """渲染签到图片，返回临时文件路径（发送后需调用 SignImageGenerator.remove_image）；繁忙或失败时返回None"""
+        return await self._submit(
+            lambda: SignImageGenerator().create_sign_image(nickname, coins, group_id, user_id))
+
+    async def render_calendar(self, nickname, user_id, group_id):
+        """渲染签到日历，返回图片路径；繁忙或失败时返回None"""
+        # 查询签到记录与检查文件同样会阻塞，放到默认线程池中执行；缓存命中时不占用渲染线程
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(
+            None, lambda: SignImageGenerator().get_cached_calendar(nickname, user_id, group_id))
+        if cached:
+            self.cache_hits += 1
+            return cached
+        return await self._submit(
+            lambda: SignImageGenerator().create_calendar_image(nickname, user_id, group_id))
+
+    def stats(self):
+        """渲染队列与耗时统计"""
+        return {
+            'pending': self.pending,
+            'max_pending': self.max_pending,
+            'rendered': self.rendered,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'cache_hits': self.cache_hits,
+            'last_latency': self.last_latency,
+            'avg_latency': self._total_latency / self.rendered if self.rendered else 0.0,
+            'max_latency': self.max_latency,
+        }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
@@ -1,7 +1,11 @@
 import os
-import yaml
+import copy
+import time
 from typing import Tuple, List
+from astrbot.api import logger
 from astrbot.api.message_components import At, Plain
+from niuniu_journal import TaxLedger
+from niuniu_txn import Transaction
 
 class TaxSystem:
     """税收系统类，管理金币获取时的税收"""
@@ -14,12 +18,25 @@ class TaxSystem:
         """
         self.plugin = plugin
         # 修改为data目录下的路径，确保数据不会在更新时被覆盖
-        self.tax_file = os.path.join('data', 'niuniu_tax.yml')
+        self.tax_file = os.path.join('data', 'niuniu_tax')  # 不含扩展名，由数据格式决定
         self.tax_data = self._load_tax_data()
+        # 群账户收支明细：每笔收支先追加到明细，余额文件延后批量保存
+        storage_cfg = self.plugin.config.get('storage_config', {})
+        self.ledger = TaxLedger(self.plugin.worker_file(os.path.join('data', 'niuniu_tax_ledger.jsonl')),
+                                storage_cfg.get('journal_fsync_interval', 1.0))
+        self.plugin.persistence.register(
+            'tax',
+            lambda keys: (self.ledger.seq, copy.deepcopy(self.tax_data)),
+            self._write_tax_data
+        )
         
         # 确保groups字典存在
         if 'groups' not in self.tax_data:
             self.tax_data['groups'] = {}
+        # 恢复上次保存之后的收支
+        self.ledger.replay(self.tax_data['groups'])
+        # 各群当日收入 {group_id: (日期, 金额)}，启动时从明细统计
+        self.daily_income = self._load_daily_income()
         
         # 初始化赋税开关状态
         if 'tax_enabled' not in self.tax_data:
@@ -27,19 +44,21 @@ class TaxSystem:
         
         # 保存初始数据
         self._save_tax_data()
+
+        # 注册命令
+        router = self.plugin.router
+        router.add('群账户', self.handle_treasury_command)
+        router.add(('开启赋税', '启用赋税'), lambda event: self.handle_tax_switch(event, True), exact=True)
+        router.add(('关闭赋税', '停用赋税'), lambda event: self.handle_tax_switch(event, False), exact=True)
         
     def _load_tax_data(self) -> dict:
-        """加载税收数据"""
-        if not os.path.exists(self.tax_file):
-            return {'groups': {}}
-        
+        """加载税收数据，文件损坏时回退到最新的有效历史版本"""
         try:
-            with open(self.tax_file, 'r', encoding='utf-8') as f:
-                data = yaml.safe_load(f)
-                if not data:
-                    data = {'groups': {}}
-                elif not isinstance(data.get('groups'), dict):
-                    data['groups'] = {}
+            data = self.plugin.load_data_file(self.tax_file, lambda d: d is None or isinstance(d, dict))
+            if not data:
+                data = {'groups': {}}
+            elif not isinstance(data.get('groups'), dict):
+                data['groups'] = {}
                     
             return data
         except Exception as e:
@@ -47,13 +66,19 @@ class TaxSystem:
             return {'groups': {}}
             
     def _save_tax_data(self):
-        """保存税收数据"""
-        try:
-            os.makedirs(os.path.dirname(self.tax_file), exist_ok=True)
-            with open(self.tax_file, 'w', encoding='utf-8') as f:
-                yaml.dump(self.tax_data, f, allow_unicode=True)
-        except Exception as e:
-            logger.error(f"保存税收数据失败: {str(e)}")
+        """标记税收数据待保存"""
+        self.plugin.persistence.mark_dirty('tax')
+
+    def _write_tax_data(self, payload):
+        """把税收数据快照写入文件后推进明细检查点"""
+        seq, data = payload
+        self.plugin.codec.write(self.plugin.worker_file(self.tax_file), data)
+        self.ledger.checkpoint(seq)
+
+    def flush_ledger(self):
+        """有未保存的收支时标记税收数据待保存（由定期压缩和卸载时调用）"""
+        if self.ledger.seq > self.ledger.checkpoint_seq:
+            self._save_tax_data()
             
     def calculate_tax(self, amount: int) -> Tuple[int, int]:
         """计算应缴税额
@@ -67,15 +92,7 @@ class TaxSystem:
         if amount <= 0:
             return 0, 0
             
-        # 计算税率
-        if amount < 100:
-            tax_rate = 0.05  # 5%
-        elif amount < 1000:
-            tax_rate = 0.10  # 10%
-        elif amount < 5000:
-            tax_rate = 0.20  # 20%
-        else:
-            tax_rate = 0.30  # 30%
+        tax_rate = self.tax_rate(amount)
             
         # 计算税额（向上取整）
         tax = int(amount * tax_rate + 0.5)
@@ -84,21 +101,67 @@ class TaxSystem:
         
         return after_tax, tax
         
-    def add_tax_to_treasury(self, group_id: str, tax_amount: int):
+    @staticmethod
+    def tax_rate(amount: int) -> float:
+        """金额适用的税率"""
+        if amount < 100:
+            return 0.05  # 5%
+        elif amount < 1000:
+            return 0.10  # 10%
+        elif amount < 5000:
+            return 0.20  # 20%
+        return 0.30  # 30%
+
+    def add_tax_to_treasury(self, group_id: str, tax_amount: int, source: str = 'tax', payer=None,
+                            amount: int = 0, rate: float = 0.0):
         """将税收添加到群公共账户
         
         Args:
             group_id: 群ID
             tax_amount: 税额
+            source: 收入来源
+            payer: 缴税用户
+            amount: 税前金额
+            rate: 适用税率
         """
         if not isinstance(group_id, str):
             group_id = str(group_id)
-            
-        if group_id not in self.tax_data['groups']:
-            self.tax_data['groups'][group_id] = 0
-            
-        self.tax_data['groups'][group_id] += tax_amount
-        self._save_tax_data()
+
+        # 在事务中时等事务提交后再入账，事务撤销时群账户也保持不变
+        txn = Transaction.current(group_id)
+        if txn is not None:
+            txn.on_commit(lambda: self.add_tax_to_treasury(group_id, tax_amount, source, payer, amount, rate))
+            return
+        self._change_balance(group_id, tax_amount, source, payer, amount, rate)
+
+    def _change_balance(self, group_id: str, delta: int, source: str, payer=None,
+                        amount: int = 0, rate: float = 0.0):
+        """修改群账户余额并记入明细（余额文件由 flush_ledger 延后保存）"""
+        groups = self.tax_data['groups']
+        groups[group_id] = groups.get(group_id, 0) + delta
+        self.ledger.entry(group_id, source, delta, groups[group_id], payer, amount, rate)
+        if delta > 0:
+            today = time.strftime('%Y-%m-%d')
+            day, income = self.daily_income.get(group_id, (today, 0))
+            self.daily_income[group_id] = (today, (income if day == today else 0) + delta)
+
+    def _load_daily_income(self) -> dict:
+        """从收支明细（含归档）统计各群今日收入"""
+        today = time.strftime('%Y-%m-%d')
+        today_start = time.mktime(time.strptime(today, '%Y-%m-%d'))
+        income = {}
+        try:
+            for record in self.ledger.history(today_start):
+                if record.get('delta', 0) > 0:
+                    income[record['group']] = income.get(record['group'], 0) + record['delta']
+        except Exception as e:
+            logger.error(f"统计今日收入失败: {str(e)}")
+        return {group_id: (today, amount) for group_id, amount in income.items()}
+
+    def get_daily_income(self, group_id: str) -> int:
+        """群账户今日收入"""
+        day, income = self.daily_income.get(str(group_id), (None, 0))
+        return income if day == time.strftime('%Y-%m-%d') else 0
         
     def get_treasury_balance(self, group_id: str) -> int:
         """获取群公共账户余额
@@ -114,12 +177,14 @@ class TaxSystem:
             
         return self.tax_data['groups'].get(group_id, 0)
         
-    def process_coins(self, group_id: str, amount: int) -> Tuple[int, int]:
+    def process_coins(self, group_id: str, amount: int, payer=None, source: str = 'income') -> Tuple[int, int]:
         """处理金币获取，计算税收并更新公共账户
         
         Args:
             group_id: 群ID
             amount: 获得的金币数量
+            payer: 获得金币的用户
+            source: 收入来源（记入群账户明细）
             
         Returns:
             Tuple[int, int]: (税后金额, 税额)
@@ -130,7 +195,7 @@ class TaxSystem:
             
         after_tax, tax = self.calculate_tax(amount)
         if tax > 0:
-            self.add_tax_to_treasury(group_id, tax)
+            self.add_tax_to_treasury(group_id, tax, source, payer, amount, self.tax_rate(amount))
         return after_tax, tax
         
     def show_treasury_menu(self) -> str:
@@ -162,7 +227,7 @@ class TaxSystem:
             return False, f"❌ 群账户余额不足，当前余额：{balance}金币"
             
         # 获取群内所有注册用户
-        group_data = self.plugin.get_group_data(group_id)
+        group_data = self.plugin.peek_group_data(group_id)
         registered_users = []
         for user_id, user_data in group_data.items():
             if isinstance(user_data, dict) and 'nickname' in user_data:
@@ -179,11 +244,11 @@ class TaxSystem:
         # 发放工资
         for user_id, user_data in registered_users:
             user_data['coins'] = user_data.get('coins', 0) + amount_per_person
+            self.plugin.record_change(group_id, user_id, 'salary', dcoins=amount_per_person)
             
         # 扣除群账户余额
-        self.tax_data['groups'][group_id] -= total_amount
-        self._save_tax_data()
-        self.plugin._save_niuniu_lengths()
+        self._change_balance(group_id, -total_amount, 'salary')
+        self.plugin._save_niuniu_lengths(group_id, *[user_id for user_id, _ in registered_users])
         
         return True, f"✅ 成功发放工资！\n总金额：{total_amount}金币\n每人获得：{amount_per_person}金币\n当前群账户余额：{self.get_treasury_balance(group_id)}金币"
         
@@ -210,9 +275,9 @@ class TaxSystem:
             
         # 执行转账
         target_data['coins'] = target_data.get('coins', 0) + amount
-        self.tax_data['groups'][group_id] -= amount
-        self._save_tax_data()
-        self.plugin._save_niuniu_lengths()
+        self.plugin.record_change(group_id, target_id, 'treasury_transfer', dcoins=amount)
+        self._change_balance(group_id, -amount, 'treasury_transfer', target_id)
+        self.plugin._save_niuniu_lengths(group_id, target_id)
         
         target_nickname = target_data.get('nickname', '未知用户')
         return True, f"✅ 成功转账！\n金额：{amount}金币\n接收者：{target_nickname}\n当前群账户余额：{self.get_treasury_balance(group_id)}金币"
@@ -246,4 +311,64 @@ class TaxSystem:
             self.tax_data['tax_enabled'] = {}
             
         self.tax_data['tax_enabled'][group_id] = enabled
-        self._save_tax_data() 
\ No newline at end of file
+        self._save_tax_data()
+
+    async def handle_treasury_command(self, event):
+        """处理群账户相关命令（管理员）"""
+        group_id = str(event.message_obj.group_id)
+        msg = event.message_str.strip()
+        user_id = str(event.get_sender_id())
+        if not self.plugin.is_admin(user_id):
+            yield event.plain_result("❌ 只有管理员才能使用群账户功能")
+            return
+            
+        if msg == "群账户":
+            # 显示群账户余额
+            balance = self.get_treasury_balance(group_id)
+            tax_status = "✅ 已开启" if self.is_tax_enabled(group_id) else "❌ 已关闭"
+            income = self.get_daily_income(group_id)
+            yield event.plain_result(f"💰 群账户余额：{balance}金币\n📈 今日收入：{income}金币\n💹 赋税状态：{tax_status}\n\n{self.show_treasury_menu()}")
+            
+        elif msg.startswith("群账户 发工资"):
+            try:
+                amount = int(msg.replace("群账户 发工资", "").strip())
+                if amount <= 0:
+                    yield event.plain_result("❌ 金额必须大于0")
+                    return
+                    
+                success, result = self.distribute_salary(group_id, amount)
+                yield event.plain_result(result)
+            except ValueError:
+                yield event.plain_result("❌ 请输入正确的金额，例如：群账户 发工资 1000")
+                
+        elif msg.startswith("群账户 转账"):
+            # 解析目标用户和金额
+            target_id = self.plugin.parse_at_target(event)
+            if not target_id:
+                yield event.plain_result("❌ 请指定转账目标")
+                return
+                
+            try:
+                amount = int(msg.split()[-1])
+                if amount <= 0:
+                    yield event.plain_result("❌ 金额必须大于0")
+                    return
+                    
+                success, result = self.transfer_to_user(group_id, target_id, amount)
+                yield event.plain_result(result)
+            except (ValueError, IndexError):
+                yield event.plain_result("❌ 请输入正确的金额，例如：群账户 转账 @用户 1000")
+
+    async def handle_tax_switch(self, event, enabled: bool):
+        """处理赋税开关命令（管理员）"""
+        group_id = str(event.message_obj.group_id)
+        user_id = str(event.get_sender_id())
+        if not self.plugin.is_admin(user_id):
+            yield event.plain_result("❌ 只有管理员才能控制赋税")
+            return
+            
+        self.set_tax_status(group_id, enabled)
+        if enabled:
+            yield event.plain_result("✅ 赋税已开启！群内所有收入将按比例缴纳税款")
+        else:
+            yield event.plain_result("✅ 赋税已关闭！群内所有收入将不再缴纳税款")
@@ -1,4 +1,3 @@
-import asyncio
 import time
 from astrbot.api.all import At, Plain, MessageChain
 
@@ -8,11 +7,24 @@ class TimerTest:
     专门用于测试延时消息回复功能
     """
     
-    def __init__(self, context):
-        """初始化，传入Context以便发送消息"""
+    def __init__(self, context, scheduler, router):
+        """初始化，传入Context以便发送消息，传入调度器以安排定时任务，传入命令路由以注册命令"""
         self.context = context
-        self.tasks = {}  # 存储任务引用，防止被垃圾回收
+        self.scheduler = scheduler
+        scheduler.register('timer_test', self._send_delayed_message)
+        # 独立测试命令，不需要牛牛插件启用
+        router.add('定时测试', self.test_timer, exact=True)
+        router.add('定时测试', self._test_timer_minutes, pattern=r'\s+(\d+)(?:分钟)?')
         
+    async def _test_timer_minutes(self, event, match):
+        """可以指定时间的定时测试，限制在1-60分钟之间"""
+        minutes = int(match.group(1))
+        if 1 <= minutes <= 60:
+            async for result in self.test_timer(event, minutes):
+                yield result
+        else:
+            yield event.plain_result("⚠️ 定时测试时间需要在1-60分钟之间")
+
     async def test_timer(self, event, delay_minutes=1):
         """
         测试定时器功能
@@ -30,25 +42,20 @@ class TimerTest:
         # 返回确认消息
         yield event.plain_result(f"⏱️ {nickname}，我会在{delay_minutes}分钟后回复你！")
         
-        # 创建并存储异步任务
+        # 安排定时任务
         task_id = f"timer_test_{user_id}_{int(time.time())}"
-        task = asyncio.create_task(self._send_delayed_message(
-            user_id=user_id,
-            nickname=nickname,
-            unified_msg_origin=unified_msg_origin,
-            delay_minutes=delay_minutes
-        ))
-        self.tasks[task_id] = task
-        
-        # 设置清理回调
-        task.add_done_callback(lambda t: self.tasks.pop(task_id, None))
+        self.scheduler.schedule(
+            task_id, time.time() + delay_minutes * 60, 'timer_test',
+            user_id=user_id, origin=unified_msg_origin,
+            payload={'nickname': nickname, 'delay_minutes': delay_minutes}
+        )
     
-    async def _send_delayed_message(self, user_id, nickname, unified_msg_origin, delay_minutes):
-        """异步发送延迟消息"""
+    async def _send_delayed_message(self, job):
+        """发送延迟消息"""
+        user_id = job.user_id
+        nickname = job.payload.get('nickname')
+        delay_minutes = job.payload.get('delay_minutes')
         try:
-            # 等待指定时间
-            await asyncio.sleep(delay_minutes * 60)
-            
             # 构建回复消息
             message = MessageChain([
                 At(qq=user_id),